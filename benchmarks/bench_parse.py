@@ -0,0 +1,73 @@
+"""Micro-benchmark of the parsing of clamd scan replies.
+
+Compares the fast path of the common INSTREAM replies with the regex
+path (error replies), with and without raw data, both on lines already
+split and through ClamdReplyReader.
+
+Usage:
+.. code-block:: shell
+
+    python benchmarks/bench_parse.py [-n NUMBER]
+
+"""
+import argparse
+import timeit
+
+from clamav_rest_service.clamd import ClamdUnixSocket
+from clamav_rest_service.clamd.client import ClamdReplyReader
+
+REPLIES = {
+    "ok": b"stream: OK\x00",
+    "found": b"stream: Win.Test.EICAR_HDB-1 FOUND\x00",
+    # not on the fast path
+    "error": b"stream: INSTREAM size limit exceeded. ERROR\x00",
+}
+
+
+class ReplaySocket():
+    """Socket replaying a reply, then EOF.
+    """
+    def __init__(self, data: bytes):
+        self._data = data
+        self._sent = False
+
+    def recv_into(self, buf) -> int:
+        if self._sent:
+            return 0
+        self._sent = True
+        buf[:len(self._data)] = self._data
+        return len(self._data)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=200000,
+                        help="parses per measure (default 200000)")
+    args = parser.parse_args()
+
+    print(f"{'reply':8} {'raw data':9} {'lines ns/op':>12} "
+          f"{'socket ns/op':>13}")
+    for keep_raw_data in (False, True):
+        clamd = ClamdUnixSocket("/dev/null", keep_raw_data=keep_raw_data)
+        for name, reply in REPLIES.items():
+            lines = reply.decode().split("\x00")[:1]
+
+            def parse_lines():
+                clamd._parse_scan_result(iter(lines))
+
+            def parse_socket():
+                reader = ClamdReplyReader(ReplaySocket(reply), b"\x00",
+                                          clamd.buffer_size,
+                                          clamd.max_reply_size)
+                clamd._parse_scan_result(reader.records())
+
+            results = []
+            for func in (parse_lines, parse_socket):
+                best = min(timeit.repeat(func, number=args.number, repeat=5))
+                results.append(best / args.number * 1e9)
+            print(f"{name:8} {str(keep_raw_data):9} {results[0]:12.0f} "
+                  f"{results[1]:13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""Member-level parallel scanning of archive uploads.
+
+A large archive sent to clamd via INSTREAM is scanned by a single clamd
+thread, one member after another.  Here we expand zip and tar (plain or
+compressed) uploads ourselves and stream each member to clamd on its
+own connection: members are read sequentially, but clamd scans them in
+parallel while we keep streaming the following ones.
+
+Expansion is bounded (member count, nesting depth and total expanded
+size) so that the mode cannot be abused as a decompression bomb.  When
+a limit is hit or the archive cannot be read (also halfway through a
+member), the caller should fall back to scanning the upload as a whole.
+
+The archive itself is never sent to clamd, only its members: signatures
+matching the whole container (e.g. .hdb hashes of the archive file) and
+clamd heuristics on the container structure are lost, which is why the
+mode is opt-in.
+
+"""
+import bz2
+import dataclasses
+import gzip
+import io
+import lzma
+import shutil
+import tarfile
+import tempfile
+import threading
+import typing as t
+import zipfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .clamd import Clamd, ClamdScanResult, ClamdScanStatus
+
+# offset and magic of the ustar header in a tar file
+TAR_MAGIC_OFFSET = 257
+TAR_MAGIC = b"ustar"
+ZIP_MAGIC = b"PK\x03\x04"
+# magic bytes of compressions understood by tarfile
+COMPRESSION_MAGICS = {
+    b"\x1f\x8b": gzip.open,
+    b"BZh": bz2.open,
+    b"\xfd7zXZ\x00": lzma.open,
+}
+
+# nested archives smaller than this are spooled in memory
+SPOOL_MAX_MEMORY = 1024 * 1024
+# errors of zipfile, tarfile and decompressors on corrupt archives;
+# RuntimeError is raised by zipfile for encrypted members,
+# NotImplementedError for unsupported compression methods
+READ_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError,
+               zlib.error, lzma.LZMAError, NotImplementedError, RuntimeError)
+
+
+class ArchiveError(Exception):
+    """Raised when an archive cannot be expanded for scanning.
+    """
+
+
+class ArchiveLimitExceeded(ArchiveError):
+    """Raised when an archive exceeds the configured expansion limits.
+    """
+
+
+@dataclasses.dataclass
+class ArchiveLimits():
+    """Limits enforced while expanding an archive.
+    """
+    max_members: int = 10000
+    max_depth: int = 2
+    max_expanded_size: int = 512 * 1024 * 1024
+
+
+class _Budget():
+    """Expansion budget shared by all the members of an upload.
+    """
+    def __init__(self, limits: ArchiveLimits):
+        self.limits = limits
+        self.members = 0
+        self.expanded_size = 0
+
+    def add_member(self) -> None:
+        self.members += 1
+        if self.members > self.limits.max_members:
+            raise ArchiveLimitExceeded(
+                f"Archive has more than {self.limits.max_members} members")
+
+    def add_bytes(self, size: int) -> None:
+        self.expanded_size += size
+        if self.expanded_size > self.limits.max_expanded_size:
+            raise ArchiveLimitExceeded(
+                "Archive expands to more than "
+                f"{self.limits.max_expanded_size} bytes")
+
+
+class _LimitedReader(io.RawIOBase):
+    """Read a member stream charging every byte to the budget.
+
+    Sizes declared in archive headers can't be trusted, so we count
+    what is actually decompressed.  Members are decompressed (and their
+    CRC checked) while clamd reads them, so read errors are raised as
+    ArchiveError from here.
+    """
+    def __init__(self, stream: t.IO[bytes], budget: _Budget):
+        self._stream = stream
+        self._budget = budget
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        try:
+            data = self._stream.read(size)
+        except READ_ERRORS as e:
+            raise ArchiveError(f"Unable to read archive member: {e}") from e
+        self._budget.add_bytes(len(data))
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def detect_archive(stream: t.IO[bytes]) -> str | None:
+    """Detect whether the stream holds a supported archive.
+
+    The stream position is restored before returning.
+
+    :param stream: Seekable input stream
+    :return: "zip", "tar" or None if not a supported archive
+    """
+    pos = stream.tell()
+    try:
+        head = stream.read(TAR_MAGIC_OFFSET + len(TAR_MAGIC))
+        if head.startswith(ZIP_MAGIC):
+            return "zip"
+        if head[TAR_MAGIC_OFFSET:].startswith(TAR_MAGIC):
+            return "tar"
+        for magic, decompressor in COMPRESSION_MAGICS.items():
+            if head.startswith(magic):
+                # only compressed tars are archives, a plain gzip'd
+                # file is scanned as is by clamd
+                stream.seek(pos)
+                try:
+                    with decompressor(stream) as f:
+                        head = f.read(TAR_MAGIC_OFFSET + len(TAR_MAGIC))
+                except (OSError, EOFError, lzma.LZMAError, zlib.error):
+                    return None
+                if head[TAR_MAGIC_OFFSET:].startswith(TAR_MAGIC):
+                    return "tar"
+                return None
+        return None
+    finally:
+        stream.seek(pos)
+
+
+def iter_members(stream: t.IO[bytes],
+                 budget: _Budget,
+                 prefix: str = "",
+                 depth: int = 1) -> t.Iterator[tuple[str, t.IO[bytes]]]:
+    """Iterate over the regular file members of an archive.
+
+    Nested archives are expanded recursively up to the depth limit;
+    deeper ones are yielded as plain members and left to clamd.
+
+    :param stream: Seekable stream of the archive
+    :param budget: Expansion budget to charge
+    :param prefix: Path of the archive, prepended to member names
+    :param depth: Nesting depth of the archive (top level is 1)
+    :return: Iterator of (member path, member stream)
+    """
+    if depth > budget.limits.max_depth:
+        raise ArchiveLimitExceeded(
+            f"Archive nesting deeper than {budget.limits.max_depth}")
+
+    kind = detect_archive(stream)
+    try:
+        if kind == "zip":
+            members = _iter_zip(stream)
+        elif kind == "tar":
+            members = _iter_tar(stream)
+        else:
+            raise ArchiveError("Not a supported archive")
+
+        for name, member_stream in members:
+            budget.add_member()
+            path = prefix + name
+            limited = io.BufferedReader(_LimitedReader(member_stream, budget))
+
+            if depth < budget.limits.max_depth and _is_archive(limited):
+                # spool the nested archive, we need random access to it
+                with tempfile.SpooledTemporaryFile(SPOOL_MAX_MEMORY) as spool:
+                    shutil.copyfileobj(limited, spool)
+                    spool.seek(0)
+                    if detect_archive(spool) is None:
+                        # compressed, but not a tar
+                        yield path, spool
+                    else:
+                        yield from iter_members(spool, budget,
+                                                prefix=path + "/",
+                                                depth=depth + 1)
+            else:
+                yield path, limited
+    except READ_ERRORS as e:
+        raise ArchiveError(f"Unable to read archive: {e}") from e
+
+
+def scan_archive(stream: t.IO[bytes],
+                 clamd_factory: t.Callable[[], Clamd],
+                 limits: ArchiveLimits,
+                 workers: int) -> ClamdScanResult | None:
+    """Scan each member of an archive on its own clamd connection.
+
+    Members are streamed sequentially, while up to `workers` clamd
+    connections are scanning at the same time.  Results are merged
+    into a single verdict: FOUND wins over ERROR, which wins over OK.
+    Members with a verdict other than OK are listed in `details`.
+
+    :param stream: Seekable stream of the upload
+    :param clamd_factory: Callable returning a new, unconnected client
+    :param limits: Expansion limits
+    :param workers: Maximum number of concurrent clamd connections
+    :return: Merged result, or None if the upload is not an archive
+    :raises ArchiveError: if the archive can't be expanded within limits
+    """
+    if not stream.seekable() or detect_archive(stream) is None:
+        return None
+
+    budget = _Budget(limits)
+    slots = threading.BoundedSemaphore(workers)
+    futures: list[tuple[str, Future]] = []
+
+    def wait_result(clamd: Clamd) -> ClamdScanResult:
+        try:
+            return clamd.instream_result()
+        finally:
+            clamd.close()
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, member_stream in iter_members(stream, budget):
+            # wait for a free clamd connection before streaming
+            slots.acquire()
+            try:
+                clamd = clamd_factory()
+                clamd.connect()
+            except BaseException:
+                slots.release()
+                raise
+            try:
+                clamd.instream_send(member_stream)
+            except BaseException:
+                clamd.close()
+                slots.release()
+                raise
+            futures.append((name, executor.submit(wait_result, clamd)))
+
+        results = [(name, f.result()) for name, f in futures]
+
+    return _merge_results(results)
+
+
+def _merge_results(
+        results: list[tuple[str, ClamdScanResult]]) -> ClamdScanResult:
+    """Merge the results of members scanning in a single result.
+    """
+    found = [(n, r) for n, r in results
+             if r.status == ClamdScanStatus.FOUND]
+    failed = [(n, r) for n, r in results
+              if r.status not in (ClamdScanStatus.OK, ClamdScanStatus.FOUND)]
+
+    details = [f"{n}: {r.virus} FOUND" for n, r in found]
+    details += [f"{n}: {r.err_msg} {r.status.value}" for n, r in failed]
+
+    if found:
+        status = ClamdScanStatus.FOUND
+        virus = found[0][1].virus
+        err_msg = None
+    elif failed:
+        status = failed[0][1].status
+        virus = None
+        err_msg = failed[0][1].err_msg
+    else:
+        status = ClamdScanStatus.OK
+        virus = None
+        err_msg = None
+
+    message = f"stream: {virus} FOUND" if virus else f"stream: {status.value}"
+    return ClamdScanResult(
+        input_file="stream",
+        raw_data="".join(r.raw_data or "" for _, r in results),
+        message=message,
+        status=status,
+        virus=virus,
+        err_msg=err_msg,
+        details=details,
+    )
+
+
+def _iter_zip(stream: t.IO[bytes]) -> t.Iterator[tuple[str, t.IO[bytes]]]:
+    with zipfile.ZipFile(stream) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            with zf.open(info) as member_stream:
+                yield info.filename, member_stream
+
+
+def _iter_tar(stream: t.IO[bytes]) -> t.Iterator[tuple[str, t.IO[bytes]]]:
+    # streaming mode: members are read once, in order, no seeking back
+    with tarfile.open(fileobj=stream, mode="r|*") as tf:
+        for info in tf:
+            if not info.isfile():
+                continue
+            member_stream = tf.extractfile(info)
+            yield info.name, member_stream
+
+
+def _is_archive(stream: io.BufferedReader) -> bool:
+    """Peek a member stream to check whether it is a nested archive.
+    """
+    head = stream.peek(TAR_MAGIC_OFFSET + len(TAR_MAGIC))
+    if head.startswith(ZIP_MAGIC):
+        return True
+    if head[TAR_MAGIC_OFFSET:].startswith(TAR_MAGIC):
+        return True
+    return any(head.startswith(m) for m in COMPRESSION_MAGICS)
@@ -0,0 +1,138 @@
+"""Static assets served with precompressed variants and long caching.
+
+Static files (mostly the Swagger UI bundle) are served:
+ - precompressed: `<file>.br` and `<file>.gz` variants, generated at
+   build time with `python docker/precompress_static.py`, are chosen
+   by content negotiation on Accept-Encoding
+ - versioned: URLs built with url_for('static') carry a `v` query arg
+   with a hash of the content, so that responses for the current
+   version can be cached forever (immutable); other requests are
+   revalidated with ETag
+
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import typing as t
+
+from flask import Response, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# variants in order of preference: (content encoding, file suffix)
+ENCODINGS = [
+    ("br", ".br"),
+    ("gzip", ".gz"),
+]
+COMPRESSED_SUFFIXES = tuple(suffix for _, suffix in ENCODINGS)
+# don't bother compressing tiny files
+MIN_COMPRESS_SIZE = 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def precompress(static_dir: str) -> list[str]:
+    """Write compressed variants of the static files.
+
+    Variants newer than their file are left untouched.  Brotli
+    variants are written only if the `brotli` package is installed.
+
+    :param static_dir: Directory of the static files
+    :return: Paths of the variants written
+    """
+    compressors: dict[str, t.Callable[[bytes], bytes]] = {
+        ".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+    }
+    if brotli is not None:
+        compressors[".br"] = lambda data: brotli.compress(data, quality=11)
+
+    written = []
+    for root, _, files in os.walk(static_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(COMPRESSED_SUFFIXES) or \
+               os.path.getsize(path) < MIN_COMPRESS_SIZE:
+                continue
+            mtime = os.path.getmtime(path)
+            data = None
+            for suffix, compress in compressors.items():
+                variant = path + suffix
+                if os.path.exists(variant) and \
+                   os.path.getmtime(variant) >= mtime:
+                    continue
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                with open(variant, "wb") as f:
+                    f.write(compress(data))
+                written.append(variant)
+    return written
+
+
+class StaticAssets():
+    """Serve the files of a static directory.
+    """
+    def __init__(self, static_dir: str):
+        self.static_dir = static_dir
+        self._versions: dict[str, str] = {}
+
+    def version(self, filename: str) -> str | None:
+        """Get the version (content hash) of a static file.
+
+        :return: Version, None if the file does not exist
+        """
+        if filename not in self._versions:
+            path = safe_join(self.static_dir, filename)
+            if path is None:
+                return None
+            try:
+                with open(path, "rb") as f:
+                    digest = hashlib.file_digest(f, "sha256")
+                self._versions[filename] = digest.hexdigest()[:16]
+            except OSError:
+                # not cached, or random names would grow the cache
+                return None
+        return self._versions[filename]
+
+    def send(self,
+             filename: str,
+             accept_encodings: t.Container[str],
+             version: str | None) -> Response:
+        """Send a static file, precompressed if possible.
+
+        :param filename: Path of the file, relative to the directory
+        :param accept_encodings: Encodings accepted by the client
+        :param version: Version requested by the client, if any
+        :return: Response
+        """
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accept_encodings:
+                continue
+            variant = filename + suffix
+            path = safe_join(self.static_dir, variant)
+            if path is None or not os.path.isfile(path):
+                continue
+            # mimetype from the original file name, not the variant
+            response = send_from_directory(
+                self.static_dir, variant,
+                mimetype=mimetypes.guess_type(filename)[0],
+                etag=True)
+            response.content_encoding = encoding
+            break
+        if response is None:
+            response = send_from_directory(self.static_dir, filename)
+        response.vary.add("Accept-Encoding")
+
+        if version is not None and version == self.version(filename):
+            response.cache_control.no_cache = False
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
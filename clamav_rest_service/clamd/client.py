@@ -21,13 +21,132 @@ from .types import ClamdException, \
 
 scan_status_line_pattern = re.compile(r"^(.+?):\s+(.+)?\s?(OK|FOUND|ERROR)$")
 
+# replies larger than this are a broken or hostile daemon
+DEFAULT_MAX_REPLY_SIZE = 16 * 1024 * 1024
+# fast path of the common INSTREAM replies
+STREAM_PREFIX = "stream: "
+STREAM_OK = "stream: OK"
+FOUND_SUFFIX = " FOUND"
+
+
+def single_record(record: str) -> bool:
+    """End replies made of a single record (PING, VERSION, INSTREAM).
+    """
+    return True
+
+
+def stats_end(record: str) -> bool:
+    """End STATS replies, whose last line is END.
+    """
+    return record.rstrip().endswith("END")
+
+
+class ClamdReplyReader():
+    """Buffered reader of clamd replies.
+
+    Replies are read as records delimited by the command terminator
+    (clamd respects the terminator that we chose), yielded as soon as
+    they arrive.  Replies of a known shape end at their last record
+    (e.g. the single record of PING or INSTREAM), without waiting for
+    clamd to close the connection, so that it can be reused.  Data is
+    received with recv_into() in a buffer allocated once, grown only
+    for records larger than it, up to the max reply size.
+    """
+    def __init__(self,
+                 sock: socket.socket,
+                 terminator: bytes,
+                 buffer_size: int,
+                 max_reply_size: int):
+        self._sock = sock
+        self._terminator = terminator
+        self._max_reply_size = max_reply_size
+        self._buf = bytearray(buffer_size)
+        # unconsumed data is self._buf[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        self._eof = False
+
+    def records(self,
+                is_last: t.Callable[[str], bool] | None = None
+                ) -> t.Iterator[str]:
+        """Iterate over the records of a reply.
+
+        :param is_last: Tells whether a record ends the reply, None to
+          read until the connection is closed by clamd
+        :return: Iterator of decoded records, without terminator
+        :raises ClamdException: if the reply exceeds the max size
+        """
+        reply_size = 0
+        while True:
+            record = self._next_record()
+            if record is None:
+                return
+            reply_size += len(record) + 1
+            if reply_size > self._max_reply_size:
+                raise ClamdException("clamd reply exceeds "
+                                     f"{self._max_reply_size} bytes")
+            record = record.decode()
+            yield record
+            if is_last is not None and is_last(record):
+                return
+
+    def _next_record(self) -> bytes | None:
+        # pending bytes already searched for the terminator
+        searched = 0
+        while True:
+            i = self._buf.find(self._terminator, self._start + searched,
+                               self._end)
+            if i >= 0:
+                record = bytes(self._buf[self._start:i])
+                self._start = i + 1
+                return record
+            searched = self._end - self._start
+            if self._eof or not self._fill():
+                # trailing data without terminator
+                record = bytes(self._buf[self._start:self._end])
+                self._start = self._end
+                return record or None
+
+    def _fill(self) -> bool:
+        """Receive more data, making room in the buffer if needed.
+
+        :return: False at EOF
+        """
+        pending = self._end - self._start
+        if self._end == len(self._buf):
+            if pending > self._max_reply_size:
+                raise ClamdException("clamd reply exceeds "
+                                     f"{self._max_reply_size} bytes")
+            if pending * 2 > len(self._buf):
+                # mostly full of a single record: grow
+                self._buf.extend(bytes(len(self._buf)))
+            # move the pending record at the start
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = pending
+
+        with memoryview(self._buf) as view:
+            size = self._sock.recv_into(view[self._end:])
+        if not size:
+            self._eof = True
+            return False
+        self._end += size
+        return True
+
 
 class Clamd(abc.ABC):
     """Abstract client for clamd daemon.
     """
-    def __init__(self, cmd_terminator: bytes, buffer_size: int):
+    def __init__(self,
+                 cmd_terminator: bytes,
+                 buffer_size: int,
+                 max_reply_size: int = DEFAULT_MAX_REPLY_SIZE,
+                 keep_raw_data: bool = True):
         self.cmd_terminator = cmd_terminator
         self.buffer_size = buffer_size
+        self.max_reply_size = max_reply_size
+        # raw replies are rebuilt only if requested (or unparsable)
+        self.keep_raw_data = keep_raw_data
 
         # cmd specifier is a prefix we put before the command.  Its
         # value is 'z' for null terminated commands or 'n' for newline
@@ -41,6 +160,7 @@ class Clamd(abc.ABC):
                                  "\\x00 or \\n accepted."
                                  "Read man clamd(8) for details")
         self._sock = None
+        self._reader = None
 
     def __enter__(self):
         self.connect()
@@ -54,6 +174,9 @@ class Clamd(abc.ABC):
         """Connect to clamd daemon.
         """
         self._sock = self._get_connection()
+        self._reader = ClamdReplyReader(self._sock, self.cmd_terminator,
+                                        self.buffer_size,
+                                        self.max_reply_size)
 
     def close(self) -> None:
         """Close connection to clamd daemon.
@@ -65,14 +188,14 @@ class Clamd(abc.ABC):
 
         Check the server's state. It should reply with "PONG".
         """
-        return self._simple_command("PING")
+        return self._simple_command("PING", single_record)
 
     def version(self) -> ClamdCmdResponse:
         """Execute clamd VERSION command.
 
         Print program and database versions.
         """
-        return self._simple_command("VERSION")
+        return self._simple_command("VERSION", single_record)
 
     def stats(self) -> ClamdCmdResponse:
         """Execute clamd STATS command.
@@ -80,7 +203,7 @@ class Clamd(abc.ABC):
         Replies with statistics about the scan queue, contents of scan
         queue, and memory usage.
         """
-        return self._simple_command("STATS")
+        return self._simple_command("STATS", stats_end)
 
     def scan(self, filepath: str) -> ClamdScanResult:
         """Execute clamd SCAN command.
@@ -93,8 +216,8 @@ class Clamd(abc.ABC):
         :return: Result of the scanning as ClamdScanResult instance
         """
         self._send_command(f"SCAN {filepath}")
-        recd_raw = self._recv()
-        return self._parse_scan_result(recd_raw)
+        # one record per file of a directory, until clamd closes
+        return self._parse_scan_result(self._recv())
 
     def instream(self, input_stream: t.IO[bytes]) -> ClamdScanResult:
         """Execute clamd INSTREAM command.
@@ -107,9 +230,28 @@ class Clamd(abc.ABC):
         :param input_stream: Input stream to analyze
         :return: Result of the scanning as ClamdScanResult instance
         """
-        self._send_command_streaming("INSTREAM", input_stream)
-        recd_raw = self._recv()
-        return self._parse_scan_result(recd_raw)
+        self.instream_send(input_stream)
+        return self.instream_result()
+
+    def instream_send(self, input_stream: t.IO[bytes]) -> int:
+        """Send an INSTREAM command without waiting for the verdict.
+
+        clamd starts scanning only once the whole stream is received,
+        so the caller can go on with other work (e.g. streaming another
+        file on another connection) and collect the verdict later with
+        instream_result().
+
+        :param input_stream: Input stream to analyze
+        :return: Number of bytes streamed
+        """
+        return self._send_command_streaming("INSTREAM", input_stream)
+
+    def instream_result(self) -> ClamdScanResult:
+        """Wait for the verdict of an INSTREAM sent with instream_send().
+
+        :return: Result of the scanning as ClamdScanResult instance
+        """
+        return self._parse_scan_result(self._recv(single_record))
 
     # TODO implement SESSION workflow with these methods and dedicated class
     #
@@ -138,15 +280,19 @@ class Clamd(abc.ABC):
         :return: Socket connected to clamd
         """
 
-    def _simple_command(self, command: str) -> ClamdCmdResponse:
+    def _simple_command(self,
+                        command: str,
+                        is_last: t.Callable[[str], bool] | None = None
+                        ) -> ClamdCmdResponse:
         """Send simple command to clamd and wait for response.
 
         :param command: Command to execute, possible values in man clamd(8)
+        :param is_last: Tells whether a record ends the response, None
+          to read until clamd closes the connection
         :return: clamd command response
         """
         self._send_command(command)
-        recd_raw = self._recv()
-        return self._parse_response(recd_raw)
+        return self._parse_response(self._recv(is_last))
 
     def _send_command(self, command: str) -> None:
         """Send command to clamd.
@@ -161,27 +307,26 @@ class Clamd(abc.ABC):
         logging.debug("Sending command: %s", full_cmd)
         self._sock.send(full_cmd)
 
-    def _recv(self) -> str:
+    def _recv(self,
+              is_last: t.Callable[[str], bool] | None = None
+              ) -> t.Iterator[str]:
         """Receive response from clamd socket.
 
-        :return: Raw data received (UTF-8)
+        :param is_last: Tells whether a record ends the response, None
+          to read until clamd closes the connection
+        :return: Iterator of the lines (records) of the response, as
+          they are received (UTF-8)
         """
-        # block until we receive everything from daemon
-        recd_data = bytearray()
-        recd_buf = self._sock.recv(self.buffer_size)
-        while recd_buf:
-            recd_data.extend(recd_buf)
-            recd_buf = self._sock.recv(self.buffer_size)
-
-        return recd_data.decode()
+        return self._reader.records(is_last)
 
     def _send_command_streaming(self,
                                 command: str,
-                                input_stream: t.IO[bytes]) -> None:
+                                input_stream: t.IO[bytes]) -> int:
         """Send a command streaming content to clamd.
 
         :param command: Command to send
         :input_stream: Input stream to send chunked to clamd
+        :return: Number of bytes streamed
         """
         self._send_command(command)
 
@@ -190,9 +335,11 @@ class Clamd(abc.ABC):
         read_buf_size = self.buffer_size - 4
 
         # send stream of packets
+        total = 0
         buf = input_stream.read(read_buf_size)
         while buf:
             buflen = len(buf)
+            total += buflen
             # pack buf as man clamd(8) says for INSTREAM command
             chunk = struct.pack('!L{}s'.format(buflen), buflen, buf)
             self._sock.send(chunk)
@@ -205,48 +352,77 @@ class Clamd(abc.ABC):
 
         # send an empty buffer to signal that we are finished
         self._sock.send(struct.pack('!L', 0))
+        return total
 
-    def _parse_response(self, raw_resp: str) -> ClamdCmdResponse:
+    def _parse_response(self, lines: t.Iterable[str]) -> ClamdCmdResponse:
         """Parse a generic clamd response to a command.
 
-        :param raw_resp: Raw clamd response string
+        :param lines: Lines of the clamd response
         :return: Structured response object
         """
-        # split lines using cmd terminator (clamd respects the
-        # terminator that we chose)
-        raw_resp_lines = raw_resp.split(self.cmd_terminator.decode())
-        message = raw_resp_lines[0]
-        additional_lines = raw_resp_lines[1:]
-
+        lines = iter(lines)
+        message = next(lines, "")
         # remove ''
-        additional_lines = [al for al in additional_lines if al]
-
+        additional_lines = [al for al in lines if al]
         return ClamdCmdResponse(
-            raw_data=raw_resp,
+            raw_data=self._raw_data(message, additional_lines)
+            if self.keep_raw_data else None,
             message=message,
             details=additional_lines,
         )
 
-    def _parse_scan_result(self, raw_resp: str) -> ClamdScanResult:
+    def _raw_data(self, message: str, details: list[str]) -> str:
+        """Rebuild the raw response from its lines.
+        """
+        terminator = self.cmd_terminator.decode()
+        return "".join(line + terminator for line in [message, *details])
+
+    def _parse_scan_result(self, lines: t.Iterable[str]) -> ClamdScanResult:
         """Parse a scanning command response.
 
-        :param raw_resp: Raw clamd response string
+        :param lines: Lines of the clamd response
         :return: Structured scan result
         """
-        resp = self._parse_response(raw_resp)
-
-        # parse the main line (message)
-        m = scan_status_line_pattern.match(resp.message)
+        lines = iter(lines)
+        message = next(lines, "")
+        details = [al for al in lines if al]
+        raw_resp = self._raw_data(message, details) \
+            if self.keep_raw_data else None
+
+        # fast path for the common INSTREAM replies, no regex
+        if message == STREAM_OK:
+            return ClamdScanResult(
+                input_file="stream",
+                raw_data=raw_resp,
+                message=message,
+                status=ClamdScanStatus.OK,
+                details=details,
+            )
+        if message.startswith(STREAM_PREFIX) and \
+           message.endswith(FOUND_SUFFIX):
+            virus = message[len(STREAM_PREFIX):-len(FOUND_SUFFIX)].strip()
+            if virus:
+                return ClamdScanResult(
+                    input_file="stream",
+                    raw_data=raw_resp,
+                    message=message,
+                    status=ClamdScanStatus.FOUND,
+                    virus=virus,
+                    details=details,
+                )
+
+        m = scan_status_line_pattern.match(message)
         if not m:
-            # not able to parse correctly clamd response
+            # not able to parse correctly clamd response, always keep
+            # the raw response to debug it
             return ClamdScanResult(
                 input_file=None,
-                raw_data=raw_resp,
-                message=resp.message,
+                raw_data=self._raw_data(message, details),
+                message=message,
                 status=ClamdScanStatus.CLIENT_PARSE_ERROR,
                 virus=None,
                 err_msg="Unable to parse clamd response",
-                details=resp.details,
+                details=details,
             )
 
         input_file = m.group(1)
@@ -269,11 +445,11 @@ class Clamd(abc.ABC):
         return ClamdScanResult(
             input_file=input_file,
             raw_data=raw_resp,
-            message=resp.message,
+            message=message,
             status=status,
             virus=virus,
             err_msg=err_msg,
-            details=resp.details,
+            details=details,
         )
 
 
@@ -289,16 +465,22 @@ class ClamdUnixSocket(Clamd):
                  socket_path: str,
                  timeout: int = 300,  # seconds
                  cmd_terminator: bytes = b'\x00',
-                 buffer_size: int = 2048):
+                 buffer_size: int = 2048,
+                 max_reply_size: int = DEFAULT_MAX_REPLY_SIZE,
+                 keep_raw_data: bool = True):
         """Create clamd client instance for UNIX domain socket.
 
         :param socket_path: Path of the clamd daemon socket
         :param timeout: Timeout of the socket
         :param cmd_terminator: Terminator of clamd commands
         :param buffer_size: Size of the buffer to read/write to clamd
+        :param max_reply_size: Max size in bytes of a clamd reply
+        :param keep_raw_data: Keep raw replies in results
         """
         super().__init__(cmd_terminator=cmd_terminator,
-                         buffer_size=buffer_size)
+                         buffer_size=buffer_size,
+                         max_reply_size=max_reply_size,
+                         keep_raw_data=keep_raw_data)
         self.socket_path = socket_path
         self.timeout = timeout
 
@@ -328,7 +510,9 @@ class ClamdTCPSocket(Clamd):
                  port: int,
                  timeout: int = 300,  # seconds
                  cmd_terminator: bytes = b'\x00',
-                 buffer_size: int = 1024):
+                 buffer_size: int = 1024,
+                 max_reply_size: int = DEFAULT_MAX_REPLY_SIZE,
+                 keep_raw_data: bool = True):
         """Create clamd client instance for TCP socket.
 
         :param host: TCP host
@@ -336,9 +520,13 @@ class ClamdTCPSocket(Clamd):
         :param timeout: Timeout of the socket
         :param cmd_terminator: Terminator of clamd commands
         :param buffer_size: Size of the buffer to read/write to clamd
+        :param max_reply_size: Max size in bytes of a clamd reply
+        :param keep_raw_data: Keep raw replies in results
         """
         super().__init__(cmd_terminator=cmd_terminator,
-                         buffer_size=buffer_size)
+                         buffer_size=buffer_size,
+                         max_reply_size=max_reply_size,
+                         keep_raw_data=keep_raw_data)
         self.host = host
         self.port = port
         self.timeout = timeout
@@ -21,19 +21,20 @@ class ClamdScanStatus(Enum):
     CLIENT_PARSE_ERROR = "CLIENT_PARSE_ERROR"
 
 
-@dataclass
+@dataclass(slots=True)
 class ClamdCmdResponse():
     """Response of a clamd command.
     """
-    raw_data: str
+    # None unless the client keeps raw data
+    raw_data: str | None
     message: str
     details: list[str]
 
     def __str__(self):
-        return self.raw_data
+        return self.raw_data if self.raw_data is not None else self.message
 
 
-@dataclass
+@dataclass(slots=True)
 class ClamdScanResult(ClamdCmdResponse):
     """Result of a clamd scanning.
     """
@@ -0,0 +1,484 @@
+"""Bulk scanning command line tool.
+
+Scan many files with a pool of workers, either directly through clamd
+(Unix or TCP socket) or through a running ClamAV REST service.  Files
+are taken from the paths given as arguments (directories are walked
+recursively) or, with no arguments, from a list of paths read from
+stdin.  Results are written as NDJSON, one record per file.
+
+Paths are scanned while they are walked (or read), with a bounded
+number of files in flight, and each file is hashed while it is
+streamed, so memory stays bounded and files are read once.
+
+Scans can be resumed: with --resume, files already in the output file
+(same path and SHA256, with an OK or FOUND status) are skipped, and
+files with the same content under another path get a record with the
+verdict already known, without being scanned again.  Resumed runs hash
+files before scanning them, to look them up.
+
+Usage:
+.. code-block:: shell
+
+    # local clamd, 8 threads
+    clamav-bulk-scan --socket /var/run/clamav/clamd.sock -w 8 \\
+        -o results.ndjson /data
+
+    # REST service, file list from stdin, resume a previous run
+    find /data -name '*.pdf' | clamav-bulk-scan \\
+        --url http://localhost:8080 -o results.ndjson --resume
+
+Exit status is 0 if no virus was found, 1 if some virus was found and
+2 if some file could not be scanned.
+
+"""
+import argparse
+import dataclasses
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import typing as t
+from concurrent.futures import FIRST_COMPLETED, Executor, \
+    ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from .clamd import Clamd, ClamdTCPSocket, ClamdUnixSocket, \
+    ClamdScanResult, ClamdScanStatus
+from .client import ClamavRestClient
+
+READ_CHUNK_SIZE = 64 * 1024
+# idle REST connections kept by each worker process
+REST_POOL_SIZE = 64
+# statuses of records that don't need to be scanned again on resume
+DONE_STATUSES = (ClamdScanStatus.OK.value, ClamdScanStatus.FOUND.value)
+
+
+@dataclasses.dataclass
+class Backend():
+    """Where to send files for scanning.
+    """
+    socket_path: str | None = None
+    host: str | None = None
+    port: int | None = None
+    url: str | None = None
+    # send paths with SCAN instead of streaming content
+    clamd_scan: bool = False
+    timeout: int = 300
+
+    def clamd(self) -> Clamd:
+        if self.socket_path:
+            return ClamdUnixSocket(self.socket_path, timeout=self.timeout)
+        return ClamdTCPSocket(self.host, self.port, timeout=self.timeout)
+
+
+@dataclasses.dataclass
+class ResumeIndex():
+    """Files already scanned, from the output file of previous runs.
+    """
+    #: verdict fields of the records, by SHA256 of the files
+    verdicts: dict[str, dict] = dataclasses.field(default_factory=dict)
+    #: (path, SHA256) of the files recorded
+    recorded: set[tuple[str, str]] = dataclasses.field(default_factory=set)
+
+
+# REST clients of the process, by URL, shared by its threads
+_rest_clients: dict[str, ClamavRestClient] = {}
+_rest_clients_lock = threading.Lock()
+# files already scanned, set once per worker
+_index = ResumeIndex()
+
+
+def init_worker(index: ResumeIndex) -> None:
+    """Initialize a pool worker.
+
+    The (possibly huge) index of files already scanned is handed over
+    once per worker, not with every file.
+
+    :param index: Files already scanned
+    """
+    global _index
+    _index = index
+
+
+def scan_path(path: str, backend: Backend) -> tuple[int, dict | None]:
+    """Scan a single file.
+
+    This is the unit of work of pool workers: it must be picklable.
+
+    :param path: Path of the file
+    :param backend: Where to send the file
+    :return: Size of the file and result record, None if the file was
+      already recorded
+    """
+    digest = size = None
+    try:
+        if _index.verdicts:
+            digest, size = _hash_file(path)
+            verdict = _index.verdicts.get(digest)
+            if verdict is not None:
+                if (path, digest) in _index.recorded:
+                    return size, None
+                # same content as a file scanned under another path
+                return size, {"path": path, "sha256": digest,
+                              "size": size, **verdict}
+        result, digest, size = _scan_file(path, backend, digest, size)
+        fields = {
+            "status": result.status.value,
+            "virus": result.virus,
+            "error": result.err_msg,
+            "details": result.details,
+        }
+    except Exception as e:
+        fields = {
+            "status": ClamdScanStatus.ERROR.value,
+            "virus": None,
+            "error": str(e),
+            "details": [],
+        }
+    record = {"path": path}
+    if digest is not None:
+        record.update({"sha256": digest, "size": size})
+    record.update(fields)
+    return size or 0, record
+
+
+def _scan_file(path: str,
+               backend: Backend,
+               digest: str | None,
+               size: int | None) -> tuple[ClamdScanResult, str, int]:
+    """Scan a file, hashing it while it is streamed if not hashed yet.
+
+    :return: Result, SHA256 and size of the file
+    """
+    if backend.clamd_scan:
+        # clamd reads the file on its own
+        if digest is None:
+            digest, size = _hash_file(path)
+        with backend.clamd() as clamd:
+            return clamd.scan(os.path.abspath(path)), digest, size
+
+    with open(path, "rb") as f:
+        reader = HashingReader(f)
+        if backend.url:
+            result = _rest_client(backend).scan(reader, path)
+        else:
+            with backend.clamd() as clamd:
+                result = clamd.instream(reader)
+        if digest is None:
+            digest, size = reader.digest()
+    return result, digest, size
+
+
+class HashingReader(io.RawIOBase):
+    """Read a binary file, computing its SHA256 from the bytes read.
+
+    Seeks are allowed (e.g. to measure the file, or rewind it for a
+    retry): bytes are hashed once, in order, as they are first read.
+    """
+    def __init__(self, file: t.BinaryIO):
+        self._file = file
+        self._hash = hashlib.sha256()
+        # bytes hashed, from the start of the file
+        self._hashed = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self._file.seekable()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def readinto(self, b) -> int:
+        pos = self._file.tell()
+        n = self._file.readinto(b)
+        if n and pos <= self._hashed < pos + n:
+            with memoryview(b) as view:
+                self._hash.update(view[self._hashed - pos:n])
+            self._hashed = pos + n
+        return n
+
+    def digest(self) -> tuple[str, int]:
+        """Get the SHA256 and the size of the file, reading the bytes
+        not read yet.
+        """
+        pos = self._file.tell()
+        self._file.seek(self._hashed)
+        while self.read(READ_CHUNK_SIZE):
+            pass
+        self._file.seek(pos)
+        return self._hash.hexdigest(), self._hashed
+
+
+def _hash_file(path: str) -> tuple[str, int]:
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        buf = f.read(READ_CHUNK_SIZE)
+        while buf:
+            h.update(buf)
+            size += len(buf)
+            buf = f.read(READ_CHUNK_SIZE)
+    return h.hexdigest(), size
+
+
+def _rest_client(backend: Backend) -> ClamavRestClient:
+    """Get the REST client of the process, keeping connections alive
+    across files.
+    """
+    with _rest_clients_lock:
+        client = _rest_clients.get(backend.url)
+        if client is None:
+            client = ClamavRestClient(backend.url, timeout=backend.timeout,
+                                      pool_size=REST_POOL_SIZE)
+            _rest_clients[backend.url] = client
+        return client
+
+
+def iter_paths(paths: list[str],
+               stdin: t.TextIO) -> t.Iterator[str]:
+    """Iterate over the files to scan.
+
+    :param paths: Files or directories, if empty read paths from stdin
+    :param stdin: Input with a path on each line
+    """
+    if not paths:
+        for line in stdin:
+            line = line.rstrip("\n")
+            if line:
+                yield line
+        return
+
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+
+
+def load_index(output: str) -> ResumeIndex:
+    """Load the files already scanned from a results file.
+    """
+    index = ResumeIndex()
+    try:
+        with open(output, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line truncated by an interrupted run
+                    continue
+                if record.get("status") in DONE_STATUSES and \
+                   record.get("sha256"):
+                    index.verdicts[record["sha256"]] = {
+                        "status": record["status"],
+                        "virus": record.get("virus"),
+                        "error": None,
+                        "details": record.get("details") or [],
+                    }
+                    index.recorded.add((record["path"], record["sha256"]))
+    except FileNotFoundError:
+        pass
+    return index
+
+
+class Progress():
+    """Running throughput and ETA, printed on stderr.
+
+    Files are counted while they are walked: the ETA is known once the
+    walk is over.
+    """
+    def __init__(self, out: t.TextIO, interval: float = 1.0):
+        #: files to scan, None until the walk is over
+        self.total_files: int | None = None
+        self.out = out
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.found = 0
+        self.errors = 0
+        self._start = time.monotonic()
+        self._printed_at = 0.0
+
+    def update(self, size: int, record: dict | None) -> None:
+        self.files += 1
+        self.bytes += size
+        if record is None:
+            self.skipped += 1
+        elif record["status"] == ClamdScanStatus.FOUND.value:
+            self.found += 1
+        elif record["status"] != ClamdScanStatus.OK.value:
+            self.errors += 1
+
+        now = time.monotonic()
+        if now - self._printed_at >= self.interval:
+            self._printed_at = now
+            self.print()
+
+    def print(self, end: str = "\r") -> None:
+        elapsed = max(time.monotonic() - self._start, 1e-6)
+        files_rate = self.files / elapsed
+        bytes_rate = self.bytes / elapsed
+        if self.total_files is None:
+            total, eta = "?", "?"
+        else:
+            total = self.total_files
+            seconds = int((total - self.files) / files_rate) \
+                if files_rate > 0 else 0
+            eta = f"{seconds // 60}m{seconds % 60:02d}s"
+        self.out.write(
+            f"{self.files}/{total} files "
+            f"({self.skipped} skipped, {self.found} found, "
+            f"{self.errors} errors) "
+            f"{files_rate:.1f} files/s {bytes_rate / 1024 / 1024:.1f} MB/s "
+            f"ETA {eta}{end}")
+        self.out.flush()
+
+
+def run(paths: t.Iterable[str],
+        backend: Backend,
+        executor: Executor,
+        workers: int,
+        output: t.TextIO,
+        progress_out: t.TextIO | None = None) -> Progress:
+    """Scan files with a pool of workers, writing NDJSON records.
+
+    Workers of the executor must be initialized with init_worker().
+
+    :param paths: Files to scan, consumed while files are scanned
+    :return: Final progress, with counts of found and errors
+    """
+    progress = Progress(progress_out or sys.stderr)
+
+    # bound the queued files, millions of futures would eat memory
+    max_in_flight = workers * 4
+    in_flight = set()
+    queue = iter(paths)
+    walked = 0
+
+    def submit_next() -> bool:
+        nonlocal walked
+        if progress.total_files is not None:
+            return False
+        path = next(queue, None)
+        if path is None:
+            progress.total_files = walked
+            return False
+        walked += 1
+        in_flight.add(executor.submit(scan_path, path, backend))
+        return True
+
+    while len(in_flight) < max_in_flight and submit_next():
+        pass
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            in_flight.remove(future)
+            size, record = future.result()
+            if record is not None:
+                output.write(json.dumps(record) + "\n")
+            progress.update(size, record)
+            submit_next()
+    output.flush()
+    progress.print(end="\n")
+    return progress
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="clamav-bulk-scan",
+        description="Scan files in bulk with clamd or the ClamAV REST "
+        "service, writing NDJSON results.")
+    parser.add_argument(
+        "paths", nargs="*",
+        help="files or directories to scan; "
+        "if none, read a list of paths from stdin")
+
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--socket", help="clamd Unix socket path")
+    target.add_argument("--host", help="clamd TCP host (use with --port)")
+    target.add_argument("--url",
+                        help="base URL of the ClamAV REST service")
+    parser.add_argument("--port", type=int, default=3310,
+                        help="clamd TCP port (default 3310)")
+    parser.add_argument(
+        "--clamd-scan", action="store_true",
+        help="send file paths with the SCAN command instead of streaming "
+        "content: clamd must be able to read the files")
+    parser.add_argument("--timeout", type=int, default=300,
+                        help="socket timeout in seconds (default 300)")
+
+    parser.add_argument("-w", "--workers", type=int,
+                        default=os.cpu_count() or 4,
+                        help="number of workers (default: CPU count)")
+    parser.add_argument("--processes", action="store_true",
+                        help="use a process pool instead of threads")
+
+    parser.add_argument("-o", "--output",
+                        help="NDJSON results file, appended to "
+                        "(default stdout)")
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="skip files already in the output file, and report files "
+        "with the same content as one already scanned without scanning "
+        "them again")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="don't print progress")
+
+    args = parser.parse_args(argv)
+    if args.resume and not args.output:
+        parser.error("--resume requires --output")
+    if args.clamd_scan and args.url:
+        parser.error("--clamd-scan can't be used with --url")
+    return args
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    backend = Backend(
+        socket_path=args.socket,
+        host=args.host,
+        port=args.port,
+        url=args.url,
+        clamd_scan=args.clamd_scan,
+        timeout=args.timeout,
+    )
+    index = load_index(args.output) if args.resume else ResumeIndex()
+    paths = iter_paths(args.paths, sys.stdin)
+
+    executor_class = ProcessPoolExecutor if args.processes \
+        else ThreadPoolExecutor
+    output = open(args.output, "a", encoding="utf-8") \
+        if args.output else sys.stdout
+    progress_out = open(os.devnull, "w") if args.quiet else sys.stderr
+    try:
+        with executor_class(max_workers=args.workers,
+                            initializer=init_worker,
+                            initargs=(index,)) as executor:
+            progress = run(paths, backend, executor, args.workers, output,
+                           progress_out=progress_out)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if progress_out is not sys.stderr:
+            progress_out.close()
+
+    if progress.errors:
+        return 2
+    if progress.found:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""Client for the ClamAV REST service.
+
+Files are streamed as request body over pooled keep-alive connections
+and results are returned as ClamdScanResult, as clamd would.  Requests
+rejected with 429 or 503 are retried after the Retry-After delay.
+
+Usage:
+.. code-block:: python
+
+    with ClamavRestClient("http://localhost:8080") as client:
+        result = client.scan("/my/file.txt")
+
+        for path, result in client.scan_many(paths, workers=8):
+            print(path, result.status, result.virus)
+
+Only uses the standard library and the clamd types of this package:
+importing it doesn't need flask, nor the configuration of the service.
+
+"""
+import collections
+import email.utils
+import http.client
+import io
+import json
+import os
+import queue
+import time
+import typing as t
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from .clamd import ClamdScanResult, ClamdScanStatus
+
+SCAN_PATH = "/api/v1/clamav/scan"
+UPLOAD_BLOCK_SIZE = 64 * 1024
+RETRY_STATUSES = (429, 503)
+
+FileLike = t.Union[str, os.PathLike, bytes, t.IO[bytes]]
+
+
+class ClamavRestError(Exception):
+    """Raised when the REST service does not return a scan result.
+    """
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+class ConnectionPool():
+    """Pool of keep-alive connections to a host.
+
+    Connections are created on demand, up to `size` idle ones are kept
+    for reuse.
+    """
+    def __init__(self, url: str, size: int, timeout: float):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL scheme '{parts.scheme}'")
+        self._conn_class = http.client.HTTPSConnection \
+            if parts.scheme == "https" else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.timeout = timeout
+        self._idle: queue.LifoQueue[http.client.HTTPConnection] = \
+            queue.LifoQueue(maxsize=size)
+
+    def get(self) -> tuple[http.client.HTTPConnection, bool]:
+        """Get a connection.
+
+        :return: Connection and whether it was reused
+        """
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            conn = self._conn_class(self.netloc, timeout=self.timeout,
+                                    blocksize=UPLOAD_BLOCK_SIZE)
+            return conn, False
+
+    def put(self, conn: http.client.HTTPConnection) -> None:
+        """Give back a connection whose response was fully read.
+        """
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ClamavRestClient():
+    """Client for the scan API of the ClamAV REST service.
+    """
+    def __init__(self,
+                 base_url: str,
+                 timeout: float = 300,
+                 pool_size: int = 8,
+                 max_retries: int = 3,
+                 max_retry_wait: float = 60,
+                 headers: dict[str, str] | None = None):
+        """Create a client.
+
+        :param base_url: Base URL of the service, e.g. http://host:8080
+        :param timeout: Socket timeout in seconds
+        :param pool_size: Max idle connections kept for reuse
+        :param max_retries: Max retries of requests rejected with 429
+          or 503 (only if the file can be rewound)
+        :param max_retry_wait: Max seconds to wait before a retry
+        :param headers: Headers sent with each request, e.g. API keys
+        """
+        self.base_path = urllib.parse.urlsplit(base_url).path.rstrip("/")
+        self.pool = ConnectionPool(base_url, pool_size, timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.max_retry_wait = max_retry_wait
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+        return False
+
+    def close(self) -> None:
+        """Close idle connections.
+        """
+        self.pool.close()
+
+    def scan(self, file: FileLike, name: str | None = None) -> ClamdScanResult:
+        """Scan a file.
+
+        :param file: Path, content or binary file handle, streamed from
+          its current position
+        :param name: Name of the file in the result, default the path
+          or the name of the file handle
+        :return: Scan result
+        :raises ClamavRestError: if the service did not return a result
+        """
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, "rb") as f:
+                return self.scan(f, name or os.fspath(file))
+        if isinstance(file, bytes):
+            file = io.BytesIO(file)
+        if name is None:
+            name = getattr(file, "name", None)
+            name = name if isinstance(name, str) else "stream"
+
+        start = file.tell() if file.seekable() else None
+        attempt = 0
+        while True:
+            status, headers, body = self._post(file, start)
+            if status not in RETRY_STATUSES or start is None or \
+               attempt >= self.max_retries:
+                break
+            attempt += 1
+            time.sleep(self._retry_wait(headers.get("Retry-After"), attempt))
+            file.seek(start)
+        return self._parse_result(name, status, body)
+
+    def scan_many(self,
+                  files: t.Iterable[FileLike],
+                  workers: int = 4) -> t.Iterator[
+                      tuple[FileLike, ClamdScanResult | Exception]]:
+        """Scan files concurrently.
+
+        At most `workers` files are scanned at the same time (at most
+        twice as many are queued), results are yielded in input order.
+
+        :param files: Paths, contents or binary file handles
+        :param workers: Max concurrent scans
+        :return: Iterator of (file, result), where result is the
+          exception raised if the file could not be scanned
+        """
+        workers = max(1, min(workers, self.pool_size))
+        pending: collections.deque = collections.deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for file in files:
+                pending.append((file, executor.submit(self.scan, file)))
+                if len(pending) >= workers * 2:
+                    yield self._result_of(*pending.popleft())
+            while pending:
+                yield self._result_of(*pending.popleft())
+
+    @staticmethod
+    def _result_of(file, future):
+        try:
+            return file, future.result()
+        except Exception as e:
+            return file, e
+
+    def _post(self, file: t.IO[bytes],
+              start: int | None) -> tuple[int, http.client.HTTPMessage, bytes]:
+        """Send a file, retrying on stale keep-alive connections.
+        """
+        headers = {**self.headers,
+                   "Content-Type": "application/octet-stream"}
+        if start is not None:
+            size = file.seek(0, io.SEEK_END) - start
+            file.seek(start)
+            headers["Content-Length"] = str(size)
+
+        while True:
+            conn, reused = self.pool.get()
+            try:
+                conn.request("POST", self.base_path + SCAN_PATH, body=file,
+                             headers=headers,
+                             encode_chunked=start is None)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if reused and start is not None:
+                    # the server may have closed an idle connection
+                    file.seek(start)
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self.pool.put(conn)
+            return resp.status, resp.headers, body
+
+    def _retry_wait(self, retry_after: str | None, attempt: int) -> float:
+        """Get seconds to wait before a retry.
+        """
+        wait = None
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                try:
+                    date = email.utils.parsedate_to_datetime(retry_after)
+                    wait = date.timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+        if wait is None:
+            # exponential backoff
+            wait = 2 ** (attempt - 1)
+        return min(max(wait, 0.0), self.max_retry_wait)
+
+    def _parse_result(self, name: str, status: int,
+                      body: bytes) -> ClamdScanResult:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise ClamavRestError(f"HTTP {status}: unexpected response",
+                                  status=status)
+        if not isinstance(data, dict) or "status" not in data:
+            # not a scan result (e.g. rate limited, too large)
+            error = data.get("error") if isinstance(data, dict) else None
+            raise ClamavRestError(f"HTTP {status}: {error}", status=status)
+
+        try:
+            scan_status = ClamdScanStatus(data["status"])
+        except ValueError:
+            raise ClamavRestError(f"HTTP {status}: unknown scan status",
+                                  status=status)
+        virus = data.get("virus")
+        err_msg = data.get("error")
+        match scan_status:
+            case ClamdScanStatus.OK:
+                message = "stream: OK"
+            case ClamdScanStatus.FOUND:
+                message = f"stream: {virus} FOUND"
+            case _:
+                message = f"stream: {err_msg} ERROR"
+        return ClamdScanResult(
+            input_file=name,
+            raw_data=data.get("raw_data") or "",
+            message=message,
+            status=scan_status,
+            virus=virus,
+            err_msg=err_msg,
+            details=data.get("details") or [],
+        )
@@ -0,0 +1,201 @@
+"""Monitor of the clamd signature database.
+
+A background thread polls the VERSION of clamd.  When the signature
+database changes (e.g. reloaded after a freshclam update) or is seen
+for the first time, a warm-up corpus is scanned through INSTREAM, so
+that the first scans of clients don't pay for cold caches; only then
+the new database is marked ready.  A failed poll marks it not ready,
+until clamd answers again and is warmed up.
+
+The latest snapshot is kept in memory, so scan results can be stamped
+with the database that produced them at no cost.
+
+"""
+import dataclasses
+import datetime
+import gzip
+import io
+import logging
+import os
+import threading
+import typing as t
+import zipfile
+
+from .clamd import Clamd
+
+
+@dataclasses.dataclass(frozen=True)
+class DatabaseSnapshot():
+    """Signature database of clamd, as reported by VERSION.
+    """
+    engine: str
+    version: int | None
+    build_date: str | None
+    # warm-up done
+    ready: bool = False
+
+    @classmethod
+    def parse(cls, message: str) -> "DatabaseSnapshot":
+        """Parse a VERSION reply, e.g.
+        "ClamAV 1.4.2/27450/Mon Oct 14 08:35:41 2024".
+        """
+        engine, _, rest = message.partition("/")
+        db_version, _, build_date = rest.partition("/")
+        try:
+            build_date = datetime.datetime.strptime(
+                build_date, "%a %b %d %H:%M:%S %Y").isoformat()
+        except ValueError:
+            # keep it as is
+            pass
+        return cls(
+            engine=engine.strip(),
+            version=int(db_version) if db_version.isdigit() else None,
+            build_date=build_date or None,
+        )
+
+    def same_database(self, other: "DatabaseSnapshot | None") -> bool:
+        return other is not None and \
+            (self.version, self.build_date) == \
+            (other.version, other.build_date)
+
+
+def builtin_corpus() -> list[tuple[str, bytes]]:
+    """Small samples of common file types, to warm up clamd parsers.
+    """
+    text = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n" * 64
+    html = b"<!DOCTYPE html><html><head><script>var x = 1;</script>" \
+        b"</head><body>" + text + b"</body></html>"
+    pdf = b"%PDF-1.4\n1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n" \
+        b"2 0 obj\n<< /Type /Pages /Kids [] /Count 0 >>\nendobj\n" \
+        b"trailer\n<< /Root 1 0 R >>\n%%EOF\n"
+    zip_buf = io.BytesIO()
+    with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("lorem.txt", text)
+        zf.writestr("index.html", html)
+        # OOXML documents are zip archives as well
+        zf.writestr("[Content_Types].xml",
+                    b'<?xml version="1.0"?><Types xmlns="http://schemas.'
+                    b'openxmlformats.org/package/2006/content-types"/>')
+    return [
+        ("lorem.txt", text),
+        ("index.html", html),
+        ("empty.pdf", pdf),
+        ("lorem.zip", zip_buf.getvalue()),
+        ("lorem.txt.gz", gzip.compress(text, mtime=0)),
+    ]
+
+
+def load_corpus(corpus_dir: str) -> list[tuple[str, bytes]]:
+    """Load a warm-up corpus from the files of a directory.
+    """
+    corpus = []
+    for name in sorted(os.listdir(corpus_dir)):
+        path = os.path.join(corpus_dir, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                corpus.append((name, f.read()))
+    return corpus
+
+
+class DatabaseMonitor():
+    """Poll clamd for database changes in a background thread.
+    """
+    def __init__(self,
+                 clamd_factory: t.Callable[[], Clamd],
+                 interval: float,
+                 corpus: list[tuple[str, bytes]],
+                 on_change: t.Callable[[DatabaseSnapshot], None] | None
+                 = None):
+        """Create a monitor.
+
+        :param clamd_factory: Callable returning a new clamd client
+        :param interval: Seconds between polls
+        :param corpus: Warm-up samples, as (name, content)
+        :param on_change: Called with each new snapshot published
+        """
+        self.clamd_factory = clamd_factory
+        self.interval = interval
+        self.corpus = corpus
+        self.on_change = on_change
+        #: latest snapshot, None until the first successful poll
+        self.snapshot: DatabaseSnapshot | None = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """Start polling, if not already running in this process.
+
+        Threads don't survive fork, so this is safe to call in each
+        request of forked workers.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            threading.Thread(target=self._run, name="clamd-db-monitor",
+                             daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._pid = None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                logging.warning("Unable to poll clamd version: %s", str(e))
+                self.unreachable()
+            if self._stop.wait(self.interval):
+                return
+
+    def poll(self) -> DatabaseSnapshot:
+        """Check the database version, warming up on changes.
+
+        :return: Latest snapshot
+        """
+        with self.clamd_factory() as clamd:
+            snapshot = DatabaseSnapshot.parse(clamd.version().message)
+        if snapshot.same_database(self.snapshot) and self.snapshot.ready:
+            return self.snapshot
+
+        # new database, or clamd back after a failed poll (maybe
+        # restarted, with cold caches)
+        logging.info("clamd database is %s (%s), warming up",
+                     snapshot.version, snapshot.build_date)
+        # published as not ready, new verdicts come from this database
+        self._publish(snapshot)
+        self.warm_up()
+        self._publish(dataclasses.replace(snapshot, ready=True))
+        return self.snapshot
+
+    def unreachable(self) -> None:
+        """Mark the latest snapshot not ready, clamd being unreachable.
+
+        Its database is kept, for stamping results.
+        """
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.ready:
+            self._publish(dataclasses.replace(snapshot, ready=False))
+
+    def _publish(self, snapshot: DatabaseSnapshot) -> None:
+        self.snapshot = snapshot
+        if self.on_change is not None:
+            self.on_change(snapshot)
+
+    def warm_up(self) -> None:
+        """Scan the warm-up corpus.
+        """
+        for name, content in self.corpus:
+            try:
+                with self.clamd_factory() as clamd:
+                    result = clamd.instream(io.BytesIO(content))
+                logging.debug("Warm-up sample %s: %s", name,
+                              result.status.value)
+            except Exception as e:
+                logging.warning("Unable to scan warm-up sample %s: %s",
+                                name, str(e))
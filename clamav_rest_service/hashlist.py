@@ -0,0 +1,231 @@
+"""Preloaded hash lists for scanning without clamd.
+
+Much of the traffic is made of the same, well known files.  Hash lists
+let us answer for them without sending the whole file to clamd:
+
+ - trusted (allow) lists: a match means the file is clean
+ - known-bad (block) lists: a match means the file is infected
+
+Accepted formats, one entry per line (empty lines and lines starting
+with '#' are skipped):
+
+ - ClamAV hash signatures (.hdb, .hsb): `<hash>:<size>:<name>`, the
+   same format written by clamd-entrypoint.sh.  The size field is not
+   checked
+ - plain lists: `<hash>`, optionally followed by whitespace and a
+   file name, as in the output of sha256sum(1)
+
+The algorithm (MD5, SHA1 or SHA256) is inferred from the hash length.
+Trusted lists only accept SHA256: a collision with a weaker hash would
+let a malicious file skip the scan altogether.
+
+Digests are held in a sorted, fixed-width byte array and looked up by
+binary search.  Files are checked for changes at most every
+`reload_interval` seconds and reloaded transparently.
+
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import typing as t
+
+# algorithm by length of the hex digest
+ALGORITHMS_BY_HEX_LENGTH = {
+    32: "md5",
+    40: "sha1",
+    64: "sha256",
+}
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class HashListException(Exception):
+    """Raised when a hash list cannot be loaded.
+    """
+
+
+class DigestTable():
+    """Sorted array of fixed-width digests with their signature names.
+    """
+    def __init__(self, digest_size: int, entries: dict[bytes, str | None]):
+        self.digest_size = digest_size
+        digests = sorted(entries)
+        self._digests = b"".join(digests)
+        self._names = tuple(entries[d] for d in digests)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def get(self, digest: bytes) -> tuple[bool, str | None]:
+        """Look up a digest.
+
+        :param digest: Binary digest
+        :return: (found, signature name if any)
+        """
+        size = self.digest_size
+        lo, hi = 0, len(self._names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self._digests[mid * size:(mid + 1) * size]
+            if cur < digest:
+                lo = mid + 1
+            elif cur > digest:
+                hi = mid
+            else:
+                return True, self._names[mid]
+        return False, None
+
+
+class HashList():
+    """A hash list file, reloaded when it changes on disk.
+    """
+    def __init__(self,
+                 path: str,
+                 trusted: bool,
+                 reload_interval: float = 5.0):
+        """Load a hash list.
+
+        :param path: Path of the hash list file
+        :param trusted: True for allow lists, False for known-bad lists
+        :param reload_interval: Seconds between checks for file changes
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self.trusted = trusted
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._tables: dict[str, DigestTable] = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self.reload()
+
+    @property
+    def algorithms(self) -> set[str]:
+        """Hash algorithms needed to look up this list.
+        """
+        self._maybe_reload()
+        return set(self._tables)
+
+    def lookup(self, digests: dict[str, bytes]) -> tuple[bool, str | None]:
+        """Look up a file by its digests.
+
+        :param digests: Binary digests of the file by algorithm
+        :return: (found, signature name if any)
+        """
+        self._maybe_reload()
+        for algorithm, table in self._tables.items():
+            digest = digests.get(algorithm)
+            if digest is None:
+                continue
+            found, name = table.get(digest)
+            if found:
+                return True, name
+        return False, None
+
+    def reload(self) -> None:
+        """(Re)load the list from file.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries, skipped = self._parse(f)
+        except OSError as e:
+            raise HashListException(
+                f"Unable to load hash list {self.path}: {e}") from e
+
+        # swap the whole dict, lookups in progress keep the old one
+        self._tables = {
+            algorithm: DigestTable(hashlib.new(algorithm).digest_size,
+                                   algorithm_entries)
+            for algorithm, algorithm_entries in entries.items()
+        }
+        self._mtime = mtime
+        logging.info("Loaded hash list %s: %d entries, %d lines skipped",
+                     self.path, sum(len(tb) for tb in self._tables.values()),
+                     skipped)
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        # only one thread checks, the others go on with the loaded list
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                logging.warning("Unable to check hash list %s, keeping "
+                                "loaded entries: %s", self.path, str(e))
+                return
+            if mtime != self._mtime:
+                try:
+                    self.reload()
+                except HashListException as e:
+                    logging.warning("%s, keeping loaded entries", str(e))
+        finally:
+            self._lock.release()
+
+    def _parse(
+        self, lines: t.Iterable[str]
+    ) -> tuple[dict[str, dict[bytes, str | None]], int]:
+        """Parse hash list lines.
+
+        :return: entries by algorithm and number of skipped lines
+        """
+        entries: dict[str, dict[bytes, str | None]] = {}
+        skipped = 0
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            if ":" in line:
+                # <hash>:<size>:<name>[:<flevel>...]
+                fields = line.split(":")
+                hex_digest = fields[0]
+                name = fields[2] if len(fields) > 2 else None
+            else:
+                # <hash> [<file name>]
+                hex_digest = line.split()[0]
+                name = None
+
+            algorithm = ALGORITHMS_BY_HEX_LENGTH.get(len(hex_digest))
+            if algorithm is None or (self.trusted and algorithm != "sha256"):
+                skipped += 1
+                continue
+            try:
+                digest = bytes.fromhex(hex_digest)
+            except ValueError:
+                skipped += 1
+                continue
+            entries.setdefault(algorithm, {})[digest] = name
+
+        return entries, skipped
+
+
+def digest_stream(stream: t.IO[bytes],
+                  algorithms: t.Iterable[str]) -> dict[str, bytes]:
+    """Compute the digests of a stream in a single pass.
+
+    The stream is read from its current position to the end; the
+    position is restored before returning.
+
+    :param stream: Seekable input stream
+    :param algorithms: Names of the hashlib algorithms to compute
+    :return: Binary digests by algorithm
+    """
+    hashers = {a: hashlib.new(a) for a in algorithms}
+    pos = stream.tell()
+    try:
+        buf = stream.read(READ_CHUNK_SIZE)
+        while buf:
+            for h in hashers.values():
+                h.update(buf)
+            buf = stream.read(READ_CHUNK_SIZE)
+    finally:
+        stream.seek(pos)
+    return {a: h.digest() for a, h in hashers.items()}
@@ -0,0 +1,354 @@
+"""Incremental parsing of JSON documents carrying base64 files.
+
+Some clients can only send JSON, embedding files as base64 strings.
+Parsing such documents as a whole would hold every file in memory
+twice (encoded and decoded), so here we parse the document while it
+is read and decode the base64 content on the fly: each file is exposed
+as a stream that can be sent to clamd as is.
+
+Expected document:
+.. code-block:: json
+
+    {
+        "files": [
+            {"name": "file.txt", "content": "<base64>"},
+            ...
+        ]
+    }
+
+Unknown keys are skipped.  Values other than file contents are bounded
+in size and nesting.
+
+"""
+import binascii
+import io
+import re
+import typing as t
+
+READ_CHUNK_SIZE = 64 * 1024
+# max size of values other than file contents (e.g. names)
+MAX_VALUE_SIZE = 64 * 1024
+MAX_DEPTH = 32
+
+WHITESPACE = b" \t\r\n"
+STRING_SPECIAL_PATTERN = re.compile(rb'["\\]')
+SIMPLE_ESCAPES = {
+    ord('"'): b'"',
+    ord('\\'): b'\\',
+    ord('/'): b'/',
+    ord('b'): b'\b',
+    ord('f'): b'\f',
+    ord('n'): b'\n',
+    ord('r'): b'\r',
+    ord('t'): b'\t',
+}
+LITERAL_CHARS = frozenset(b"0123456789+-.eEtruefalsn")
+HEX_DIGITS = b"0123456789abcdefABCDEF"
+
+
+class JsonStreamError(ValueError):
+    """Raised when the JSON document is malformed or unexpected.
+    """
+
+
+class JsonFile():
+    """A file embedded in the JSON document.
+
+    `stream` yields the decoded content while the document is parsed.
+    Other fields (e.g. `name`) are only guaranteed to be set once the
+    iteration moves to the next file.
+    """
+    def __init__(self, index: int):
+        self.index = index
+        self.name: str | None = None
+        self.stream: t.IO[bytes] | None = None
+
+
+class _Reader():
+    """Buffered byte reader over the input stream.
+    """
+    def __init__(self, stream: t.IO[bytes]):
+        self._stream = stream
+        self._buf = b""
+        self._pos = 0
+
+    def _fill(self) -> bool:
+        data = self._stream.read(READ_CHUNK_SIZE)
+        if not data:
+            return False
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def peek(self) -> int | None:
+        """Peek next non whitespace byte, None at EOF.
+        """
+        while True:
+            while self._pos < len(self._buf):
+                c = self._buf[self._pos]
+                if c not in WHITESPACE:
+                    return c
+                self._pos += 1
+            if not self._fill():
+                return None
+
+    def next(self) -> int:
+        """Consume next non whitespace byte.
+        """
+        c = self.peek()
+        if c is None:
+            raise JsonStreamError("Unexpected end of JSON document")
+        self._pos += 1
+        return c
+
+    def expect(self, char: bytes) -> None:
+        c = self.next()
+        if c != char[0]:
+            raise JsonStreamError(
+                f"Expected '{char.decode()}', found '{chr(c)}'")
+
+    def _take(self, size: int) -> bytes:
+        """Consume exactly `size` raw bytes.
+        """
+        while len(self._buf) - self._pos < size:
+            if not self._fill():
+                raise JsonStreamError("Unexpected end of JSON document")
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += size
+        return data
+
+    def string_segments(self) -> t.Iterator[bytes]:
+        """Iterate over the UTF-8 segments of a string value.
+
+        The opening quote must be already consumed; the closing one is
+        consumed when the iteration ends.
+        """
+        while True:
+            m = STRING_SPECIAL_PATTERN.search(self._buf, self._pos)
+            if m is None:
+                segment = self._buf[self._pos:]
+                self._pos = len(self._buf)
+                if segment:
+                    yield segment
+                if not self._fill():
+                    raise JsonStreamError("Unterminated string")
+                continue
+
+            i = m.start()
+            if i > self._pos:
+                yield self._buf[self._pos:i]
+            self._pos = i + 1
+            if m.group() == b'"':
+                return
+            yield self._escape()
+
+    def _escape(self) -> bytes:
+        c = self._take(1)[0]
+        if c in SIMPLE_ESCAPES:
+            return SIMPLE_ESCAPES[c]
+        if c != ord('u'):
+            raise JsonStreamError(f"Invalid escape '\\{chr(c)}'")
+        cp = self._hex4()
+        if 0xDC00 <= cp < 0xE000:
+            raise JsonStreamError("Lone low surrogate in unicode escape")
+        if 0xD800 <= cp < 0xDC00:
+            # surrogate pair
+            if self._take(2) != b"\\u":
+                raise JsonStreamError("Invalid surrogate pair")
+            low = self._hex4()
+            if not 0xDC00 <= low < 0xE000:
+                raise JsonStreamError("Invalid surrogate pair")
+            cp = 0x10000 + ((cp - 0xD800) << 10) + (low - 0xDC00)
+        return chr(cp).encode()
+
+    def _hex4(self) -> int:
+        digits = self._take(4)
+        # int() would also accept signs, spaces and underscores
+        if digits.strip(HEX_DIGITS):
+            raise JsonStreamError("Invalid unicode escape")
+        return int(digits, 16)
+
+    def read_string(self) -> str:
+        """Read a whole (small) string value.
+        """
+        self.expect(b'"')
+        parts = []
+        size = 0
+        for segment in self.string_segments():
+            size += len(segment)
+            if size > MAX_VALUE_SIZE:
+                raise JsonStreamError("String value too large")
+            parts.append(segment)
+        try:
+            return b"".join(parts).decode()
+        except UnicodeDecodeError:
+            raise JsonStreamError("Invalid UTF-8 in string")
+
+    def skip_value(self, depth: int = 0) -> None:
+        """Skip any JSON value.
+        """
+        if depth > MAX_DEPTH:
+            raise JsonStreamError("JSON document nested too deeply")
+
+        c = self.peek()
+        if c == ord('"'):
+            self._pos += 1
+            for _ in self.string_segments():
+                pass
+        elif c == ord('{'):
+            self._pos += 1
+            for _ in self.iter_object_keys():
+                self.skip_value(depth + 1)
+        elif c == ord('['):
+            self._pos += 1
+            for _ in self.iter_array():
+                self.skip_value(depth + 1)
+        else:
+            self._skip_literal()
+
+    def _skip_literal(self) -> None:
+        start = self._pos
+        while True:
+            c = self.peek_raw()
+            if c is None or c not in LITERAL_CHARS:
+                break
+            self._pos += 1
+            if self._pos - start > MAX_VALUE_SIZE:
+                raise JsonStreamError("Literal value too large")
+        if self._pos == start:
+            raise JsonStreamError("Expected JSON value")
+
+    def peek_raw(self) -> int | None:
+        """Peek next byte, whitespace included.
+        """
+        if self._pos >= len(self._buf) and not self._fill():
+            return None
+        return self._buf[self._pos]
+
+    def iter_object_keys(self) -> t.Iterator[str]:
+        """Iterate over the keys of an object.
+
+        The opening brace must be already consumed.  The caller must
+        consume the value of each key before moving to the next one.
+        """
+        if self.peek() == ord('}'):
+            self._pos += 1
+            return
+        while True:
+            key = self.read_string()
+            self.expect(b':')
+            yield key
+            c = self.next()
+            if c == ord('}'):
+                return
+            if c != ord(','):
+                raise JsonStreamError("Expected ',' or '}' in object")
+
+    def iter_array(self) -> t.Iterator[None]:
+        """Iterate over the items of an array.
+
+        The opening bracket must be already consumed.  The caller must
+        consume each item before moving to the next one.
+        """
+        if self.peek() == ord(']'):
+            self._pos += 1
+            return
+        while True:
+            yield None
+            c = self.next()
+            if c == ord(']'):
+                return
+            if c != ord(','):
+                raise JsonStreamError("Expected ',' or ']' in array")
+
+
+class Base64DecodingStream(io.RawIOBase):
+    """Read-only stream decoding base64 text segments on the fly.
+    """
+    def __init__(self, segments: t.Iterator[bytes]):
+        self._segments = segments
+        self._pending = b""
+        self._decoded = b""
+        # position of the next byte to read in self._decoded
+        self._offset = 0
+        self._exhausted = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self._offset == len(self._decoded) and not self._exhausted:
+            self._decode_next()
+        size = min(len(b), len(self._decoded) - self._offset)
+        with memoryview(self._decoded) as view:
+            b[:size] = view[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def drain(self) -> None:
+        """Consume the rest of the encoded content.
+        """
+        for _ in self._segments:
+            pass
+        self._exhausted = True
+
+    def _decode_next(self) -> None:
+        segment = next(self._segments, None)
+        if segment is None:
+            self._exhausted = True
+            if self._pending:
+                raise JsonStreamError("Truncated base64 content")
+            return
+
+        data = self._pending + segment.translate(None, WHITESPACE)
+        # decode only whole 4-chars blocks, keep the rest for later
+        whole = len(data) - len(data) % 4
+        self._pending = data[whole:]
+        try:
+            self._decoded = binascii.a2b_base64(data[:whole],
+                                                strict_mode=True)
+            self._offset = 0
+        except binascii.Error as e:
+            raise JsonStreamError(f"Invalid base64 content: {e}")
+
+
+def iter_json_files(stream: t.IO[bytes]) -> t.Iterator[JsonFile]:
+    """Iterate over the files embedded in a JSON document.
+
+    Each file is yielded as soon as its content starts; its stream
+    must be consumed before moving to the next file (whatever is left
+    is skipped).
+
+    :param stream: Input stream of the JSON document
+    :return: Iterator of files
+    :raises JsonStreamError: if the document is malformed
+    """
+    reader = _Reader(stream)
+    reader.expect(b'{')
+    index = 0
+    for key in reader.iter_object_keys():
+        if key != "files":
+            reader.skip_value()
+            continue
+
+        reader.expect(b'[')
+        for _ in reader.iter_array():
+            json_file = JsonFile(index)
+            index += 1
+            reader.expect(b'{')
+            for file_key in reader.iter_object_keys():
+                if file_key == "name":
+                    json_file.name = reader.read_string()
+                elif file_key == "content" and json_file.stream is None:
+                    reader.expect(b'"')
+                    content = Base64DecodingStream(reader.string_segments())
+                    json_file.stream = io.BufferedReader(content)
+                    yield json_file
+                    content.drain()
+                else:
+                    reader.skip_value()
+            if json_file.stream is None:
+                raise JsonStreamError(f"File {json_file.index} has no content")
+
+    if reader.peek() is not None:
+        raise JsonStreamError("Unexpected data after JSON document")
@@ -0,0 +1,452 @@
+"""Pipeline of the stages of a file scan.
+
+A scan runs a list of stages over a ScanContext, in order, until one
+of them sets the result (e.g. a hash list match, or clamd verdict);
+then the `after` hooks of the stages that ran are called, in order,
+and may amend the result (e.g. policies).
+
+The context wraps the uploaded stream: `ctx.stream` is what stages
+send to clamd, and while it is read the size and the digests of the
+file are computed and its type is sniffed from the first bytes, so
+that everything happens in the same single pass as the upload.
+Stages that need the type before the upload (e.g. to skip known-safe
+types) call `ctx.head()`, which reads the first bytes once and keeps
+them for the upload.
+
+Time spent in each stage is recorded in the context and totalled by
+the pipeline.
+
+"""
+import contextlib
+import hashlib
+import io
+import threading
+import time
+import typing as t
+
+from .clamd import Clamd, ClamdScanResult, ClamdScanStatus
+from .hashlist import HashList, digest_stream
+
+# bytes read to sniff the type of a file (tar magic is at 257)
+SNIFF_SIZE = 512
+# digests computed while uploading
+DEFAULT_ALGORITHMS = ("sha256",)
+
+# (offset, magic bytes, type), first match wins
+MAGIC_TYPES = [
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"PK\x05\x06", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"BZh", "application/x-bzip2"),
+    (0, b"\xfd7zXZ\x00", "application/x-xz"),
+    (0, b"(\xb5/\xfd", "application/zstd"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (0, b"Rar!\x1a\x07", "application/vnd.rar"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage"),
+    (0, b"{\\rtf", "application/rtf"),
+    (0, b"MZ", "application/x-msdownload"),
+    (0, b"\x7fELF", "application/x-executable"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (257, b"ustar", "application/x-tar"),
+]
+# types that can be skipped: inert images only, not the formats
+# carrying executable content (executables, archives, documents with
+# macros or scripts) nor the text/plain and application/octet-stream
+# fallbacks; magic bytes are chosen by the sender, so a payload after
+# a PNG header is skipped as well
+SKIPPABLE_TYPES = frozenset(["image/png", "image/jpeg", "image/gif"])
+
+
+def sniff_type(head: bytes) -> str | None:
+    """Guess the type of a file from its first bytes.
+
+    :return: MIME type, None for empty files
+    """
+    if not head:
+        return None
+    for offset, magic, mime_type in MAGIC_TYPES:
+        if head.startswith(magic, offset):
+            return mime_type
+    if b"\x00" not in head:
+        try:
+            head.decode()
+            return "text/plain"
+        except UnicodeDecodeError as e:
+            # a multi-byte char cut at the end of the head
+            if e.start >= len(head) - 3:
+                return "text/plain"
+    return "application/octet-stream"
+
+
+class ScanPipelineError(Exception):
+    """Raised when the pipeline is misconfigured.
+    """
+
+
+class ScanContext():
+    """State of a file scan, shared by the stages.
+    """
+    def __init__(self,
+                 stream: t.IO[bytes],
+                 filename: str,
+                 algorithms: t.Iterable[str] = DEFAULT_ALGORITHMS):
+        """Create a context.
+
+        :param stream: Uploaded file, at its start
+        :param filename: Name of the file, sanitized
+        :param algorithms: Digests computed while the file is read
+        """
+        self.raw = stream
+        self.filename = filename
+        #: stream to read the file from, computing size and digests
+        self.stream = _TeeStream(self)
+        #: set by the stage producing the verdict
+        self.result: ClamdScanResult | None = None
+        #: sniffed MIME type, once the first bytes are read
+        self.sniffed_type: str | None = None
+        #: size in bytes, once known
+        self.size: int | None = None
+        #: fields added to the response by stages
+        self.extra: dict[str, t.Any] = {}
+        #: seconds spent by stage
+        self.timings: dict[str, float] = {}
+        self._hashers = {a: hashlib.new(a) for a in algorithms}
+        self._head: bytes | None = None
+        # head bytes not delivered by the stream yet
+        self._pending = b""
+        self._consumed = 0
+        self._complete = False
+
+    def head(self) -> bytes:
+        """Get the first bytes of the file, sniffing its type.
+
+        They are read once, and delivered again by `stream`.
+        """
+        if self._head is None:
+            parts = []
+            size = 0
+            while size < SNIFF_SIZE:
+                data = self.raw.read(SNIFF_SIZE - size)
+                if not data:
+                    self._complete = True
+                    break
+                parts.append(data)
+                size += len(data)
+            self._head = b"".join(parts)
+            self._pending = self._head
+            self._update(self._head)
+            self.sniffed_type = sniff_type(self._head)
+        return self._head
+
+    @contextlib.contextmanager
+    def raw_at_start(self) -> t.Iterator[t.IO[bytes]]:
+        """Access the raw (seekable) stream from its start.
+
+        Its position is restored on exit, so that `stream` goes on
+        where it was.
+        """
+        pos = self.raw.tell()
+        self.raw.seek(0)
+        try:
+            yield self.raw
+        finally:
+            self.raw.seek(pos)
+
+    def digests(self) -> dict[str, bytes] | None:
+        """Get the digests of the file, None if not read to the end.
+        """
+        if not self._complete:
+            return None
+        return {a: h.digest() for a, h in self._hashers.items()}
+
+    def require_digests(self, algorithms: t.Iterable[str]) -> None:
+        """Also compute these digests while the file is read.
+
+        :raises ScanPipelineError: if the file was already read past
+          its head
+        """
+        missing = [a for a in algorithms if a not in self._hashers]
+        if not missing:
+            return
+        head = self._head or b""
+        if self._consumed > len(head):
+            raise ScanPipelineError("Digests must be required before "
+                                    "the file is read")
+        for algorithm in missing:
+            self._hashers[algorithm] = hashlib.new(algorithm, head)
+
+    def read_to_end(self) -> None:
+        """Read the rest of the file through `stream`, completing its
+        digests.
+        """
+        while self.stream.read(64 * 1024):
+            pass
+
+    def finish(self) -> None:
+        """Settle the size of the file, once the scan is done.
+
+        Files not read to the end are measured by seeking, or read
+        through (e.g. request bodies, to keep the connection usable).
+        """
+        if self._complete:
+            self.size = self._consumed
+        elif self.raw.seekable():
+            self.size = self.raw.seek(0, io.SEEK_END)
+        else:
+            self.read_to_end()
+            self.size = self._consumed
+
+    def _update(self, data: bytes) -> None:
+        self._consumed += len(data)
+        for h in self._hashers.values():
+            h.update(data)
+
+
+class _TeeStream(io.RawIOBase):
+    """Read the raw stream of a context, feeding its digests.
+    """
+    def __init__(self, ctx: ScanContext):
+        self._ctx = ctx
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        ctx = self._ctx
+        if ctx._head is None:
+            ctx.head()
+        if ctx._pending:
+            if size is None or size < 0:
+                size = len(ctx._pending)
+            data = ctx._pending[:size]
+            ctx._pending = ctx._pending[size:]
+            return data
+        if ctx._complete:
+            return b""
+        data = ctx.raw.read(size)
+        if data:
+            ctx._update(data)
+        else:
+            ctx._complete = True
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class Stage():
+    """A stage of the scan pipeline.
+    """
+    #: name in timings and configuration
+    name = "stage"
+
+    def run(self, ctx: ScanContext) -> None:
+        """Work on the context, setting ctx.result to stop the pipeline.
+        """
+
+    def after(self, ctx: ScanContext) -> None:
+        """Called once the result is set, may amend it.
+        """
+
+
+class SniffStage(Stage):
+    """Sniff the type of the file from its first bytes.
+    """
+    name = "sniff"
+
+    def run(self, ctx: ScanContext) -> None:
+        ctx.head()
+        ctx.extra["file_type"] = ctx.sniffed_type
+
+
+class SkipTypesStage(Stage):
+    """Report files of known-safe types as OK, without scanning them.
+
+    Types are trusted from the magic bytes of the file only.
+    """
+    name = "skip_types"
+
+    def __init__(self, types: t.Collection[str]):
+        """:param types: Types to skip, among SKIPPABLE_TYPES
+        :raises ScanPipelineError: if a type can't be skipped
+        """
+        unsafe = set(types) - SKIPPABLE_TYPES
+        if unsafe:
+            raise ScanPipelineError(
+                f"Types that can't be skipped: {', '.join(sorted(unsafe))}"
+                f" (allowed: {', '.join(sorted(SKIPPABLE_TYPES))})")
+        self.types = frozenset(types)
+
+    def run(self, ctx: ScanContext) -> None:
+        if not self.types:
+            return
+        ctx.head()
+        if ctx.sniffed_type in self.types:
+            ctx.result = _result(ClamdScanStatus.OK)
+            ctx.extra["skipped_type"] = ctx.sniffed_type
+
+
+class HashListStage(Stage):
+    """Look up the file in hash lists.
+
+    Seekable files are read on their own before the upload, so that
+    matching files are not sent to clamd.  Other files (e.g. request
+    bodies) can't be read twice: their digests are computed while they
+    are streamed, and a match overrides the result once it is set.
+    """
+    name = "hash_lists"
+
+    def __init__(self, lists: t.Callable[[], list[HashList]]):
+        """:param lists: Callable returning the hash lists to check,
+          known-bad ones first
+        """
+        self.lists = lists
+
+    def run(self, ctx: ScanContext) -> None:
+        lists = self.lists()
+        algorithms = set().union(*(hl.algorithms for hl in lists))
+        if not algorithms:
+            # no lists, or empty ones
+            return
+        if not ctx.raw.seekable():
+            # looked up in after()
+            ctx.require_digests(algorithms)
+            return
+        with ctx.raw_at_start() as raw:
+            digests = digest_stream(raw, algorithms)
+        self._lookup(ctx, lists, digests)
+
+    def after(self, ctx: ScanContext) -> None:
+        if ctx.raw.seekable() or "hash_list" in ctx.extra:
+            return
+        lists = self.lists()
+        if not lists:
+            return
+        # e.g. skipped types are not streamed to clamd
+        ctx.read_to_end()
+        self._lookup(ctx, lists, ctx.digests())
+
+    @staticmethod
+    def _lookup(ctx: ScanContext,
+                lists: list[HashList],
+                digests: dict[str, bytes]) -> None:
+        for hl in lists:
+            found, name = hl.lookup(digests)
+            if not found:
+                continue
+            if hl.trusted:
+                ctx.result = _result(ClamdScanStatus.OK)
+            else:
+                ctx.result = _result(ClamdScanStatus.FOUND,
+                                     name or "KnownBad.Hash")
+            ctx.extra["hash_list"] = hl.name
+            return
+
+
+class ArchiveStage(Stage):
+    """Scan the members of archives in parallel.
+    """
+    name = "archive"
+
+    def __init__(self,
+                 scan: t.Callable[[t.IO[bytes], str],
+                                  ClamdScanResult | None],
+                 enabled: t.Callable[[], bool]):
+        """:param scan: Callable scanning an archive stream, None if
+          it must be scanned as a whole
+        :param enabled: Callable telling whether the stage is enabled
+        """
+        self.scan = scan
+        self.enabled = enabled
+
+    def run(self, ctx: ScanContext) -> None:
+        if not self.enabled() or not ctx.raw.seekable():
+            return
+        with ctx.raw_at_start() as raw:
+            ctx.result = self.scan(raw, ctx.filename)
+
+
+class ClamdStage(Stage):
+    """Stream the file to clamd and wait for the verdict.
+    """
+    name = "clamd"
+
+    def __init__(self, clamd_factory: t.Callable[[], Clamd]):
+        self.clamd_factory = clamd_factory
+
+    def run(self, ctx: ScanContext) -> None:
+        with self.clamd_factory() as clamd:
+            clamd.instream_send(ctx.stream)
+            ctx.result = clamd.instream_result()
+
+
+def _result(status: ClamdScanStatus,
+            virus: str | None = None) -> ClamdScanResult:
+    """Build the result of a scan decided without clamd.
+    """
+    return ClamdScanResult(
+        input_file="stream",
+        raw_data="",
+        message=f"stream: {virus} FOUND" if virus
+        else f"stream: {status.value}",
+        status=status,
+        virus=virus,
+        err_msg=None,
+        details=[],
+    )
+
+
+class ScanPipeline():
+    """Stages run for each scan.
+    """
+    def __init__(self, stages: list[Stage]):
+        if not stages or not isinstance(stages[-1], ClamdStage):
+            raise ScanPipelineError("The last stage must be clamd")
+        self.stages = stages
+        self._lock = threading.Lock()
+        self._calls = {s.name: 0 for s in stages}
+        self._seconds = {s.name: 0.0 for s in stages}
+
+    def run(self, ctx: ScanContext) -> ClamdScanResult:
+        """Scan a file.
+
+        :return: Result, also set in the context
+        """
+        ran = []
+        for stage in self.stages:
+            ran.append(stage)
+            self._timed(ctx, stage, stage.run)
+            if ctx.result is not None:
+                break
+        for stage in ran:
+            self._timed(ctx, stage, stage.after)
+        ctx.finish()
+
+        with self._lock:
+            for name, seconds in ctx.timings.items():
+                self._calls[name] += 1
+                self._seconds[name] += seconds
+        return ctx.result
+
+    @staticmethod
+    def _timed(ctx: ScanContext, stage: Stage, func) -> None:
+        start = time.perf_counter()
+        try:
+            func(ctx)
+        finally:
+            ctx.timings[stage.name] = ctx.timings.get(stage.name, 0.0) + \
+                time.perf_counter() - start
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Get the calls and the total seconds of each stage.
+        """
+        with self._lock:
+            return {name: {"calls": self._calls[name],
+                           "seconds": round(self._seconds[name], 6)}
+                    for name in self._calls}
@@ -0,0 +1,342 @@
+"""On-demand profiling of a live worker process.
+
+A capture is armed in the worker process serving the debug request
+and covers what the same process does next, up to a number of
+requests or seconds: its report is collected by a later call (while
+the capture is running, it covers what was captured so far).  So it
+works with sync workers, which serve one request at a time:
+ - ProfileCapture profiles requests with cProfile, one at a time, and
+   reports merged pstats
+ - SampleCapture samples the stacks of the threads serving requests
+   from a background thread, and reports them as collapsed stacks
+   (input of flamegraph.pl and speedscope)
+ - TracemallocCapture compares tracemalloc snapshots taken when armed
+   and at the end of the capture, covering all threads
+
+Captures live in the worker process that armed them: with several
+workers, reports are collected from the worker that serves the call.
+
+When no capture is running, request hooks only check `current`.
+
+"""
+import abc
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import typing as t
+
+from werkzeug.exceptions import Conflict, NotFound
+
+MAX_SECONDS = 600
+SAMPLE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 25
+#: sort keys of pstats reports: SortKey values and their aliases
+#: (e.g. tottime)
+SORT_KEYS = frozenset(key.value for key in pstats.SortKey) | \
+    frozenset(pstats.Stats.sort_arg_dict_default)
+
+#: latest request capture armed in this process, if any
+current: "ProfileCapture | SampleCapture | None" = None
+#: latest tracemalloc capture armed in this process, if any
+current_tracemalloc: "TracemallocCapture | None" = None
+_arm_lock = threading.Lock()
+
+
+class RequestCapture(abc.ABC):
+    """Capture of the next requests served by this process.
+
+    The token returned by request_started() must be given back to
+    request_finished() once the request is done, whatever happened
+    to the capture meanwhile.
+    """
+    def __init__(self, max_requests: int, seconds: float):
+        self.max_requests = max_requests
+        self.deadline = time.monotonic() + seconds
+        self._lock = threading.Lock()
+        self.hooked = 0
+        self.profiled = 0
+        self.skipped = 0
+
+    def running(self) -> bool:
+        """Tell whether new requests are captured.
+        """
+        return self.hooked < self.max_requests and \
+            time.monotonic() < self.deadline
+
+    def start(self) -> None:
+        """Start the capture, once armed.
+        """
+
+    def request_started(self) -> t.Any:
+        """Hook a request starting in the current thread.
+
+        :return: Token of the request, None if not captured
+        """
+        with self._lock:
+            if not self.running():
+                return None
+            self.hooked += 1
+        return self._started()
+
+    @abc.abstractmethod
+    def request_finished(self, token: t.Any) -> None:
+        """Hook a request captured by request_started() finishing.
+        """
+
+    @abc.abstractmethod
+    def _started(self) -> t.Any:
+        """Start capturing a request in the current thread.
+
+        :return: Token of the request, None if skipped
+        """
+
+    def _skip(self) -> None:
+        with self._lock:
+            self.skipped += 1
+
+    def summary(self) -> str:
+        state = "running" if self.running() else "finished"
+        return (f"# worker {os.getpid()} ({state}): "
+                f"requests profiled: {self.profiled}, "
+                f"skipped: {self.skipped}\n")
+
+
+class ProfileCapture(RequestCapture):
+    """Profile requests with cProfile, merging their stats.
+
+    Only one profiler can be enabled at a time, so requests running
+    while another one is profiled are skipped.
+    """
+    def __init__(self, max_requests: int, seconds: float):
+        super().__init__(max_requests, seconds)
+        self._profiling = threading.Lock()
+        self.stats: pstats.Stats | None = None
+
+    def _started(self) -> cProfile.Profile | None:
+        if not self._profiling.acquire(blocking=False):
+            self._skip()
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiling tool is active (python >= 3.12)
+            self._profiling.release()
+            self._skip()
+            return None
+        return profile
+
+    def request_finished(self, profile: cProfile.Profile) -> None:
+        profile.disable()
+        self._profiling.release()
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.profiled += 1
+
+    def report(self, sort: str = "cumulative", limit: int = 50) -> str:
+        """Get the pstats report of the requests profiled.
+        """
+        out = io.StringIO()
+        out.write(self.summary())
+        with self._lock:
+            if self.stats is not None:
+                self.stats.stream = out
+                self.stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class SampleCapture(RequestCapture):
+    """Sample the stacks of the threads serving requests.
+    """
+    def __init__(self, max_requests: int, seconds: float,
+                 interval: float = SAMPLE_INTERVAL):
+        super().__init__(max_requests, seconds)
+        self.interval = interval
+        self._threads: set[int] = set()
+        self.samples: collections.Counter[str] = collections.Counter()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name="profiling-sampler",
+                         daemon=True).start()
+
+    def _started(self) -> int:
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads.add(ident)
+        return ident
+
+    def request_finished(self, ident: int) -> None:
+        with self._lock:
+            self._threads.discard(ident)
+            self.profiled += 1
+
+    def _run(self) -> None:
+        """Sample stacks until no more requests are captured.
+        """
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                threads = list(self._threads)
+            if not threads:
+                if not self.running():
+                    return
+                continue
+            frames = sys._current_frames()
+            stacks = [_collapse(frames[ident]) for ident in threads
+                      if ident in frames]
+            del frames
+            with self._lock:
+                self.samples.update(stacks)
+
+    def report(self) -> str:
+        """Get the samples as collapsed stacks, one per line.
+        """
+        with self._lock:
+            samples = self.samples.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_qualname} "
+                     f"({os.path.basename(code.co_filename)}"
+                     f":{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class TracemallocCapture():
+    """Compare allocations at the start and end of some seconds.
+
+    tracemalloc is started for the capture, unless already tracing,
+    and stopped by a timer at its end.
+    """
+    def __init__(self, seconds: float):
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(seconds, self.stop)
+        self._timer.daemon = True
+        self._started = False
+        self._before: tracemalloc.Snapshot | None = None
+        self._after: tracemalloc.Snapshot | None = None
+
+    def running(self) -> bool:
+        return self._after is None
+
+    def start(self) -> None:
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._before = _take_snapshot()
+        self._timer.start()
+
+    def stop(self) -> None:
+        self._timer.cancel()
+        with self._lock:
+            if self._after is not None:
+                return
+            self._after = _take_snapshot()
+            if self._started:
+                tracemalloc.stop()
+
+    def report(self, group_by: str = "lineno", limit: int = 50) -> str:
+        """Get the largest differences of allocations.
+
+        :param group_by: "lineno", "filename" or "traceback"
+        :param limit: Max entries in the report
+        """
+        with self._lock:
+            state = "running" if self._after is None else "finished"
+            after = self._after or _take_snapshot()
+        out = io.StringIO()
+        out.write(f"# worker {os.getpid()} ({state})\n")
+        for stat in after.compare_to(self._before, group_by)[:limit]:
+            out.write(f"{stat}\n")
+            if group_by == "traceback":
+                for line in stat.traceback.format(most_recent_first=True):
+                    out.write(f"    {line}\n")
+        return out.getvalue()
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+
+
+def arm_profile(max_requests: int,
+                seconds: float,
+                collapsed: bool = False) -> RequestCapture:
+    """Profile the next requests served by this process.
+
+    :param max_requests: Max requests captured
+    :param seconds: Max duration of the capture
+    :param collapsed: Sample stacks and report collapsed stacks,
+      instead of cProfile stats
+    :return: Capture armed
+    :raises Conflict: if another capture is running
+    """
+    global current
+    seconds = min(seconds, MAX_SECONDS)
+    capture = SampleCapture(max_requests, seconds) if collapsed \
+        else ProfileCapture(max_requests, seconds)
+    with _arm_lock:
+        if current is not None and current.running():
+            raise Conflict("Another capture is running in this worker")
+        capture.start()
+        current = capture
+    return capture
+
+
+def arm_tracemalloc(seconds: float) -> TracemallocCapture:
+    """Trace the allocations of this process for some seconds.
+
+    :return: Capture armed
+    :raises Conflict: if another capture is running
+    """
+    global current_tracemalloc
+    capture = TracemallocCapture(min(seconds, MAX_SECONDS))
+    with _arm_lock:
+        if current_tracemalloc is not None and \
+           current_tracemalloc.running():
+            raise Conflict("Another capture is running in this worker")
+        capture.start()
+        current_tracemalloc = capture
+    return capture
+
+
+def profile_report(sort: str = "cumulative", limit: int = 50) -> str:
+    """Get the report of the latest request capture of this process.
+
+    :param sort: pstats sort key, one of SORT_KEYS
+    :param limit: Max functions in pstats report
+    :raises NotFound: if no capture was armed in this process
+    """
+    capture = current
+    if capture is None:
+        raise NotFound(f"No capture armed in worker {os.getpid()}")
+    if isinstance(capture, SampleCapture):
+        return capture.report()
+    return capture.report(sort=sort, limit=limit)
+
+
+def tracemalloc_report(group_by: str = "lineno", limit: int = 50) -> str:
+    """Get the report of the latest tracemalloc capture of this process.
+
+    :raises NotFound: if no capture was armed in this process
+    """
+    capture = current_tracemalloc
+    if capture is None:
+        raise NotFound(f"No capture armed in worker {os.getpid()}")
+    return capture.report(group_by=group_by, limit=limit)
@@ -0,0 +1,286 @@
+"""Per-client rate limiting and fair queuing of scans.
+
+Clients are identified by a key (e.g. the value of an API key header)
+and each one gets:
+ - two token buckets, one for requests and one for bytes uploaded:
+   a request is admitted only if both buckets have enough tokens,
+   otherwise it is rejected with 429 and a Retry-After telling when
+   the buckets will be refilled enough
+ - a fair share of the scan slots of the worker process: when more
+   scans than slots are in flight, the waiting ones are served by
+   weighted fair queuing (start-time fair queuing, with the bytes of
+   the request as cost), so a client bulk uploading large files
+   cannot starve clients sending few small ones
+
+Each client can be given a weight, multiplying its rates and its share
+of the slots.  State is per worker process: the service divides rates
+among its workers, and the slots only matter to workers serving
+several requests at a time (threads).
+
+"""
+import collections
+import heapq
+import itertools
+import math
+import threading
+import time
+import typing as t
+
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+# cost of a request in the fair queue, on top of its bytes, so that
+# small requests are not free
+REQUEST_COST = 64 * 1024
+# seconds a client should wait before retrying when the queue is full
+RETRY_AFTER = 5
+# max number of clients whose state is kept, least recently seen
+# ones are forgotten first
+MAX_CLIENTS = 10000
+
+
+def parse_weights(spec: str) -> dict[str, float]:
+    """Parse client weights from "client=weight,..." specs.
+
+    :raises ValueError: if the spec is malformed
+    """
+    weights = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        client, sep, weight = item.rpartition("=")
+        if not sep or not client.strip() or float(weight) <= 0:
+            raise ValueError(f"Invalid client weight '{item.strip()}'")
+        weights[client.strip()] = float(weight)
+    return weights
+
+
+class TokenBucket():
+    """Token bucket, refilled at a constant rate up to its capacity.
+
+    Tokens can go below zero: a cost larger than the capacity is
+    admitted once the bucket is full and the debt delays the next
+    requests.
+    """
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(now - self.updated, 0.0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """Get seconds to wait before `cost` tokens can be taken.
+        """
+        self._refill(now)
+        needed = min(cost, self.capacity) - self.tokens
+        return max(needed, 0.0) / self.rate
+
+    def take(self, cost: float, now: float) -> None:
+        """Take tokens, possibly going into debt.
+        """
+        self._refill(now)
+        self.tokens -= cost
+
+
+class RateLimiter():
+    """Token buckets of the clients, by requests and by bytes.
+    """
+    def __init__(self,
+                 requests_rate: float | None,
+                 bytes_rate: float | None,
+                 burst: float = 10.0,
+                 weights: dict[str, float] | None = None,
+                 clock: t.Callable[[], float] = time.monotonic,
+                 max_clients: int = MAX_CLIENTS):
+        """Create a rate limiter.
+
+        :param requests_rate: Requests per second per client, None for
+          unlimited
+        :param bytes_rate: Bytes per second per client, None for
+          unlimited
+        :param burst: Capacity of the buckets, in seconds of rate
+        :param weights: Weights of the clients, default 1
+        :param clock: Monotonic clock, in seconds
+        :param max_clients: Max number of clients whose buckets are kept
+        """
+        self.requests_rate = requests_rate
+        self.bytes_rate = bytes_rate
+        self.burst = burst
+        self.weights = weights or {}
+        self.max_clients = max_clients
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets: collections.OrderedDict[
+            str, list[TokenBucket]] = collections.OrderedDict()
+        self.admitted = 0
+        self.rejected = 0
+
+    def _client_buckets(self, client: str, now: float) -> list[TokenBucket]:
+        buckets = self._buckets.get(client)
+        if buckets is not None:
+            self._buckets.move_to_end(client)
+            return buckets
+
+        weight = self.weights.get(client, 1.0)
+        buckets = []
+        for rate in (self.requests_rate, self.bytes_rate):
+            if rate is None:
+                buckets.append(None)
+                continue
+            rate *= weight
+            buckets.append(TokenBucket(rate, rate * self.burst, now))
+        self._buckets[client] = buckets
+
+        # forget the least recently seen client, whose buckets are most
+        # likely refilled anyway
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return buckets
+
+    def acquire(self, client: str, size: int) -> None:
+        """Admit a request of a client.
+
+        :param client: Client key
+        :param size: Bytes of the request, 0 if not known yet
+        :raises TooManyRequests: if the client exceeded its rates
+        """
+        costs = (1, size)
+        with self._lock:
+            now = self._clock()
+            buckets = self._client_buckets(client, now)
+            wait = max(b.wait_time(cost, now)
+                       for b, cost in zip(buckets, costs) if b is not None)
+            if wait > 0:
+                self.rejected += 1
+                raise TooManyRequests(
+                    "Rate limit exceeded, retry later",
+                    retry_after=math.ceil(wait))
+            for b, cost in zip(buckets, costs):
+                if b is not None:
+                    b.take(cost, now)
+            self.admitted += 1
+
+    def charge(self, client: str, size: int) -> None:
+        """Charge bytes not known when the request was admitted.
+
+        :param client: Client key
+        :param size: Bytes to charge
+        """
+        with self._lock:
+            now = self._clock()
+            bucket = self._client_buckets(client, now)[1]
+            if bucket is not None:
+                bucket.take(size, now)
+
+    def stats(self) -> dict[str, int]:
+        """Get rate limiting stats.
+        """
+        with self._lock:
+            return {
+                "clients": len(self._buckets),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+class _Ticket():
+    def __init__(self, client: str, start: float, finish: float):
+        self.client = client
+        self.start = start
+        self.finish = finish
+        self.granted = False
+        self.cancelled = False
+
+
+class FairQueue():
+    """Scan slots shared by weighted fair queuing.
+
+    Each request is tagged with a virtual start time, the later of the
+    current virtual time and the finish time of the previous request
+    of the same client, and a finish time, start plus cost / weight.
+    Free slots go to the waiting request with the earliest finish time.
+    """
+    def __init__(self, slots: int, weights: dict[str, float] | None = None):
+        """Create a fair queue.
+
+        :param slots: Max concurrent scans
+        :param weights: Weights of the clients, default 1
+        """
+        self.slots = slots
+        self.weights = weights or {}
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting: list[tuple[float, int, _Ticket]] = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish: dict[str, float] = {}
+        self.timeouts = 0
+
+    def acquire(self, client: str, size: int, timeout: float | None) -> None:
+        """Wait for a scan slot.
+
+        :param client: Client key
+        :param size: Bytes of the request, 0 if not known
+        :param timeout: Max seconds to wait, None to wait forever
+        :raises ServiceUnavailable: if no slot was free in time
+        """
+        weight = self.weights.get(client, 1.0)
+        with self._cond:
+            start = max(self._virtual_time,
+                        self._last_finish.get(client, 0.0))
+            ticket = _Ticket(client, start,
+                             start + (REQUEST_COST + size) / weight)
+            self._last_finish[client] = ticket.finish
+            heapq.heappush(self._waiting,
+                           (ticket.finish, next(self._seq), ticket))
+            self._grant()
+            if not self._cond.wait_for(lambda: ticket.granted, timeout):
+                ticket.cancelled = True
+                # the client did not get the service it was charged for
+                if client in self._last_finish:
+                    self._last_finish[client] -= ticket.finish - ticket.start
+                self.timeouts += 1
+                raise ServiceUnavailable(
+                    "Too many scans in progress, retry later",
+                    retry_after=RETRY_AFTER)
+
+    def release(self) -> None:
+        """Give back a scan slot.
+        """
+        with self._cond:
+            self._active -= 1
+            self._grant()
+
+    def _grant(self) -> None:
+        granted = False
+        while self._active < self.slots and self._waiting:
+            _, _, ticket = heapq.heappop(self._waiting)
+            if ticket.cancelled:
+                continue
+            ticket.granted = granted = True
+            self._active += 1
+            self._virtual_time = max(self._virtual_time, ticket.start)
+        if granted:
+            self._cond.notify_all()
+
+        if len(self._last_finish) > MAX_CLIENTS:
+            # clients behind virtual time start from it anyway
+            self._last_finish = {
+                c: f for c, f in self._last_finish.items()
+                if f > self._virtual_time}
+
+    def stats(self) -> dict[str, int]:
+        """Get queuing stats.
+        """
+        with self._cond:
+            return {
+                "slots": self.slots,
+                "active": self._active,
+                "waiting": sum(1 for _, _, tk in self._waiting
+                               if not tk.cancelled),
+                "timeouts": self.timeouts,
+            }
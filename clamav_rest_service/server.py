@@ -0,0 +1,1263 @@
+"""Server of the ClamAV REST Service, a REST interface for ClamAV daemon.
+
+The ClamAV daemon (clamd) can be either reached via Unix domain socket
+or TCP socket.  This behaviour can be specified via configuration.
+
+Configuration: all configuration is managed through environment
+variables.  All environment variables starting with "CLAMAV_" prefix
+are loaded into the application.
+
+No authentication of any type is implemented whatsoever: be sure that
+your ClamAV REST service is adequately protected.
+
+The following variables are accepted:
+
+ - CLAMAV_CLAMD_SOCKET_PATH : application will connect to clamd
+    running on Unix socket at path specified.
+ - CLAMAV_CLAMD_HOST : application will connect to clamd running on TCP
+    socket at host specified; also CLAMAV_CLAMD_PORT is expected
+ - CLAMAV_CLAMD_PORT : use with CLAMAV_CLAMD_PORT
+ - CLAMAV_ARCHIVE_PARALLEL_SCAN : when true, zip and tar uploads are
+    expanded and their members scanned in parallel; the archive itself
+    is not sent to clamd, so signatures of the whole container are
+    not matched (default false)
+ - CLAMAV_ARCHIVE_SCAN_WORKERS : max concurrent clamd connections used
+    to scan the members of a single archive (default 4)
+ - CLAMAV_ARCHIVE_MAX_MEMBERS : max number of members expanded from an
+    archive, nested ones included (default 10000)
+ - CLAMAV_ARCHIVE_MAX_DEPTH : max nesting depth of expanded archives
+    (default 2)
+ - CLAMAV_ARCHIVE_MAX_EXPANDED_SIZE : max total bytes expanded from an
+    archive (default 536870912, 512 MiB)
+ - CLAMAV_MAX_CONTENT_LENGTH : max size in bytes of a request body
+    (default 2122317824, as StreamMaxLength in the bundled clamd.conf)
+ - CLAMAV_SPOOL_DIR : directory where uploaded files are spooled on
+    disk, e.g. a tmpfs mount (default: system temp directory)
+ - CLAMAV_SPOOL_MEMORY_THRESHOLD : uploaded files up to this size in
+    bytes are kept in memory (default 512000)
+ - CLAMAV_SPOOL_BUDGET : max total bytes spooled by the concurrent
+    requests of a worker process, further uploads are rejected with
+    503 (default unlimited)
+ - CLAMAV_MAX_DECOMPRESSED_SIZE : max size in bytes of a request body
+    sent with Content-Encoding, once decompressed (default 2122317824,
+    as StreamMaxLength in the bundled clamd.conf)
+ - CLAMAV_HASH_ALLOWLIST : comma separated paths of trusted hash lists;
+    uploads matching them are reported OK without calling clamd
+ - CLAMAV_HASH_BLOCKLIST : comma separated paths of known-bad hash
+    lists; uploads matching them are reported FOUND without calling
+    clamd
+ - CLAMAV_HASH_LIST_RELOAD_INTERVAL : seconds between checks for
+    changes of hash list files (default 5)
+ - CLAMAV_RATE_LIMIT_HEADER : request header identifying the client
+    (e.g. X-Api-Key) for rate limiting and fair queuing (default: the
+    client address)
+ - CLAMAV_RATE_LIMIT_REQUESTS : scan requests per second allowed to
+    each client by the whole service, exceeding requests get 429
+    (default unlimited)
+ - CLAMAV_RATE_LIMIT_BYTES : bytes per second each client is allowed to
+    upload for scanning to the whole service, exceeding requests get 429
+    (default unlimited)
+ - CLAMAV_RATE_LIMIT_BURST : seconds of rate a client can use in a
+    burst (default 10)
+ - CLAMAV_WORKER_PROCESSES : number of worker processes, set by
+    docker/gunicorn_conf.py from the gunicorn -w option: each worker
+    keeps its own buckets, with the rates divided by this number, and
+    a 429 Retry-After tells when the worker serving it would admit the
+    request (default 1)
+ - CLAMAV_CLIENT_WEIGHTS : comma separated client=weight pairs,
+    multiplying the rates and the scan slots share of those clients
+    (default 1 for all clients)
+ - CLAMAV_SCAN_CONCURRENCY : max concurrent scans of a worker process;
+    further scans wait, served by weighted fair queuing among clients
+    (default unlimited; sync workers serve one request at a time, so it
+    only works with threaded workers)
+ - CLAMAV_SCAN_QUEUE_TIMEOUT : max seconds a scan waits for a slot,
+    then it gets 503 (default 30)
+ - CLAMAV_SCAN_PIPELINE : comma separated stages run for each scan, in
+    order, until one decides the verdict; clamd must be the last one
+    (default hash_lists,sniff,skip_types,archive,clamd)
+ - CLAMAV_SKIP_TYPES : comma separated MIME types, as sniffed from the
+    magic bytes of files, reported OK without scanning, among
+    image/png, image/jpeg and image/gif; magic bytes are chosen by the
+    sender, so anything can be hidden after them (default none)
+ - CLAMAV_DB_MONITOR_INTERVAL : seconds between checks of the clamd
+    signature database version, 0 to disable (default 60)
+ - CLAMAV_WARMUP_CORPUS_DIR : directory of files scanned to warm up
+    clamd when its signature database changes (default: a few built-in
+    samples of common file types)
+ - CLAMAV_SHARED_STATE_DIR : directory of the memory segment shared by
+    gunicorn workers for service-wide metrics, created when gunicorn
+    runs with -c docker/gunicorn_conf.py (default /dev/shm)
+ - CLAMAV_DEBUG_TOKEN : enables the /debug/profile and
+    /debug/tracemalloc endpoints, to be called with an
+    "Authorization: Bearer <token>" header: POST arms a capture of the
+    worker process serving it, GET collects its report (default
+    disabled)
+
+"""
+import functools
+import hashlib
+import hmac
+import logging
+import os
+
+from flask import Flask, g, render_template, request
+from flask_swagger import swagger
+from werkzeug.datastructures import WWWAuthenticate
+from werkzeug.exceptions import HTTPException, NotFound, \
+    TooManyRequests, Unauthorized
+
+from .archive import ArchiveError, ArchiveLimits, scan_archive
+from .assets import StaticAssets
+from .clamd import ClamdUnixSocket, ClamdTCPSocket, ClamdScanStatus
+from .dbmonitor import DatabaseMonitor, builtin_corpus, load_corpus
+from .hashlist import HashList
+from .jsonstream import JsonStreamError, iter_json_files
+from .pipeline import ArchiveStage, ClamdStage, HashListStage, \
+    ScanContext, ScanPipeline, SkipTypesStage, SniffStage
+from .ratelimit import FairQueue, RateLimiter, parse_weights
+from . import profiling, sharedstate, spool
+from .wrappers import ScanRequest
+
+##
+# Init app and config
+##
+
+# static files are served by static_file(), with precompressed variants
+# named after the package, served as clamav_rest_service:app
+app = Flask(__package__, static_folder=None)
+app.request_class = ScanRequest
+static_assets = StaticAssets(os.path.join(app.root_path, "static"))
+
+# load all env starting with CLAMAV_ and make them available in
+# app.config without CLAMAV_
+app.config.from_prefixed_env("CLAMAV")
+if app.config["MAX_CONTENT_LENGTH"] is None:
+    # as StreamMaxLength in the bundled clamd.conf
+    app.config["MAX_CONTENT_LENGTH"] = 2024 * 1024 * 1024
+
+# fix gunicorn logging
+if __name__ != '__main__':
+    gunicorn_logger = logging.getLogger('gunicorn.error')
+    app.logger.handlers = gunicorn_logger.handlers[:]
+    app.logger.setLevel(gunicorn_logger.level)
+    app.logger.propagate = False
+
+##
+# Pages
+##
+
+
+@app.route("/", methods=["GET"])
+@app.route("/index.html", methods=["GET"])
+def index():
+    """Welcome page.
+    """
+    # try to ping clamd
+    try:
+        with clamd_instance() as clamd:
+            pong = clamd.ping().message
+        connection_up = pong == "PONG"
+    except Exception as e:
+        app.logger.exception("Unable to ping clamav: %s", str(e))
+        connection_up = False
+
+    if connection_up:
+        # try to get clamd version
+        try:
+            with clamd_instance() as clamd:
+                version = clamd.version().message
+        except Exception as e:
+            app.logger.exception("Unable to get clamav stats: %s", str(e))
+            stats = "Unable to get ClamAV version."
+
+        # try to get clamd stats
+        try:
+            with clamd_instance() as clamd:
+                stats = clamd.stats().message
+        except Exception as e:
+            app.logger.exception("Unable to get clamav stats: %s", str(e))
+            stats = "Unable to get ClamAV stats."
+    else:
+        pong = version = stats = "Unable to connect to ClamAV service."
+
+    return render_template(
+        "index.html",
+        connection_up=connection_up,
+        pong=pong,
+        version=version,
+        stats=stats,
+    )
+
+
+@app.route("/swagger-ui")
+def swagger_ui():
+    """Swagger UI page.
+    """
+    return render_template("swagger-ui.html")
+
+
+##
+# API
+##
+
+
+@app.route("/static/<path:filename>", endpoint="static")
+def static_file(filename):
+    """Static files, precompressed and cacheable.
+    """
+    accept_encodings = {e for e in ("br", "gzip")
+                        if request.accept_encodings[e] > 0}
+    return static_assets.send(filename, accept_encodings,
+                              request.args.get("v"))
+
+
+@app.url_defaults
+def static_version(endpoint, values):
+    """Add the content version to static URLs, for cache busting.
+    """
+    if endpoint == "static" and "filename" in values:
+        version = static_assets.version(values["filename"])
+        if version is not None:
+            values.setdefault("v", version)
+
+
+@app.route("/api/v1/doc")
+def api_doc():
+    """OpenAPI spec of the v1 API.
+    """
+    body, etag = api_spec()
+    resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag)
+    # clients can cache it, but have to revalidate with the ETag
+    resp.cache_control.public = True
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+@app.route("/health", methods=["GET"])
+@app.route("/api/v1/clamav/ping", methods=["GET"])
+def ping():
+    """Ping clamav ensuring connection is up.
+    ---
+    tags:
+      - status
+    responses:
+      200:
+        description: Pong
+        content: application/json
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              description: Status of the ping
+              example: OK
+            message:
+              type: string
+              description: Message returned by clamav on ping command
+              example: PONG
+            error:
+              type: string
+              description: Error occurred, if any
+    """
+    app.logger.debug("Pinging clamd...")
+    with clamd_instance() as clamd:
+        pong = clamd.ping()
+    app.logger.debug("Ping clamd raw response: %s", pong.raw_data)
+
+    if pong.message == "PONG":
+        status = "OK"
+        code = 200
+    else:
+        status = "KO"
+        code = 503
+
+    return {
+        "status": status,
+        "message": pong.message,
+    }, code
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Check that clamd is warmed up with its signature database.
+    ---
+    tags:
+      - status
+    responses:
+      200:
+        description: Ready to scan
+        content: application/json
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              description: Readiness {OK,KO}
+              example: OK
+            db_version:
+              type: integer
+              description: Version of the signature database
+              example: 27450
+            db_build_date:
+              type: string
+              description: Build date of the signature database
+              example: "2024-10-14T08:35:41"
+      503:
+        description: Not ready, clamd unreachable or warming up
+    """
+    monitor = db_monitor()
+    if monitor is None:
+        # nothing to warm up, ready when clamd is
+        return ping()
+
+    snapshot = monitor.snapshot
+    is_ready = snapshot is not None and snapshot.ready
+    return {
+        "status": "OK" if is_ready else "KO",
+        **db_stamp(),
+    }, 200 if is_ready else 503
+
+
+@app.route("/api/v1/clamav/scan", methods=["POST"])
+def scan_file():
+    """Scan a file attached to the request.
+    ---
+    tags:
+      - scan
+    consumes:
+      - multipart/form-data
+      - application/octet-stream
+    parameters:
+      - in: formData
+        name: file
+        description: File to scan
+        required: true
+      - in: body
+        name: body
+        description: File to scan, as the whole request body, when
+          sent as application/octet-stream instead of form data
+      - in: header
+        name: Content-Encoding
+        type: string
+        description: Compression of the request body, one of gzip,
+          deflate, zstd or br (the latter two require optional
+          packages). The body is decompressed while streamed to clamd
+    responses:
+      200:
+        description: Scanning result
+        content: application/json
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              description: Status of the scanning {OK,FOUND,ERROR}
+              example: FOUND
+            virus:
+              type: string
+              description: Virus found, if any
+              example: Name-Of-Virus-Found
+            error:
+              type: string
+              description: Error occurred, if any
+            file_size:
+              type: integer
+              description: Size of the file scanned in bytes
+              example: 256
+            details:
+              type: array
+              description: Additional lines of details, if any. When
+                archive parallel scan is enabled, lists the members
+                of the archive that did not scan OK
+            hash_list:
+              type: string
+              description: Name of the hash list matched by the file,
+                if any. When set, the file was not sent to clamd
+              example: trusted.sha256
+            db_version:
+              type: integer
+              description: Version of the clamd signature database,
+                as last checked
+              example: 27450
+            db_build_date:
+              type: string
+              description: Build date of the clamd signature database,
+                as last checked
+              example: "2024-10-14T08:35:41"
+            file_type:
+              type: string
+              description: MIME type sniffed from the first bytes of
+                the file, if the sniff stage ran
+              example: application/pdf
+            sha256:
+              type: string
+              description: SHA256 of the file, if it was read to the
+                end
+            skipped_type:
+              type: string
+              description: Type of the file, if it was not scanned as
+                a known-safe type
+    """
+    if request.mimetype == "application/octet-stream":
+        # the body is the file: stream it to clamd as it is received
+        stream = request.stream
+        filename = "-"
+    elif 'file' in request.files:
+        file_to_analyze = request.files['file']
+        stream = file_to_analyze.stream
+        filename = file_to_analyze.filename
+    else:
+        return {"error": "No file attached"}, 400
+    # sanitize filename to prevent log injection
+    safe_filename = filename.replace('\r\n', '').replace('\n', '')
+
+    app.logger.debug("Starting scan for file \"%s\"", safe_filename)
+    ctx = ScanContext(stream, safe_filename)
+    result = scan_pipeline().run(ctx)
+    file_size = ctx.size
+    charge_uploaded_bytes(file_size)
+    count_scan(result.status, file_size)
+    app.logger.info("Scanned file \"%s\" (%d bytes) with status %s - %s",
+                    safe_filename, file_size, result.status.value, result.virus
+                    or "no virus")
+    app.logger.debug("Scan raw response: %s", result.raw_data)
+
+    # pack the response
+    resp_body = {
+        "status": result.status.value,
+        "virus": result.virus,
+        "details": result.details,
+        "error": result.err_msg,
+        "file_size": file_size,
+        "hash_list": None,
+        **db_stamp(),
+        **ctx.extra,
+    }
+    digests = ctx.digests()
+    if digests is not None:
+        resp_body["sha256"] = digests["sha256"].hex()
+    if config_bool("INCLUDE_RAW_DATA"):
+        app.logger.warning("Including raw data in scan response. "
+                           "Use this option only for debugging")
+        resp_body["raw_data"] = result.raw_data
+
+    # decide http status code
+    if result.status == ClamdScanStatus.ERROR:
+        status_code = 500
+        app.logger.error("Detected clamd error: %s", result.err_msg)
+    if result.status == ClamdScanStatus.CLIENT_PARSE_ERROR:
+        # this is not a clamd error, but our error in parsing response
+        status_code = 500
+        app.logger.error("Unable to parse clamd response. Raw response: %s",
+                         result.raw_data)
+    else:
+        status_code = 200
+
+    return resp_body, status_code, {"Server-Timing": server_timing(ctx)}
+
+
+@app.route("/api/v1/clamav/scan/json", methods=["POST"])
+def scan_json():
+    """Scan files embedded as base64 in a JSON document.
+    ---
+    tags:
+      - scan
+    consumes:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        description: Files to scan. The document is parsed and decoded
+          while it is received, each file is streamed to clamd
+        schema:
+          type: object
+          properties:
+            files:
+              type: array
+              items:
+                type: object
+                properties:
+                  name:
+                    type: string
+                    description: Name of the file, echoed in results
+                    example: my-file.txt
+                  content:
+                    type: string
+                    format: byte
+                    description: Base64 encoded content of the file
+    responses:
+      200:
+        description: Scanning results
+        content: application/json
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              description: Overall status of the scanning {OK,FOUND,ERROR},
+                FOUND if any file is infected
+              example: FOUND
+            db_version:
+              type: integer
+              description: Version of the clamd signature database,
+                as last checked
+            db_build_date:
+              type: string
+              description: Build date of the clamd signature database,
+                as last checked
+            files:
+              type: array
+              description: Result of each file, in request order
+              items:
+                type: object
+                properties:
+                  name:
+                    type: string
+                    description: Name of the file, if any
+                  status:
+                    type: string
+                    description: Status of the scanning {OK,FOUND,ERROR}
+                  virus:
+                    type: string
+                    description: Virus found, if any
+                  error:
+                    type: string
+                    description: Error occurred, if any
+                  file_size:
+                    type: integer
+                    description: Decoded size of the file in bytes
+                  details:
+                    type: array
+                    description: Additional lines of details, if any
+      400:
+        description: Malformed JSON document
+    """
+    if not request.is_json:
+        return {"error": "Expected application/json content"}, 415
+
+    scanned = []
+    try:
+        for json_file in iter_json_files(request.stream):
+            ctx = ScanContext(json_file.stream, f"#{json_file.index}")
+            result = scan_pipeline().run(ctx)
+            file_size = ctx.size
+            scanned.append((json_file, result, file_size))
+            count_scan(result.status, file_size)
+    except JsonStreamError as e:
+        app.logger.info("Malformed JSON scan request: %s", str(e))
+        return {"error": f"Malformed JSON document: {e}"}, 400
+    finally:
+        charge_uploaded_bytes(sum(size for _, _, size in scanned))
+
+    files = []
+    for json_file, result, file_size in scanned:
+        files.append({
+            "name": json_file.name,
+            "status": result.status.value,
+            "virus": result.virus,
+            "details": result.details,
+            "error": result.err_msg,
+            "file_size": file_size,
+        })
+        app.logger.info("Scanned JSON file #%d (%d bytes) with status "
+                        "%s - %s", json_file.index, file_size,
+                        result.status.value, result.virus or "no virus")
+
+    statuses = {f["status"] for f in files}
+    if ClamdScanStatus.FOUND.value in statuses:
+        status = ClamdScanStatus.FOUND
+    elif statuses - {ClamdScanStatus.OK.value}:
+        status = ClamdScanStatus.ERROR
+    else:
+        status = ClamdScanStatus.OK
+
+    return {
+        "status": status.value,
+        "files": files,
+        **db_stamp(),
+    }
+
+
+@app.route("/api/v1/clamav/stats", methods=["GET"])
+def stats():
+    """Get clamav stats.
+    ---
+    tags:
+      - status
+    responses:
+      200:
+        description: ClamAV stats
+        content: application/json
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              description: ClamAV stats message
+            details:
+              type: array
+              description: Additional lines of details, if any
+            error:
+              type: string
+              description: Error occurred, if any
+    """
+    app.logger.debug("Requesting clamd stats...")
+    with clamd_instance() as clamd:
+        stats = clamd.stats()
+    app.logger.debug("Stats clamd raw response: %s", stats.raw_data)
+
+    return {
+        "message": stats.message,
+        "details": stats.details,
+    }
+
+
+@app.route("/api/v1/clamav/version", methods=["GET"])
+def clamav_version():
+    """Get version of connected clamav instance.
+    ---
+    tags:
+      - status
+    responses:
+      200:
+        description: ClamAV version
+        content: application/json
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              description: ClamAV version message
+              example: ClamAV 1.4.2
+            details:
+              type: array
+              description: Additional lines of details, if any
+            error:
+              type: string
+              description: Error occurred, if any
+    """
+    with clamd_instance() as clamd:
+        version = clamd.version()
+
+    return {
+        "message": version.message,
+        "details": version.details,
+    }
+
+
+@app.route("/api/v1/metrics", methods=["GET"])
+def metrics():
+    """Get metrics of the worker process serving the request.
+    ---
+    tags:
+      - status
+    responses:
+      200:
+        description: Metrics of the worker process
+        content: application/json
+        schema:
+          type: object
+          properties:
+            spool:
+              type: object
+              description: Upload spooling
+              properties:
+                current_bytes:
+                  type: integer
+                  description: Bytes currently spooled
+                peak_bytes:
+                  type: integer
+                  description: Max bytes spooled at the same time
+                budget_bytes:
+                  type: integer
+                  description: Spool budget, null if unlimited
+                rejected:
+                  type: integer
+                  description: Uploads rejected for exhausted budget
+            rate_limit:
+              type: object
+              description: Rate limiting, null if disabled
+              properties:
+                clients:
+                  type: integer
+                  description: Clients tracked
+                admitted:
+                  type: integer
+                  description: Scan requests admitted
+                rejected:
+                  type: integer
+                  description: Scan requests rejected with 429
+            service:
+              type: object
+              description: Counters of all the worker processes (of
+                this worker only, if the shared memory segment cannot
+                be attached), null if gunicorn does not run with the
+                service configuration
+              properties:
+                scans:
+                  type: integer
+                  description: Files scanned
+                scans_found:
+                  type: integer
+                  description: Files found infected
+                scans_error:
+                  type: integer
+                  description: Files not scanned because of errors
+                scanned_bytes:
+                  type: integer
+                  description: Bytes scanned
+                rate_limited:
+                  type: integer
+                  description: Scan requests rejected with 429
+                db_version:
+                  type: integer
+                  description: Newest version of the clamd signature
+                    database seen by the workers (readiness is per
+                    worker, see /ready)
+            pipeline:
+              type: object
+              description: Calls and total seconds of each stage of
+                the scan pipeline
+            scan_queue:
+              type: object
+              description: Fair queuing of scans, null if disabled
+              properties:
+                slots:
+                  type: integer
+                  description: Max concurrent scans
+                active:
+                  type: integer
+                  description: Scans in progress
+                waiting:
+                  type: integer
+                  description: Scans waiting for a slot
+                timeouts:
+                  type: integer
+                  description: Scans rejected after waiting too long
+    """
+    limiter = rate_limiter()
+    queue = scan_queue()
+    state = sharedstate.attach()
+    return {
+        "spool": {
+            **spool.budget.stats(),
+            "budget_bytes": app.config.get("SPOOL_BUDGET"),
+        },
+        "rate_limit": limiter.stats() if limiter else None,
+        "scan_queue": queue.stats() if queue else None,
+        "service": state.snapshot() if state else None,
+        "pipeline": scan_pipeline().stats(),
+    }
+
+
+##
+# Database monitor
+##
+
+
+@app.before_request
+def start_db_monitor():
+    """Start the database monitor in the worker process.
+    """
+    monitor = db_monitor()
+    if monitor is not None:
+        monitor.start()
+
+
+##
+# Rate limiting
+##
+
+# endpoints subject to rate limiting and fair queuing
+SCAN_ENDPOINTS = ("scan_file", "scan_json")
+
+
+@app.before_request
+def admit_scan():
+    """Admit scan requests by client rate and wait for a scan slot.
+    """
+    if request.endpoint not in SCAN_ENDPOINTS:
+        return
+    g.client_key = client_key()
+    # bodies without Content-Length are charged once scanned
+    size = request.content_length or 0
+
+    limiter = rate_limiter()
+    if limiter is not None:
+        try:
+            limiter.acquire(g.client_key, size)
+        except TooManyRequests:
+            state = sharedstate.attach()
+            if state is not None:
+                state.add("rate_limited")
+            raise
+        g.uncharged_bytes = request.content_length is None
+
+    queue = scan_queue()
+    if queue is not None:
+        timeout = float(app.config.get("SCAN_QUEUE_TIMEOUT", 30))
+        queue.acquire(g.client_key, size, timeout)
+        g.scan_queue = queue
+
+
+@app.teardown_request
+def release_scan_slot(exc):
+    """Give back the scan slot taken by the request, if any.
+    """
+    queue = g.pop("scan_queue", None)
+    if queue is not None:
+        queue.release()
+
+
+##
+# Debug
+##
+
+
+@app.before_request
+def start_request_profiling():
+    """Hook requests into the running profiling capture, if any.
+    """
+    capture = profiling.current
+    if capture is not None and capture.running() and \
+       request.endpoint not in DEBUG_ENDPOINTS:
+        token = capture.request_started()
+        if token is not None:
+            g.profiling = (capture, token)
+
+
+@app.teardown_request
+def finish_request_profiling(exc):
+    """Unhook requests from their capture, even if it is over.
+    """
+    hooked = g.pop("profiling", None)
+    if hooked is not None:
+        capture, token = hooked
+        capture.request_finished(token)
+
+
+@app.route("/debug/profile", methods=["POST"])
+def debug_profile_arm():
+    """Profile the next requests served by this worker.
+
+    Query args: requests (default 100), seconds (default 60, max 600)
+    and format (pstats or collapsed).  The report is collected with
+    GET on the same endpoint.
+    """
+    check_debug_token()
+    report_format = request.args.get("format", "pstats")
+    if report_format not in ("pstats", "collapsed"):
+        return {"error": f"Unknown format '{report_format}'"}, 400
+    max_requests = request.args.get("requests", 100, type=int)
+    seconds = request.args.get("seconds", 60, type=float)
+    profiling.arm_profile(max_requests, seconds,
+                          collapsed=report_format == "collapsed")
+    return {"status": "armed", "worker": os.getpid()}, 202
+
+
+@app.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    """Report of the latest profiling capture of this worker.
+
+    Query args: sort (pstats sort key) and limit.
+    """
+    check_debug_token()
+    sort = request.args.get("sort", "cumulative")
+    if sort not in profiling.SORT_KEYS:
+        return {"error": f"Unknown sort '{sort}'"}, 400
+    report = profiling.profile_report(
+        sort=sort,
+        limit=request.args.get("limit", 50, type=int),
+    )
+    return report, 200, debug_report_headers()
+
+
+@app.route("/debug/tracemalloc", methods=["POST"])
+def debug_tracemalloc_arm():
+    """Trace the memory allocations of this worker for some seconds.
+
+    Query args: seconds (default 60, max 600).  The report is collected
+    with GET on the same endpoint.
+    """
+    check_debug_token()
+    profiling.arm_tracemalloc(request.args.get("seconds", 60, type=float))
+    return {"status": "armed", "worker": os.getpid()}, 202
+
+
+@app.route("/debug/tracemalloc", methods=["GET"])
+def debug_tracemalloc():
+    """Diff of the memory allocations of the latest tracemalloc capture
+    of this worker.
+
+    Query args: group (lineno, filename or traceback) and limit.
+    """
+    check_debug_token()
+    group_by = request.args.get("group", "lineno")
+    if group_by not in ("lineno", "filename", "traceback"):
+        return {"error": f"Unknown group '{group_by}'"}, 400
+    report = profiling.tracemalloc_report(
+        group_by=group_by,
+        limit=request.args.get("limit", 50, type=int),
+    )
+    return report, 200, debug_report_headers()
+
+
+##
+# Error handlers
+##
+
+
+@app.errorhandler(HTTPException)
+def handle_http_exception(e):
+    """Handle an HTTP exception and return JSON.
+    """
+    str_e = str(e)
+    if e.code not in [404, 405, 415]:
+        # don't pollute logs, these statuses does not concern us
+        app.logger.exception("HTTP exception: %s", str_e)
+    # keep headers such as Retry-After or Allow
+    headers = [(k, v) for k, v in e.get_headers()
+               if k.lower() != "content-type"]
+    return {"error": str_e}, e.code, headers
+
+
+@app.errorhandler(Exception)
+def handle_exception(e):
+    """Handle an generic exception and return JSON.
+    """
+    str_e = str(e)
+    app.logger.exception("Generic exception: %s", str_e)
+    return {"error": str_e}, 500
+
+
+##
+# Helpers
+##
+
+
+def clamd_instance():
+    """Get a clamd isntance based on app config.
+    """
+    # remember, these are env variables prefixed with CLAMAV_
+    host = app.config.get("CLAMD_HOST")
+    port = app.config.get("CLAMD_PORT")
+    # raw replies are only needed in responses or debug logs
+    keep_raw_data = config_bool("INCLUDE_RAW_DATA") or \
+        app.logger.isEnabledFor(logging.DEBUG)
+
+    if host is not None and port is not None:
+        return ClamdTCPSocket(host=host, port=port,
+                              keep_raw_data=keep_raw_data)
+
+    socket_path = app.config.get("CLAMD_SOCKET_PATH") or "/tmp/clamd.sock"
+    return ClamdUnixSocket(socket_path, keep_raw_data=keep_raw_data)
+
+
+def scan_archive_members(stream, safe_filename: str):
+    """Scan the members of an archive upload in parallel.
+
+    :return: Merged scan result, or None if the upload should be
+      scanned as a whole (not an archive, or not expandable)
+    """
+    limits = ArchiveLimits(
+        max_members=config_int("ARCHIVE_MAX_MEMBERS", 10000),
+        max_depth=config_int("ARCHIVE_MAX_DEPTH", 2),
+        max_expanded_size=config_int("ARCHIVE_MAX_EXPANDED_SIZE",
+                                     512 * 1024 * 1024),
+    )
+    workers = config_int("ARCHIVE_SCAN_WORKERS", 4)
+    try:
+        return scan_archive(stream, clamd_instance, limits, workers)
+    except ArchiveError as e:
+        # clamd applies its own archive limits, let it decide
+        app.logger.warning("Scanning \"%s\" as a whole: %s",
+                           safe_filename, str(e))
+        stream.seek(0)
+        return None
+
+
+@functools.cache
+def api_spec() -> tuple[bytes, str]:
+    """Build the OpenAPI spec of the v1 API.
+
+    Walking the routes and parsing their docstrings is costly, so the
+    spec is built once and served as is.
+
+    :return: Serialized spec and its ETag
+    """
+    swag = swagger(app)
+    swag['info']['version'] = "1.0"
+    swag['info']['title'] = "ClamAV REST service"
+    swag['info']['description'] = \
+        "Sandboxed file scanning with ClamAV via REST API"
+    body = app.json.dumps(swag).encode()
+    return body, hashlib.sha256(body).hexdigest()
+
+
+# endpoints never profiled
+DEBUG_ENDPOINTS = ("debug_profile", "debug_profile_arm",
+                   "debug_tracemalloc", "debug_tracemalloc_arm")
+
+
+def debug_report_headers() -> dict[str, str]:
+    """Get the headers of debug reports.
+    """
+    return {
+        "Content-Type": "text/plain; charset=utf-8",
+        # captures are per worker process
+        "X-Worker-Pid": str(os.getpid()),
+    }
+
+
+def check_debug_token() -> None:
+    """Check the token of a debug request.
+
+    :raises NotFound: if debug endpoints are disabled
+    :raises Unauthorized: if the token is missing or wrong
+    """
+    token = app.config.get("DEBUG_TOKEN")
+    if not token:
+        raise NotFound()
+    auth = request.authorization
+    given = auth.token if auth is not None and auth.type == "bearer" else None
+    if not given or not hmac.compare_digest(given.encode(),
+                                            str(token).encode()):
+        raise Unauthorized("Invalid debug token",
+                           www_authenticate=WWWAuthenticate("bearer"))
+
+
+def client_key() -> str:
+    """Get the key identifying the client of the request.
+    """
+    header = app.config.get("RATE_LIMIT_HEADER")
+    key = request.headers.get(header) if header else None
+    return key or request.remote_addr or ""
+
+
+def charge_uploaded_bytes(size: int) -> None:
+    """Charge to the client the bytes of a body sent without
+    Content-Length, unknown when the request was admitted.
+    """
+    if g.pop("uncharged_bytes", False):
+        rate_limiter().charge(g.client_key, size)
+
+
+def rate_limiter() -> RateLimiter | None:
+    """Get the rate limiter, None if rate limiting is disabled.
+    """
+    return _load_rate_limiter(
+        app.config.get("RATE_LIMIT_REQUESTS"),
+        app.config.get("RATE_LIMIT_BYTES"),
+        float(app.config.get("RATE_LIMIT_BURST", 10)),
+        app.config.get("CLIENT_WEIGHTS") or "",
+        config_int("WORKER_PROCESSES", 1),
+    )
+
+
+@functools.cache
+def _load_rate_limiter(requests_rate, bytes_rate, burst: float,
+                       weights: str, workers: int) -> RateLimiter | None:
+    """Create the rate limiter once per configuration.
+
+    Rates are shared by the worker processes, each one keeping its own
+    buckets: a client spreading its requests over the workers gets the
+    configured rates in total, at most.
+    """
+    if requests_rate is None and bytes_rate is None:
+        return None
+    workers = max(workers, 1)
+    return RateLimiter(
+        requests_rate=None if requests_rate is None
+        else float(requests_rate) / workers,
+        bytes_rate=None if bytes_rate is None
+        else float(bytes_rate) / workers,
+        burst=burst,
+        weights=parse_weights(weights),
+    )
+
+
+def scan_queue() -> FairQueue | None:
+    """Get the fair queue of scans, None if concurrency is unlimited.
+    """
+    return _load_scan_queue(
+        app.config.get("SCAN_CONCURRENCY"),
+        app.config.get("CLIENT_WEIGHTS") or "",
+    )
+
+
+@functools.cache
+def _load_scan_queue(slots, weights: str) -> FairQueue | None:
+    """Create the fair queue once per configuration.
+    """
+    if slots is None:
+        return None
+    return FairQueue(int(slots), weights=parse_weights(weights))
+
+
+def scan_pipeline() -> ScanPipeline:
+    """Get the scan pipeline.
+    """
+    return _load_scan_pipeline(
+        app.config.get("SCAN_PIPELINE") or DEFAULT_SCAN_PIPELINE,
+        app.config.get("SKIP_TYPES") or "",
+    )
+
+
+# stages of the scan pipeline, by name
+DEFAULT_SCAN_PIPELINE = "hash_lists,sniff,skip_types,archive,clamd"
+SCAN_STAGES = {
+    "hash_lists": lambda skip_types: HashListStage(hash_lists),
+    "sniff": lambda skip_types: SniffStage(),
+    "skip_types": lambda skip_types: SkipTypesStage(skip_types),
+    "archive": lambda skip_types: ArchiveStage(
+        scan_archive_members,
+        lambda: config_bool("ARCHIVE_PARALLEL_SCAN")),
+    "clamd": lambda skip_types: ClamdStage(clamd_instance),
+}
+
+
+@functools.cache
+def _load_scan_pipeline(stages: str, skip_types: str) -> ScanPipeline:
+    """Create the scan pipeline once per configuration.
+    """
+    types = [st.strip() for st in skip_types.split(",") if st.strip()]
+    names = [n.strip() for n in stages.split(",") if n.strip()]
+    unknown = set(names) - set(SCAN_STAGES)
+    if unknown:
+        raise ValueError(f"Unknown scan stages: {', '.join(unknown)}")
+    return ScanPipeline([SCAN_STAGES[n](types) for n in names])
+
+
+def server_timing(ctx: ScanContext) -> str:
+    """Format the stage timings of a scan as Server-Timing header.
+    """
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}"
+                     for name, seconds in ctx.timings.items())
+
+
+def db_monitor() -> DatabaseMonitor | None:
+    """Get the clamd database monitor, None if disabled.
+    """
+    return _load_db_monitor(
+        float(app.config.get("DB_MONITOR_INTERVAL", 60)),
+        app.config.get("WARMUP_CORPUS_DIR"),
+    )
+
+
+@functools.cache
+def _load_db_monitor(interval: float,
+                     corpus_dir: str | None) -> DatabaseMonitor | None:
+    """Create the database monitor once per configuration.
+    """
+    if interval <= 0:
+        return None
+    corpus = load_corpus(corpus_dir) if corpus_dir else builtin_corpus()
+    return DatabaseMonitor(clamd_instance, interval, corpus,
+                           on_change=publish_db_snapshot)
+
+
+def publish_db_snapshot(snapshot) -> None:
+    """Publish the database of clamd in the shared state.
+    """
+    state = sharedstate.attach()
+    if state is not None:
+        # workers poll on their own, keep the newest one seen
+        state.set_max("db_version", snapshot.version or 0)
+
+
+def count_scan(status: ClamdScanStatus, size: int) -> None:
+    """Count a scanned file in the shared state.
+    """
+    state = sharedstate.attach()
+    if state is None:
+        return
+    state.add_all({
+        "scans": 1,
+        "scanned_bytes": size,
+        "scans_found": int(status == ClamdScanStatus.FOUND),
+        "scans_error": int(status not in (ClamdScanStatus.OK,
+                                          ClamdScanStatus.FOUND)),
+    })
+
+
+def db_stamp() -> dict:
+    """Get the signature database of the latest snapshot, for stamping
+    responses.
+    """
+    monitor = db_monitor()
+    snapshot = monitor.snapshot if monitor is not None else None
+    return {
+        "db_version": snapshot.version if snapshot else None,
+        "db_build_date": snapshot.build_date if snapshot else None,
+    }
+
+
+def hash_lists() -> list[HashList]:
+    """Get the configured hash lists, known-bad ones first.
+    """
+    return _load_hash_lists(
+        app.config.get("HASH_ALLOWLIST") or "",
+        app.config.get("HASH_BLOCKLIST") or "",
+        float(app.config.get("HASH_LIST_RELOAD_INTERVAL", 5)),
+    )
+
+
+@functools.cache
+def _load_hash_lists(allowlist: str,
+                     blocklist: str,
+                     reload_interval: float) -> list[HashList]:
+    """Load hash lists once per configuration.
+    """
+    lists = [HashList(p.strip(), trusted=False,
+                      reload_interval=reload_interval)
+             for p in blocklist.split(",") if p.strip()]
+    lists += [HashList(p.strip(), trusted=True,
+                       reload_interval=reload_interval)
+              for p in allowlist.split(",") if p.strip()]
+    return lists
+
+
+def config_bool(env_name: str) -> bool:
+    """Given a config var name, try to parse as boolean.
+    """
+    val = app.config.get(env_name, "false")
+    if isinstance(val, bool):
+        # from_prefixed_env already parsed it as json
+        return val
+    return str(val).strip().lower() in ["true", "1", "enable", "enabled"]
+
+
+def config_int(env_name: str, default: int) -> int:
+    """Given a config var name, try to parse as integer.
+    """
+    val = app.config.get(env_name)
+    if val is None:
+        return default
+    return int(val)
+
+
+##
+# Startup
+##
+
+# load hash lists at startup, so that broken files fail early
+hash_lists()
+# same for rate limiting settings, warm-up corpus and scan pipeline
+rate_limiter()
+scan_queue()
+db_monitor()
+scan_pipeline()
+# all routes are registered by now
+api_spec()
+
+##
+# DEV runner
+##
+
+if __name__ == "__main__":
+    # don't run directly in prod, use a production grade wsgi server
+    # like gunicorn
+    app.run(host="0.0.0.0", port=8080, debug=True)
@@ -0,0 +1,249 @@
+"""State shared by the worker processes through shared memory.
+
+Gunicorn workers are separate processes, so anything service-wide
+(e.g. scan counters) would need IPC.  Instead, the master process
+creates a small file in shared memory (/dev/shm) holding a fixed
+layout of 64-bit integer fields, and each worker maps it on first use:
+reading a field is an aligned 8-byte read from memory, updates are
+serialized by a file lock.
+
+Layout:
+ - header: magic, format version, number of fields, CRC32 of the
+   field names (so that workers running different code refuse to
+   attach)
+ - fields: signed 64-bit integers, native byte order, in FIELDS order
+
+When the segment cannot be attached (e.g. removed, or created by a
+different version), workers fall back to fields in their own memory:
+metrics are never worth failing requests.
+
+Usage with gunicorn (see docker/gunicorn_conf.py):
+.. code-block:: python
+
+    def on_starting(server):
+        os.environ[ENV_PATH] = create()
+
+"""
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+MAGIC = b"CRSS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("=4sIII")
+FIELD = struct.Struct("=q")
+# fields start aligned at 8 bytes after the header
+FIELDS_OFFSET = (HEADER.size + 7) // 8 * 8
+
+#: fields of the shared state, append only
+FIELDS = (
+    "scans",
+    "scans_found",
+    "scans_error",
+    "scanned_bytes",
+    "rate_limited",
+    "db_version",
+)
+_OFFSETS = {name: FIELDS_OFFSET + i * FIELD.size
+            for i, name in enumerate(FIELDS)}
+SIZE = FIELDS_OFFSET + len(FIELDS) * FIELD.size
+LAYOUT_CRC = zlib.crc32(",".join(FIELDS).encode())
+
+#: env variable with the path of the segment, inherited by workers
+ENV_PATH = "CLAMAV_SHARED_STATE_PATH"
+
+
+class SharedStateError(Exception):
+    """Raised when the shared state cannot be created or attached.
+    """
+
+
+class SharedState():
+    """Fields of a shared memory segment.
+    """
+    def __init__(self, path: str):
+        """Map an existing segment.
+
+        :param path: Path of the segment file
+        :raises SharedStateError: if the segment is missing or
+          has a different layout
+        """
+        self.path = path
+        try:
+            self._fd = os.open(path, os.O_RDWR)
+        except OSError as e:
+            raise SharedStateError(f"Unable to open shared state: {e}")
+        try:
+            self._mmap = mmap.mmap(self._fd, SIZE)
+        except (OSError, ValueError) as e:
+            os.close(self._fd)
+            raise SharedStateError(f"Unable to map shared state: {e}")
+        magic, version, count, crc = HEADER.unpack_from(self._mmap, 0)
+        if (magic, version, count, crc) != \
+           (MAGIC, FORMAT_VERSION, len(FIELDS), LAYOUT_CRC):
+            self.close()
+            raise SharedStateError(f"Incompatible shared state at {path}")
+        # file locks are per process, threads need their own lock
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self._mmap.close()
+        os.close(self._fd)
+
+    def get(self, name: str) -> int:
+        """Read a field, without locking.
+        """
+        return FIELD.unpack_from(self._mmap, _OFFSETS[name])[0]
+
+    def set(self, name: str, value: int) -> None:
+        """Write a field.
+        """
+        with self._locked():
+            FIELD.pack_into(self._mmap, _OFFSETS[name], value)
+
+    def add(self, name: str, delta: int = 1) -> int:
+        """Atomically add to a field.
+
+        :return: New value
+        """
+        offset = _OFFSETS[name]
+        with self._locked():
+            value = FIELD.unpack_from(self._mmap, offset)[0] + delta
+            FIELD.pack_into(self._mmap, offset, value)
+        return value
+
+    def add_all(self, deltas: dict[str, int]) -> None:
+        """Atomically add to many fields at once.
+        """
+        with self._locked():
+            for name, delta in deltas.items():
+                offset = _OFFSETS[name]
+                value = FIELD.unpack_from(self._mmap, offset)[0] + delta
+                FIELD.pack_into(self._mmap, offset, value)
+
+    def set_max(self, name: str, value: int) -> None:
+        """Atomically raise a field to at least a value.
+        """
+        offset = _OFFSETS[name]
+        with self._locked():
+            if FIELD.unpack_from(self._mmap, offset)[0] < value:
+                FIELD.pack_into(self._mmap, offset, value)
+
+    def compare_and_set(self, name: str, expected: int, value: int) -> bool:
+        """Atomically write a field if it has the expected value.
+
+        :return: True if the field was written
+        """
+        offset = _OFFSETS[name]
+        with self._locked():
+            if FIELD.unpack_from(self._mmap, offset)[0] != expected:
+                return False
+            FIELD.pack_into(self._mmap, offset, value)
+        return True
+
+    def snapshot(self) -> dict[str, int]:
+        """Read all fields, without locking.
+        """
+        return {name: self.get(name) for name in FIELDS}
+
+    def _locked(self) -> "_Locked":
+        return _Locked(self._lock, self._fd)
+
+
+class LocalState(SharedState):
+    """Fields in the private memory of this process.
+
+    Same interface as SharedState, used when the segment cannot be
+    attached.
+    """
+    def __init__(self):
+        self.path = None
+        self._mmap = mmap.mmap(-1, SIZE, flags=mmap.MAP_PRIVATE)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def _locked(self) -> threading.Lock:
+        return self._lock
+
+
+class _Locked():
+    """Hold the thread lock and the file lock of a segment.
+    """
+    def __init__(self, lock: threading.Lock, fd: int):
+        self._lock = lock
+        self._fd = fd
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def __exit__(self, *args):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+        return False
+
+
+def create(directory: str | None = None) -> str:
+    """Create a zeroed segment.
+
+    :param directory: Directory of the segment file, default /dev/shm
+      if available
+    :return: Path of the segment
+    """
+    if directory is None and os.path.isdir("/dev/shm"):
+        directory = "/dev/shm"
+    fd, path = tempfile.mkstemp(prefix="clamav-rest-", suffix=".state",
+                                dir=directory)
+    try:
+        os.ftruncate(fd, SIZE)
+        os.pwrite(fd, HEADER.pack(MAGIC, FORMAT_VERSION, len(FIELDS),
+                                  LAYOUT_CRC), 0)
+    finally:
+        os.close(fd)
+    return path
+
+
+_attached: SharedState | None = None
+_attached_pid: int | None = None
+_attach_lock = threading.Lock()
+
+
+def attach(path: str | None = None) -> SharedState | None:
+    """Get the segment of the service, mapping it on first use.
+
+    If the segment cannot be attached, the error is logged once and
+    the process falls back to a LocalState.
+
+    :param path: Path of the segment, default from ENV_PATH
+    :return: Shared state, None if no segment was created
+    """
+    global _attached, _attached_pid
+    if _attached_pid == os.getpid():
+        return _attached
+    path = path or os.environ.get(ENV_PATH)
+    with _attach_lock:
+        if _attached_pid != os.getpid():
+            _attached = _attach(path) if path else None
+            _attached_pid = os.getpid()
+    return _attached
+
+
+def _attach(path: str) -> SharedState:
+    try:
+        return SharedState(path)
+    except SharedStateError as e:
+        logging.error("%s, counting in this process only", str(e))
+        return LocalState()
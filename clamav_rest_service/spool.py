@@ -0,0 +1,104 @@
+"""Spooling of uploaded files.
+
+Uploaded files are spooled by the form parser before being scanned:
+in memory up to a threshold, then in an anonymous file in the spool
+directory (e.g. a tmpfs mount).  Every byte spooled is charged to a
+budget shared by the concurrent requests of the worker process, so
+that a burst of large uploads cannot fill the disk or the memory of
+the container: when the budget is exhausted the request is rejected.
+
+"""
+import tempfile
+import threading
+
+from werkzeug.exceptions import ServiceUnavailable
+
+# seconds a client should wait before retrying when budget is exhausted
+RETRY_AFTER = 5
+
+
+class SpoolBudget():
+    """Bytes spooled by the concurrent requests of the process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+        self.rejected = 0
+
+    def reserve(self, size: int, limit: int | None) -> None:
+        """Charge bytes to the budget.
+
+        :param size: Bytes to charge
+        :param limit: Total budget in bytes, None for unlimited
+        :raises ServiceUnavailable: if the budget is exhausted
+        """
+        with self._lock:
+            if limit is not None and self.current + size > limit:
+                self.rejected += 1
+                raise ServiceUnavailable(
+                    "Upload spool budget exhausted, retry later",
+                    retry_after=RETRY_AFTER)
+            self.current += size
+            self.peak = max(self.peak, self.current)
+
+    def release(self, size: int) -> None:
+        """Give bytes back to the budget.
+        """
+        with self._lock:
+            self.current -= size
+
+    def stats(self) -> dict[str, int]:
+        """Get spool usage stats.
+        """
+        with self._lock:
+            return {
+                "current_bytes": self.current,
+                "peak_bytes": self.peak,
+                "rejected": self.rejected,
+            }
+
+
+#: budget of the running process
+budget = SpoolBudget()
+
+
+class SpoolFile(tempfile.SpooledTemporaryFile):
+    """Spooled temporary file charging written bytes to the budget.
+    """
+    def __init__(self,
+                 max_size: int,
+                 dir: str | None,
+                 budget_limit: int | None,
+                 spool_budget: SpoolBudget = budget):
+        """Create a spool file.
+
+        :param max_size: Bytes kept in memory before rolling over to disk
+        :param dir: Directory of the file on disk, None for the default
+        :param budget_limit: Total budget in bytes, None for unlimited
+        :param spool_budget: Budget to charge
+        """
+        super().__init__(max_size=max_size, mode="w+b", dir=dir)
+        self._budget = spool_budget
+        self._budget_limit = budget_limit
+        self._charged = 0
+
+    def write(self, s) -> int:
+        size = len(s)
+        try:
+            self._budget.reserve(size, self._budget_limit)
+        except ServiceUnavailable:
+            # the form parser won't hand this file over, release it now
+            self.close()
+            raise
+        self._charged += size
+        return super().write(s)
+
+    # NOTE: files left unclosed (e.g. on form parsing errors) are
+    # closed, and released, by SpooledTemporaryFile.__del__
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self._budget.release(self._charged)
+            self._charged = 0
@@ -0,0 +1,218 @@
+"""Request wrapper for the REST service.
+
+Uploaded files are spooled as configured by the app (see spool module
+for details).
+
+Scan requests can be sent with a compressed body by setting the
+Content-Encoding header.  The body is decompressed incrementally while
+it is read (either by the form parser or directly by the clamd client),
+it is never held in memory as a whole.
+
+Supported encodings:
+ - gzip and deflate (standard library)
+ - zstd (requires the `zstandard` package)
+ - br (requires the `brotli` package)
+
+"""
+import io
+import typing as t
+import zlib
+
+from flask import Request, current_app
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, \
+    UnsupportedMediaType
+from werkzeug.utils import cached_property
+
+from .spool import SpoolFile
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# size of compressed data read from the request at once
+READ_CHUNK_SIZE = 64 * 1024
+
+# as StreamMaxLength in the bundled clamd.conf
+DEFAULT_MAX_DECOMPRESSED_SIZE = 2024 * 1024 * 1024
+# as werkzeug default
+DEFAULT_SPOOL_MEMORY_THRESHOLD = 500 * 1024
+
+# errors raised by decoders on corrupted data
+DECODE_ERRORS: tuple[type[Exception], ...] = (zlib.error, EOFError)
+if zstandard is not None:
+    DECODE_ERRORS += (zstandard.ZstdError,)
+if brotli is not None:
+    DECODE_ERRORS += (brotli.error,)
+
+
+class _ZlibDecoder():
+    """gzip and deflate decoder.
+    """
+    def __init__(self, source: t.IO[bytes], wbits: int):
+        self._source = source
+        self._wbits = wbits
+        self._obj = zlib.decompressobj(wbits)
+
+    def read(self, size: int) -> bytes:
+        while True:
+            if self._obj.eof:
+                # gzip allows concatenated members
+                data = self._obj.unused_data or \
+                    self._source.read(READ_CHUNK_SIZE)
+                if not data:
+                    return b""
+                self._obj = zlib.decompressobj(self._wbits)
+            else:
+                data = self._obj.unconsumed_tail or \
+                    self._source.read(READ_CHUNK_SIZE)
+                if not data:
+                    raise zlib.error("Truncated compressed data")
+            # bound the output, a small input can expand a lot
+            out = self._obj.decompress(data, size)
+            if out:
+                return out
+
+
+class _ZstdDecoder():
+    """zstd decoder.
+    """
+    def __init__(self, source: t.IO[bytes]):
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            source, read_size=READ_CHUNK_SIZE, read_across_frames=True)
+
+    def read(self, size: int) -> bytes:
+        return self._reader.read(size)
+
+
+class _BrotliDecoder():
+    """brotli decoder.
+    """
+    def __init__(self, source: t.IO[bytes]):
+        self._source = source
+        self._obj = brotli.Decompressor()
+
+    def read(self, size: int) -> bytes:
+        while True:
+            if self._obj.can_accept_more_data():
+                if self._obj.is_finished():
+                    return b""
+                data = self._source.read(READ_CHUNK_SIZE)
+                if not data:
+                    raise brotli.error("Truncated compressed data")
+            else:
+                # drain output buffered from the previous input
+                data = b""
+            out = self._obj.process(data, output_buffer_limit=size)
+            if out:
+                return out
+
+
+def _make_decoder(encoding: str, source: t.IO[bytes]):
+    """Get the decoder for a content encoding.
+
+    :raises UnsupportedMediaType: if the encoding is not supported
+    """
+    match encoding:
+        case "gzip" | "x-gzip":
+            return _ZlibDecoder(source, 16 + zlib.MAX_WBITS)
+        case "deflate":
+            return _ZlibDecoder(source, zlib.MAX_WBITS)
+        case "zstd" if zstandard is not None:
+            return _ZstdDecoder(source)
+        case "br" if brotli is not None:
+            return _BrotliDecoder(source)
+    raise UnsupportedMediaType(
+        f"Unsupported Content-Encoding: {encoding}")
+
+
+class DecompressingStream(io.RawIOBase):
+    """Read-only stream decompressing another stream on the fly.
+    """
+    def __init__(self,
+                 source: t.IO[bytes],
+                 encoding: str,
+                 max_size: int | None = None):
+        """Wrap a compressed stream.
+
+        :param source: Compressed input stream
+        :param encoding: Content-Encoding of the source
+        :param max_size: Max decompressed size, None for unlimited
+        :raises UnsupportedMediaType: if the encoding is not supported
+        """
+        self._decoder = _make_decoder(encoding, source)
+        self.encoding = encoding
+        self.max_size = max_size
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        try:
+            data = self._decoder.read(len(b))
+        except DECODE_ERRORS as e:
+            raise BadRequest(f"Invalid {self.encoding} content: {e}")
+
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge(
+                f"Decompressed content larger than {self.max_size} bytes")
+
+        b[:len(data)] = data
+        return len(data)
+
+
+class ScanRequest(Request):
+    """Request accepting compressed bodies, with configurable spooling.
+
+    When the request comes with a Content-Encoding header, `stream`
+    (and thus form parsing) yields the decompressed body.
+
+    Uploaded files are spooled according to the SPOOL_DIR,
+    SPOOL_MEMORY_THRESHOLD and SPOOL_BUDGET config of the app.
+    """
+    @property
+    def max_decompressed_size(self) -> int | None:
+        """Max size of a decompressed body, None for unlimited.
+
+        Read from the MAX_DECOMPRESSED_SIZE config of the app.
+        """
+        if not current_app:
+            return None
+        size = current_app.config.get("MAX_DECOMPRESSED_SIZE",
+                                      DEFAULT_MAX_DECOMPRESSED_SIZE)
+        return int(size) if size is not None else None
+
+    @cached_property
+    def stream(self) -> t.IO[bytes]:
+        stream = super().stream
+        encodings = [e.strip().lower()
+                     for e in (self.content_encoding or "").split(",")]
+        encodings = [e for e in encodings if e and e != "identity"]
+
+        # decode in the reverse order encodings were applied
+        for enc in reversed(encodings):
+            stream = io.BufferedReader(DecompressingStream(
+                stream, enc, max_size=self.max_decompressed_size))
+        return stream
+
+    def _get_file_stream(self,
+                         total_content_length: int | None,
+                         content_type: str | None,
+                         filename: str | None = None,
+                         content_length: int | None = None) -> t.IO[bytes]:
+        config = current_app.config
+        threshold = config.get("SPOOL_MEMORY_THRESHOLD",
+                               DEFAULT_SPOOL_MEMORY_THRESHOLD)
+        budget = config.get("SPOOL_BUDGET")
+        return SpoolFile(
+            max_size=int(threshold),
+            dir=config.get("SPOOL_DIR"),
+            budget_limit=int(budget) if budget is not None else None,
+        )
@@ -0,0 +1,58 @@
+"""Gunicorn configuration of the ClamAV REST service.
+
+Creates the shared state of the workers in the master process, and
+tells them how many they are (CLAMAV_WORKER_PROCESSES).  The
+sharedstate module is loaded from its file, so that the package (and
+with it the Flask app and its configuration) is not imported by the
+master: workers build the app on their own, and pick up new code and
+configuration when reloaded.
+
+Usage:
+.. code-block:: shell
+
+    gunicorn -c docker/gunicorn_conf.py \\
+        -b 0.0.0.0:80 -w 3 clamav_rest_service:app
+
+"""
+import importlib.util
+import os
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "clamav_rest_service")
+
+
+def load_sharedstate_module():
+    """Load clamav_rest_service/sharedstate.py as a standalone module.
+    """
+    spec = importlib.util.spec_from_file_location(
+        "clamav_rest_sharedstate",
+        os.path.join(PACKAGE_DIR, "sharedstate.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+sharedstate = load_sharedstate_module()
+
+
+def on_starting(server):
+    """Create the shared state segment and tell the number of workers,
+    inherited by the workers.
+    """
+    path = sharedstate.create(os.environ.get("CLAMAV_SHARED_STATE_DIR"))
+    os.environ[sharedstate.ENV_PATH] = path
+    server.log.info("Shared state at %s", path)
+    # per worker rate limits
+    os.environ.setdefault("CLAMAV_WORKER_PROCESSES",
+                          str(server.cfg.workers))
+
+
+def on_exit(server):
+    """Remove the shared state segment.
+    """
+    path = os.environ.pop(sharedstate.ENV_PATH, None)
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
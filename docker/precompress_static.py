@@ -0,0 +1,47 @@
+"""Precompress the static files of the ClamAV REST service.
+
+Run when the Docker images are built.  The assets module is loaded
+from its file, so that the package (and with it the Flask app and its
+configuration) is not imported.
+
+Brotli variants need the `brotli` extra: without it, the script fails
+unless --gzip-only is given.
+
+Usage: python docker/precompress_static.py [--gzip-only] [directory]
+
+"""
+import argparse
+import importlib.util
+import os
+import sys
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, "clamav_rest_service")
+
+
+def load_assets_module():
+    """Load clamav_rest_service/assets.py as a standalone module.
+    """
+    spec = importlib.util.spec_from_file_location(
+        "clamav_rest_assets", os.path.join(PACKAGE_DIR, "assets.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompress the static files of the service.")
+    parser.add_argument("directory", nargs="?",
+                        default=os.path.join(PACKAGE_DIR, "static"),
+                        help="static directory (default: the package one)")
+    parser.add_argument("--gzip-only", action="store_true",
+                        help="don't fail if brotli is not installed")
+    args = parser.parse_args()
+
+    assets = load_assets_module()
+    if assets.brotli is None and not args.gzip_only:
+        sys.exit("brotli is not installed (install the brotli extra), "
+                 "use --gzip-only to write gzip variants only")
+    for written in assets.precompress(args.directory):
+        print(f"Written {written}")
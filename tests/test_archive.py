@@ -0,0 +1,111 @@
+import gzip
+import io
+import tarfile
+import zipfile
+
+import pytest
+from clamav_rest_service.archive import ArchiveError, \
+    ArchiveLimitExceeded, ArchiveLimits, _Budget, detect_archive, \
+    iter_members, scan_archive
+from clamav_rest_service.clamd import ClamdUnixSocket, ClamdScanStatus
+
+INFECTED = br"X5O!P%@AP[4\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"  # noqa: E501
+
+
+def make_zip(members: dict[str, bytes]) -> io.BytesIO:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    buf.seek(0)
+    return buf
+
+
+def make_tar(members: dict[str, bytes], mode: str = "w") -> io.BytesIO:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tf:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    return buf
+
+
+def test_detect_archive():
+    assert detect_archive(make_zip({"a": b"a"})) == "zip"
+    assert detect_archive(make_tar({"a": b"a"})) == "tar"
+    assert detect_archive(make_tar({"a": b"a"}, mode="w:gz")) == "tar"
+    assert detect_archive(io.BytesIO(gzip.compress(b"plain"))) is None
+    assert detect_archive(io.BytesIO(b"plain")) is None
+
+
+def test_iter_members_nested():
+    inner = make_tar({"inner.txt": b"inner"}, mode="w:gz").getvalue()
+    archive = make_zip({"outer.txt": b"outer", "inner.tar.gz": inner})
+
+    budget = _Budget(ArchiveLimits())
+    members = {name: s.read() for name, s in iter_members(archive, budget)}
+
+    assert members == {
+        "outer.txt": b"outer",
+        "inner.tar.gz/inner.txt": b"inner",
+    }
+
+
+def test_iter_members_limits():
+    archive = make_zip({f"file{i}": b"x" for i in range(10)})
+    budget = _Budget(ArchiveLimits(max_members=5))
+    with pytest.raises(ArchiveLimitExceeded):
+        for _, s in iter_members(archive, budget):
+            s.read()
+
+    archive = make_zip({"bomb": b"\x00" * 1024 * 1024})
+    budget = _Budget(ArchiveLimits(max_expanded_size=1024))
+    with pytest.raises(ArchiveLimitExceeded):
+        for _, s in iter_members(archive, budget):
+            s.read()
+
+
+# require running clamd daemon
+
+def test_scan_archive_infected():
+    archive = make_zip({
+        "clean.txt": b"clean",
+        "dir/infected.txt": INFECTED,
+    })
+
+    result = scan_archive(archive,
+                          lambda: ClamdUnixSocket("/tmp/clamd.sock"),
+                          ArchiveLimits(),
+                          workers=2)
+
+    assert result.status == ClamdScanStatus.FOUND
+    assert result.virus == "Win.Test.EICAR_HDB-1"
+    assert result.details == ["dir/infected.txt: Win.Test.EICAR_HDB-1 FOUND"]
+
+
+def test_scan_archive_corrupt_member():
+    data = b"x" * (1100 * 1024)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+        zf.writestr("clean.txt", b"clean")
+        zf.writestr("large.bin", data)
+    corrupt = bytearray(archive.getvalue())
+    corrupt[corrupt.index(data) + len(data) // 2] ^= 0xff
+
+    # the CRC fails while the member is streamed to clamd
+    with pytest.raises(ArchiveError, match="Bad CRC-32"):
+        scan_archive(io.BytesIO(corrupt),
+                     lambda: ClamdUnixSocket("/tmp/clamd.sock"),
+                     ArchiveLimits(),
+                     workers=2)
+
+
+def test_scan_archive_not_archive():
+    result = scan_archive(io.BytesIO(b"plain"),
+                          lambda: ClamdUnixSocket("/tmp/clamd.sock"),
+                          ArchiveLimits(),
+                          workers=2)
+
+    assert result is None
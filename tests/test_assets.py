@@ -0,0 +1,30 @@
+import gzip
+
+from clamav_rest_service.assets import StaticAssets, precompress
+
+
+def test_precompressed_variants(tmp_path, test_app):
+    content = b"body { color: red; }\n" * 100
+    (tmp_path / "styles.css").write_bytes(content)
+    assert str(tmp_path / "styles.css.gz") in precompress(str(tmp_path))
+    # up to date variants are not written again
+    assert str(tmp_path / "styles.css.gz") not in precompress(str(tmp_path))
+
+    assets = StaticAssets(str(tmp_path))
+    version = assets.version("styles.css")
+    with test_app.test_request_context():
+        resp = assets.send("styles.css", {"gzip"}, version)
+        resp.direct_passthrough = False
+
+        assert resp.content_encoding == "gzip"
+        assert resp.mimetype == "text/css"
+        assert "Accept-Encoding" in resp.vary
+        assert resp.cache_control.immutable
+        assert gzip.decompress(resp.get_data()) == content
+
+        resp = assets.send("styles.css", set(), "stale")
+        resp.direct_passthrough = False
+
+        assert resp.content_encoding is None
+        assert resp.cache_control.no_cache
+        assert resp.get_data() == content
@@ -0,0 +1,113 @@
+import socket
+
+import pytest
+from clamav_rest_service.clamd import ClamdException, ClamdScanStatus, \
+    ClamdUnixSocket
+from clamav_rest_service.clamd.client import ClamdReplyReader, \
+    single_record, stats_end
+
+
+def reader_for(data: bytes, max_reply_size: int = 1024 * 1024):
+    server, client = socket.socketpair()
+    server.sendall(data)
+    server.close()
+    return ClamdReplyReader(client, b"\x00", buffer_size=16,
+                            max_reply_size=max_reply_size)
+
+
+def test_records():
+    long_record = b"x" * 5000
+    reader = reader_for(b"first\x00" + long_record + b"\x00\x00tail")
+
+    assert list(reader.records()) == \
+        ["first", long_record.decode(), "", "tail"]
+
+
+def test_records_end_without_close():
+    server, client = socket.socketpair()
+    client.settimeout(1)
+    reader = ClamdReplyReader(client, b"\x00", buffer_size=16,
+                              max_reply_size=1024)
+    try:
+        # replies end at their last record, the connection stays open
+        server.sendall(b"PONG\x00")
+        assert list(reader.records(single_record)) == ["PONG"]
+        server.sendall(b"POOLS: 1\n\nSTATE: VALID PRIMARY\nEND\x00")
+        assert list(reader.records(stats_end)) == \
+            ["POOLS: 1\n\nSTATE: VALID PRIMARY\nEND"]
+        server.sendall(b"POOLS: 1\nEND\x00")
+        assert list(reader.records(stats_end)) == ["POOLS: 1\nEND"]
+    finally:
+        server.close()
+        client.close()
+
+
+def test_commands_on_open_connection():
+    server, client = socket.socketpair()
+    client.settimeout(1)
+    clamd = ClamdUnixSocket("/tmp/clamd.sock")
+    clamd._get_connection = lambda: client
+    try:
+        server.sendall(b"PONG\x00stream: OK\x00")
+        with clamd:
+            assert clamd.ping().message == "PONG"
+            assert clamd.instream_result().status == ClamdScanStatus.OK
+    finally:
+        server.close()
+
+
+def test_max_reply_size():
+    reader = reader_for(b"a" * 100 + b"\x00" + b"b" * 100 + b"\x00",
+                        max_reply_size=150)
+    records = reader.records()
+
+    assert next(records) == "a" * 100
+    with pytest.raises(ClamdException):
+        next(records)
+
+
+def test_max_reply_size_unterminated():
+    reader = reader_for(b"a" * 5000, max_reply_size=1000)
+
+    with pytest.raises(ClamdException):
+        list(reader.records())
+
+
+def test_parse_scan_result():
+    clamd = ClamdUnixSocket("/tmp/clamd.sock")
+    result = clamd._parse_scan_result(
+        iter(["stream: Win.Test.EICAR_HDB-1 FOUND", "", "more"]))
+
+    assert result.status == ClamdScanStatus.FOUND
+    assert result.virus == "Win.Test.EICAR_HDB-1"
+    assert result.details == ["more"]
+    assert result.raw_data == \
+        "stream: Win.Test.EICAR_HDB-1 FOUND\x00more\x00"
+
+
+@pytest.mark.parametrize("message, status, virus", [
+    ("stream: OK", ClamdScanStatus.OK, None),
+    ("stream: Win.Test.EICAR_HDB-1 FOUND", ClamdScanStatus.FOUND,
+     "Win.Test.EICAR_HDB-1"),
+    ("/tmp/file: Win.Test.EICAR_HDB-1 FOUND", ClamdScanStatus.FOUND,
+     "Win.Test.EICAR_HDB-1"),
+    ("stream: Some error ERROR", ClamdScanStatus.ERROR, None),
+])
+def test_parse_scan_result_without_raw_data(message, status, virus):
+    clamd = ClamdUnixSocket("/tmp/clamd.sock", keep_raw_data=False)
+    result = clamd._parse_scan_result(iter([message]))
+
+    assert result.status == status
+    assert result.virus == virus
+    assert result.input_file == message.split(":")[0]
+    assert result.raw_data is None
+    assert str(result) == message
+    assert not hasattr(result, "__dict__")
+
+
+def test_parse_error_keeps_raw_data():
+    clamd = ClamdUnixSocket("/tmp/clamd.sock", keep_raw_data=False)
+    result = clamd._parse_scan_result(iter(["garbage"]))
+
+    assert result.status == ClamdScanStatus.CLIENT_PARSE_ERROR
+    assert result.raw_data == "garbage\x00"
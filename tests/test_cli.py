@@ -0,0 +1,83 @@
+import hashlib
+import io
+import json
+import subprocess
+import sys
+
+from clamav_rest_service.cli import HashingReader, main
+
+INFECTED = br"X5O!P%@AP[4\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"  # noqa: E501
+
+
+# require running clamd daemon
+
+def test_bulk_scan_resume(tmp_path):
+    files = tmp_path / "files"
+    (files / "sub").mkdir(parents=True)
+    (files / "clean.txt").write_bytes(b"clean")
+    (files / "sub" / "infected.txt").write_bytes(INFECTED)
+    output = tmp_path / "results.ndjson"
+
+    exit_code = main(["--socket", "/tmp/clamd.sock", "-w", "2", "-q",
+                      "-o", str(output), str(files)])
+
+    assert exit_code == 1
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    statuses = {r["path"]: r["status"] for r in records}
+    assert statuses == {
+        str(files / "clean.txt"): "OK",
+        str(files / "sub" / "infected.txt"): "FOUND",
+    }
+
+    # only the new file is scanned on resume
+    (files / "new.txt").write_bytes(b"new")
+    exit_code = main(["--socket", "/tmp/clamd.sock", "-q", "--resume",
+                      "-o", str(output), str(files)])
+
+    assert exit_code == 0
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert len(records) == 3
+    assert records[-1]["path"] == str(files / "new.txt")
+    assert records[-1]["sha256"] == hashlib.sha256(b"new").hexdigest()
+
+    # a copy of a scanned file gets a record with its known verdict,
+    # without being scanned (clamd is not reachable)
+    (files / "copy.txt").write_bytes(INFECTED)
+    exit_code = main(["--socket", "/tmp/missing.sock", "-q", "--resume",
+                      "-o", str(output), str(files)])
+
+    assert exit_code == 1
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert len(records) == 4
+    assert records[-1]["path"] == str(files / "copy.txt")
+    assert records[-1]["status"] == "FOUND"
+    assert records[-1]["virus"] == "Win.Test.EICAR_HDB-1"
+
+
+def test_hashing_reader():
+    content = bytes(range(256)) * 100
+    reader = HashingReader(io.BytesIO(content))
+
+    # measured, read in part, then rewound as for a retry
+    assert reader.seek(0, io.SEEK_END) == len(content)
+    reader.seek(0)
+    assert reader.read(1000) == content[:1000]
+    reader.seek(0)
+    assert reader.read() == content
+    assert reader.digest() == (hashlib.sha256(content).hexdigest(),
+                               len(content))
+
+    # not read to the end
+    reader = HashingReader(io.BytesIO(content))
+    reader.read(10)
+    assert reader.digest()[0] == hashlib.sha256(content).hexdigest()
+
+
+def test_import_without_server():
+    # the service configuration of the environment doesn't matter
+    code = ("import sys\n"
+            "import clamav_rest_service.cli\n"
+            "assert 'flask' not in sys.modules\n")
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   env={"CLAMAV_HASH_ALLOWLIST": "/nonexistent",
+                        "CLAMAV_SKIP_TYPES": "text/plain"})
@@ -0,0 +1,95 @@
+import http.server
+import io
+import json
+import subprocess
+import sys
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+from clamav_rest_service.clamd import ClamdScanStatus
+from clamav_rest_service.client import ClamavRestClient, ClamavRestError
+
+
+@pytest.fixture()
+def server_url(test_app):
+    server = make_server("127.0.0.1", 0, test_app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield f"http://127.0.0.1:{server.port}"
+    server.shutdown()
+    thread.join()
+
+
+class BusyHandler(http.server.BaseHTTPRequestHandler):
+    """Reject the first request with 429, then answer OK."""
+    protocol_version = "HTTP/1.1"
+    requests = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        type(self).requests += 1
+        if type(self).requests == 1:
+            status, data = 429, {"error": "Rate limit exceeded"}
+        else:
+            status, data = 200, {"status": "OK", "file_size": len(body)}
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_scan(server_url):
+    with ClamavRestClient(server_url) as client:
+        result = client.scan("tests/assets/testfile.txt")
+        assert result.status == ClamdScanStatus.OK
+        assert result.input_file == "tests/assets/testfile.txt"
+
+        # unseekable streams are sent chunked
+        stream = io.BufferedReader(io.BytesIO(b"hello"))
+        stream.seekable = lambda: False
+        assert client.scan(stream).status == ClamdScanStatus.OK
+
+
+def test_scan_many(server_url):
+    files = [b"file %d" % i for i in range(20)] + ["/does/not/exist"]
+    with ClamavRestClient(server_url, pool_size=4) as client:
+        results = list(client.scan_many(files, workers=4))
+
+    assert [f for f, _ in results] == files
+    assert all(r.status == ClamdScanStatus.OK for _, r in results[:-1])
+    assert isinstance(results[-1][1], FileNotFoundError)
+
+
+def test_retry_after():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BusyHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}"
+        with ClamavRestClient(url) as client:
+            assert client.scan(b"hello").status == ClamdScanStatus.OK
+            assert BusyHandler.requests == 2
+
+        BusyHandler.requests = 0
+        with ClamavRestClient(url, max_retries=0) as client:
+            with pytest.raises(ClamavRestError) as e:
+                client.scan(b"hello")
+            assert e.value.status == 429
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def test_import_without_server():
+    # a broken service configuration doesn't matter to clients
+    code = ("import sys\n"
+            "import clamav_rest_service.client\n"
+            "assert 'flask' not in sys.modules\n")
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   env={"CLAMAV_HASH_ALLOWLIST": "/nonexistent"})
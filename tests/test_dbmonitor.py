@@ -0,0 +1,92 @@
+from clamav_rest_service.clamd import ClamdScanResult, ClamdScanStatus
+from clamav_rest_service.clamd.types import ClamdCmdResponse
+from clamav_rest_service.dbmonitor import DatabaseMonitor, \
+    DatabaseSnapshot, builtin_corpus, load_corpus
+
+
+class FakeClamd():
+    version_message = "ClamAV 1.4.2/27450/Mon Oct 14 08:35:41 2024"
+    scanned = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def version(self):
+        return ClamdCmdResponse(raw_data="", message=self.version_message,
+                                details=[])
+
+    def instream(self, stream):
+        self.scanned.append(stream.read())
+        return ClamdScanResult(raw_data="", message="stream: OK", details=[],
+                               input_file="stream",
+                               status=ClamdScanStatus.OK)
+
+
+def test_parse_version():
+    snapshot = DatabaseSnapshot.parse(FakeClamd.version_message)
+
+    assert snapshot.engine == "ClamAV 1.4.2"
+    assert snapshot.version == 27450
+    assert snapshot.build_date == "2024-10-14T08:35:41"
+    assert not snapshot.ready
+
+    # no database loaded
+    snapshot = DatabaseSnapshot.parse("ClamAV 1.4.2")
+    assert snapshot.version is None
+    assert snapshot.build_date is None
+
+
+def test_warm_up_on_database_change(tmp_path):
+    (tmp_path / "sample.txt").write_bytes(b"sample")
+    FakeClamd.scanned = []
+    monitor = DatabaseMonitor(FakeClamd, 60, load_corpus(str(tmp_path)))
+
+    snapshot = monitor.poll()
+    assert snapshot.ready
+    assert snapshot.version == 27450
+    assert FakeClamd.scanned == [b"sample"]
+
+    # same database, no warm-up
+    monitor.poll()
+    assert len(FakeClamd.scanned) == 1
+
+    clamd = FakeClamd()
+    clamd.version_message = "ClamAV 1.4.2/27451/Tue Oct 15 08:35:41 2024"
+    monitor.clamd_factory = lambda: clamd
+    snapshot = monitor.poll()
+    assert snapshot.version == 27451
+    assert len(FakeClamd.scanned) == 2
+
+
+def test_not_ready_when_unreachable(tmp_path):
+    (tmp_path / "sample.txt").write_bytes(b"sample")
+    FakeClamd.scanned = []
+    published = []
+    monitor = DatabaseMonitor(FakeClamd, 60, load_corpus(str(tmp_path)),
+                              on_change=published.append)
+    monitor.poll()
+
+    def unreachable():
+        raise OSError("No such file or directory")
+
+    monitor.clamd_factory = unreachable
+    # a single failed poll of the thread
+    monitor.stop()
+    monitor._run()
+    assert not monitor.snapshot.ready
+    assert monitor.snapshot.version == 27450
+    assert not published[-1].ready
+
+    # back with the same database, warmed up again
+    monitor.clamd_factory = FakeClamd
+    assert monitor.poll().ready
+    assert len(FakeClamd.scanned) == 2
+
+
+def test_builtin_corpus():
+    names = [name for name, content in builtin_corpus() if content]
+    assert "lorem.zip" in names
+    assert "empty.pdf" in names
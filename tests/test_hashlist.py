@@ -0,0 +1,59 @@
+import hashlib
+import io
+import os
+
+from clamav_rest_service.hashlist import HashList, digest_stream
+
+INFECTED = br"X5O!P%@AP[4\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"  # noqa: E501
+
+
+def test_known_bad_hdb(tmp_path):
+    hdb = tmp_path / "test.hdb"
+    hdb.write_text("# comment\n"
+                   "44d88612fea8a8f36de82e1278abb02f:68:EICAR-Test-Signature\n"
+                   "not-a-hash:0:Broken\n")
+    hl = HashList(str(hdb), trusted=False)
+
+    assert hl.algorithms == {"md5"}
+    digests = digest_stream(io.BytesIO(INFECTED), hl.algorithms)
+    assert hl.lookup(digests) == (True, "EICAR-Test-Signature")
+    digests = digest_stream(io.BytesIO(b"clean"), hl.algorithms)
+    assert hl.lookup(digests) == (False, None)
+
+
+def test_trusted_sha256_only(tmp_path):
+    clean = b"signed installer"
+    sha256 = hashlib.sha256(clean).hexdigest()
+    md5 = hashlib.md5(clean).hexdigest()
+    allowlist = tmp_path / "trusted.sha256"
+    allowlist.write_text(f"{sha256}  installer.msi\n{md5}  installer.msi\n")
+    hl = HashList(str(allowlist), trusted=True)
+
+    assert hl.algorithms == {"sha256"}
+    assert hl.lookup({"sha256": hashlib.sha256(clean).digest()}) == \
+        (True, None)
+    assert hl.lookup({"md5": hashlib.md5(clean).digest()}) == (False, None)
+
+
+def test_reload_on_change(tmp_path):
+    allowlist = tmp_path / "trusted.sha256"
+    allowlist.write_text("")
+    hl = HashList(str(allowlist), trusted=True, reload_interval=0)
+    digests = {"sha256": hashlib.sha256(b"new").digest()}
+    assert hl.lookup(digests) == (False, None)
+
+    allowlist.write_text(hashlib.sha256(b"new").hexdigest() + "\n")
+    # make sure mtime changes on coarse-grained filesystems
+    st = os.stat(allowlist)
+    os.utime(allowlist, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    assert hl.lookup(digests) == (True, None)
+
+
+def test_digest_stream_restores_position():
+    stream = io.BytesIO(b"some data")
+    digests = digest_stream(stream, ["sha256", "md5"])
+
+    assert stream.tell() == 0
+    assert digests["sha256"] == hashlib.sha256(b"some data").digest()
+    assert digests["md5"] == hashlib.md5(b"some data").digest()
@@ -1,5 +1,9 @@
+import base64
+import gzip
+import hashlib
 import io
 
+import pytest
 from werkzeug.datastructures import FileStorage
 
 
@@ -87,3 +91,227 @@ def test_scan_infected(client):
     assert resp_d["input_file"] == "infected"
     assert "raw_data" not in resp_d
     assert not resp_d["details"]
+
+
+@pytest.fixture
+def blocklist(client, tmp_path):
+    path = tmp_path / "known-bad.sha256"
+    path.write_text(hashlib.sha256(b"known bad").hexdigest() + "\n")
+    client.application.config["HASH_BLOCKLIST"] = str(path)
+    yield path
+    del client.application.config["HASH_BLOCKLIST"]
+
+
+def test_scan_hash_blocklist(client, blocklist):
+    file_to_analyze = FileStorage(
+        stream=io.BytesIO(b"known bad"),
+        filename="known-bad"
+    )
+
+    resp = client.post("/api/v1/clamav/scan",
+                       data={"file": file_to_analyze},
+                       content_type="multipart/form-data")
+
+    assert resp.status_code == 200
+    resp_d = resp.json
+
+    assert resp_d["status"] == "FOUND"
+    assert resp_d["virus"] == "KnownBad.Hash"
+    assert resp_d["hash_list"] == "known-bad.sha256"
+
+
+@pytest.mark.parametrize("encoding", [None, "gzip"])
+def test_scan_body_hash_blocklist(client, blocklist, encoding):
+    body = b"known bad"
+    headers = {}
+    if encoding:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = encoding
+
+    # request bodies are looked up once streamed to clamd
+    resp = client.post("/api/v1/clamav/scan", data=body, headers=headers,
+                       content_type="application/octet-stream")
+
+    assert resp.status_code == 200
+    resp_d = resp.json
+
+    assert resp_d["status"] == "FOUND"
+    assert resp_d["virus"] == "KnownBad.Hash"
+    assert resp_d["hash_list"] == "known-bad.sha256"
+
+
+def test_scan_json_hash_blocklist(client, blocklist):
+    resp = client.post("/api/v1/clamav/scan/json", json={"files": [
+        {"name": "clean", "content": base64.b64encode(b"clean").decode()},
+        {"name": "known-bad",
+         "content": base64.b64encode(b"known bad").decode()},
+    ]})
+
+    assert resp.status_code == 200
+    resp_d = resp.json
+
+    assert resp_d["status"] == "FOUND"
+    assert resp_d["files"][0]["status"] == "OK"
+    assert resp_d["files"][1]["status"] == "FOUND"
+    assert resp_d["files"][1]["virus"] == "KnownBad.Hash"
+
+
+def test_scan_gzip_body(client):
+    infected = br"X5O!P%@AP[4\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"  # noqa: E501
+
+    resp = client.post("/api/v1/clamav/scan",
+                       data=gzip.compress(infected),
+                       headers={"Content-Encoding": "gzip"},
+                       content_type="application/octet-stream")
+
+    assert resp.status_code == 200
+    resp_d = resp.json
+
+    assert resp_d["status"] == "FOUND"
+    assert resp_d["virus"] == "Win.Test.EICAR_HDB-1"
+    assert resp_d["file_size"] == len(infected)
+
+
+def test_scan_json(client):
+    infected = br"X5O!P%@AP[4\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"  # noqa: E501
+
+    resp = client.post("/api/v1/clamav/scan/json", json={"files": [
+        {"name": "clean", "content": base64.b64encode(b"clean").decode()},
+        {"name": "infected", "content": base64.b64encode(infected).decode()},
+    ]})
+
+    assert resp.status_code == 200
+    resp_d = resp.json
+
+    assert resp_d["status"] == "FOUND"
+    assert [f["name"] for f in resp_d["files"]] == ["clean", "infected"]
+    assert resp_d["files"][0]["status"] == "OK"
+    assert resp_d["files"][1]["status"] == "FOUND"
+    assert resp_d["files"][1]["virus"] == "Win.Test.EICAR_HDB-1"
+    assert resp_d["files"][1]["file_size"] == len(infected)
+
+
+def test_scan_rate_limit(client):
+    client.application.config.update({
+        "RATE_LIMIT_HEADER": "X-Api-Key",
+        "RATE_LIMIT_REQUESTS": 0.01,
+        "RATE_LIMIT_BURST": 100,
+    })
+    try:
+        resp = client.post("/api/v1/clamav/scan", data=b"hello",
+                           content_type="application/octet-stream",
+                           headers={"X-Api-Key": "tenant"})
+        assert resp.status_code == 200
+
+        resp = client.post("/api/v1/clamav/scan", data=b"hello",
+                           content_type="application/octet-stream",
+                           headers={"X-Api-Key": "tenant"})
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "100"
+
+        resp = client.get("/api/v1/metrics")
+        assert resp.json["rate_limit"]["rejected"] == 1
+    finally:
+        for name in ("RATE_LIMIT_HEADER", "RATE_LIMIT_REQUESTS",
+                     "RATE_LIMIT_BURST"):
+            del client.application.config[name]
+
+
+def test_scan_rate_limit_per_worker(client):
+    client.application.config.update({
+        "RATE_LIMIT_REQUESTS": 0.02,
+        "RATE_LIMIT_BURST": 100,
+        "WORKER_PROCESSES": 2,
+    })
+    try:
+        # a bucket of 1 request, refilled at 0.01 requests/s
+        resp = client.post("/api/v1/clamav/scan", data=b"hello",
+                           content_type="application/octet-stream")
+        assert resp.status_code == 200
+
+        resp = client.post("/api/v1/clamav/scan", data=b"hello",
+                           content_type="application/octet-stream")
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "100"
+    finally:
+        for name in ("RATE_LIMIT_REQUESTS", "RATE_LIMIT_BURST",
+                     "WORKER_PROCESSES"):
+            del client.application.config[name]
+
+
+def test_debug_endpoints_disabled(client):
+    resp = client.get("/debug/profile")
+    assert resp.status_code == 404
+
+    client.application.config["DEBUG_TOKEN"] = "secret"
+    auth = {"Authorization": "Bearer secret"}
+    try:
+        resp = client.post("/debug/profile",
+                           headers={"Authorization": "Bearer wrong"})
+        assert resp.status_code == 401
+
+        resp = client.post("/debug/profile?requests=1", headers=auth)
+        assert resp.status_code == 202
+        client.get("/api/v1/clamav/ping")
+        resp = client.get("/debug/profile?sort=bogus", headers=auth)
+        assert resp.status_code == 400
+        resp = client.get("/debug/profile?sort=tottime", headers=auth)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        assert "requests profiled: 1" in resp.text
+
+        resp = client.post("/debug/tracemalloc?seconds=0", headers=auth)
+        assert resp.status_code == 202
+        resp = client.get("/debug/tracemalloc", headers=auth)
+        assert resp.status_code == 200
+    finally:
+        del client.application.config["DEBUG_TOKEN"]
+
+
+def test_scan_with_missing_shared_state(client, monkeypatch, tmp_path):
+    from clamav_rest_service import sharedstate
+    monkeypatch.setattr(sharedstate, "_attached_pid", None)
+    monkeypatch.setenv(sharedstate.ENV_PATH, str(tmp_path / "missing"))
+    try:
+        resp = client.post("/api/v1/clamav/scan", data=b"clean",
+                           content_type="application/octet-stream")
+        assert resp.status_code == 200
+        assert resp.json["status"] == "OK"
+        assert client.get("/api/v1/metrics").json["service"]["scans"] == 1
+    finally:
+        monkeypatch.setattr(sharedstate, "_attached_pid", None)
+        monkeypatch.setattr(sharedstate, "_attached", None)
+
+
+def test_ready(client):
+    from clamav_rest_service import db_monitor
+    db_monitor().poll()
+
+    resp = client.get("/ready")
+    assert resp.status_code == 200
+    assert resp.json["status"] == "OK"
+    assert resp.json["db_version"]
+
+    resp = client.post("/api/v1/clamav/scan", data=b"hello",
+                       content_type="application/octet-stream")
+    assert resp.json["db_version"] == db_monitor().snapshot.version
+
+
+def test_not_ready_when_clamd_unreachable(client, tmp_path):
+    from clamav_rest_service import db_monitor
+    monitor = db_monitor()
+    monitor.poll()
+
+    client.application.config["CLAMD_SOCKET_PATH"] = \
+        str(tmp_path / "missing.sock")
+    try:
+        # a single failed poll of the monitor thread
+        monitor.stop()
+        monitor._run()
+        resp = client.get("/ready")
+    finally:
+        client.application.config["CLAMD_SOCKET_PATH"] = "/tmp/clamd.sock"
+        monitor.poll()
+
+    assert resp.status_code == 503
+    assert resp.json["status"] == "KO"
@@ -0,0 +1,69 @@
+import base64
+import io
+import json
+
+import pytest
+from clamav_rest_service import jsonstream
+from clamav_rest_service.jsonstream import JsonStreamError, iter_json_files
+
+
+def read_files(document: bytes) -> list[tuple[str | None, bytes]]:
+    files = []
+    for json_file in iter_json_files(io.BytesIO(document)):
+        files.append((json_file, json_file.stream.read()))
+    return [(f.name, content) for f, content in files]
+
+
+@pytest.fixture(params=[7, 64 * 1024])
+def chunk_size(request, monkeypatch):
+    # small chunks stress values split across reads
+    monkeypatch.setattr(jsonstream, "READ_CHUNK_SIZE", request.param)
+    return request.param
+
+
+def test_iter_json_files(chunk_size):
+    first = bytes(range(256)) * 10
+    document = json.dumps({
+        "other": {"nested": [1, 2.5e3, None, True, "\"x\""]},
+        "files": [
+            {"name": "first.bin",
+             "content": base64.b64encode(first).decode()},
+            # name after content, escaped slashes and line breaks
+            {"content": base64.encodebytes(b"second\xff\xfe").decode(),
+             "name": "sécond 😀.txt"},
+        ],
+    }, ensure_ascii=True).replace("//", "\\/\\/").encode()
+
+    assert read_files(document) == [
+        ("first.bin", first),
+        ("sécond 😀.txt", b"second\xff\xfe"),
+    ]
+
+
+def test_unconsumed_content_is_skipped():
+    document = json.dumps({"files": [
+        {"name": "a", "content": base64.b64encode(b"a" * 1000).decode()},
+        {"name": "b", "content": base64.b64encode(b"b").decode()},
+    ]}).encode()
+
+    names = [f.name for f in iter_json_files(io.BytesIO(document))]
+
+    assert names == ["a", "b"]
+
+
+@pytest.mark.parametrize("document", [
+    b'{"files": [{"name": "a", "content": "YWJj"}',
+    b'{"files": [{"name": "a", "content": "YWJ"}]}',
+    b'{"files": [{"name": "a", "content": "Y!Jj"}]}',
+    b'{"files": [{"name": "a"}]}',
+    b'{"files": {}}',
+    b'["files"]',
+    # invalid unicode escapes
+    b'{"files": [{"name": "\\udbff\\uffff", "content": ""}]}',
+    b'{"files": [{"name": "\\udc00", "content": ""}]}',
+    b'{"files": [{"name": "\\ud800x", "content": ""}]}',
+    b'{"files": [{"name": "\\u-001", "content": ""}]}',
+])
+def test_malformed(document):
+    with pytest.raises(JsonStreamError):
+        read_files(document)
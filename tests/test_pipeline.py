@@ -0,0 +1,138 @@
+import hashlib
+import io
+
+import pytest
+from clamav_rest_service.clamd import ClamdScanResult, ClamdScanStatus
+from clamav_rest_service.hashlist import HashList
+from clamav_rest_service.pipeline import ClamdStage, HashListStage, \
+    ScanContext, ScanPipeline, ScanPipelineError, SkipTypesStage, \
+    SniffStage, sniff_type
+
+
+class UnseekableStream(io.BytesIO):
+    def seekable(self):
+        return False
+
+
+class FakeClamd():
+    received = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def instream_send(self, stream):
+        data = b""
+        buf = stream.read(1000)
+        while buf:
+            data += buf
+            buf = stream.read(1000)
+        self.received.append(data)
+        return len(data)
+
+    def instream_result(self):
+        return ClamdScanResult(raw_data=None, message="stream: OK",
+                               details=[], input_file="stream",
+                               status=ClamdScanStatus.OK)
+
+
+@pytest.mark.parametrize("head, mime_type", [
+    (b"", None),
+    (b"%PDF-1.7\n", "application/pdf"),
+    (b"PK\x03\x04rest", "application/zip"),
+    (b"\x00" * 257 + b"ustar\x0000", "application/x-tar"),
+    (b"MZ\x90\x00", "application/x-msdownload"),
+    ("caffè".encode(), "text/plain"),
+    (b"\x00\x01\x02", "application/octet-stream"),
+])
+def test_sniff_type(head, mime_type):
+    assert sniff_type(head) == mime_type
+
+
+def test_single_pass():
+    content = b"%PDF-1.4\n" + bytes(range(256)) * 100
+    FakeClamd.received = []
+    pipeline = ScanPipeline([SniffStage(), ClamdStage(FakeClamd)])
+    ctx = ScanContext(UnseekableStream(content), "file.pdf")
+
+    result = pipeline.run(ctx)
+
+    assert result.status == ClamdScanStatus.OK
+    assert FakeClamd.received == [content]
+    assert ctx.sniffed_type == "application/pdf"
+    assert ctx.extra == {"file_type": "application/pdf"}
+    assert ctx.size == len(content)
+    assert ctx.digests()["sha256"] == hashlib.sha256(content).digest()
+    assert set(ctx.timings) == {"sniff", "clamd"}
+    assert pipeline.stats()["clamd"]["calls"] == 1
+
+
+@pytest.mark.parametrize("stream_class", [io.BytesIO, UnseekableStream])
+def test_short_circuit(stream_class):
+    content = b"\x89PNG\r\n\x1a\n" + b"\x00" * 2000
+    FakeClamd.received = []
+    pipeline = ScanPipeline([SkipTypesStage(["image/png"]),
+                             ClamdStage(FakeClamd)])
+    ctx = ScanContext(stream_class(content), "image.png")
+
+    result = pipeline.run(ctx)
+
+    assert result.status == ClamdScanStatus.OK
+    assert not FakeClamd.received
+    assert ctx.extra == {"skipped_type": "image/png"}
+    assert ctx.size == len(content)
+    assert "clamd" not in ctx.timings
+
+
+def test_last_stage_must_be_clamd():
+    with pytest.raises(ScanPipelineError):
+        ScanPipeline([SniffStage()])
+
+
+@pytest.fixture
+def blocklist(tmp_path):
+    path = tmp_path / "known-bad.sha256"
+    path.write_text(hashlib.sha256(b"\x89PNG\r\n\x1a\nbad").hexdigest()
+                    + "\n")
+    return HashList(str(path), trusted=False)
+
+
+@pytest.mark.parametrize("stages", [[], [SkipTypesStage(["image/png"])]])
+def test_hash_list_after_unseekable(blocklist, stages):
+    content = b"\x89PNG\r\n\x1a\nbad"
+    FakeClamd.received = []
+    pipeline = ScanPipeline([HashListStage(lambda: [blocklist]), *stages,
+                             ClamdStage(FakeClamd)])
+    ctx = ScanContext(UnseekableStream(content), "image.png")
+
+    result = pipeline.run(ctx)
+
+    # found once the digests are complete, also for skipped types
+    assert result.status == ClamdScanStatus.FOUND
+    assert result.virus == "KnownBad.Hash"
+    assert ctx.extra["hash_list"] == "known-bad.sha256"
+    assert ctx.size == len(content)
+
+
+def test_hash_list_after_no_match(blocklist):
+    FakeClamd.received = []
+    pipeline = ScanPipeline([HashListStage(lambda: [blocklist]),
+                             ClamdStage(FakeClamd)])
+    ctx = ScanContext(UnseekableStream(b"clean"), "clean")
+
+    assert pipeline.run(ctx).status == ClamdScanStatus.OK
+    assert "hash_list" not in ctx.extra
+
+
+@pytest.mark.parametrize("mime_type", [
+    "text/plain",
+    "application/octet-stream",
+    "application/x-msdownload",
+    "application/zip",
+    "application/pdf",
+])
+def test_skip_types_refuses_active_types(mime_type):
+    with pytest.raises(ScanPipelineError):
+        SkipTypesStage(["image/png", mime_type])
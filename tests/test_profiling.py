@@ -0,0 +1,91 @@
+import sys
+import time
+
+import pytest
+from werkzeug.exceptions import Conflict, NotFound
+from clamav_rest_service import profiling
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+def serve_requests(count: int) -> None:
+    """Serve requests as a sync worker: one at a time, in this thread.
+    """
+    for _ in range(count):
+        capture = profiling.current
+        token = capture.request_started()
+        deadline = time.monotonic() + 0.02
+        while time.monotonic() < deadline:
+            fib(15)
+        if token is not None:
+            capture.request_finished(token)
+
+
+@pytest.fixture(autouse=True)
+def no_capture(monkeypatch):
+    monkeypatch.setattr(profiling, "current", None)
+    monkeypatch.setattr(profiling, "current_tracemalloc", None)
+
+
+@pytest.mark.parametrize("collapsed", [False, True])
+def test_profile_next_requests(collapsed):
+    with pytest.raises(NotFound):
+        profiling.profile_report()
+
+    capture = profiling.arm_profile(3, 10, collapsed=collapsed)
+    serve_requests(5)
+    assert not capture.running()
+    assert capture.hooked == 3
+    if collapsed:
+        # the sampler stops once the captured requests are done
+        time.sleep(0.05)
+
+    report = profiling.profile_report(sort="tottime")
+    assert "fib" in report
+    if collapsed:
+        stack, count = report.splitlines()[0].rsplit(" ", 1)
+        assert "serve_requests" in stack
+        assert int(count) > 0
+    else:
+        assert "requests profiled: 3, skipped: 0" in report
+    assert sys.getprofile() is None
+
+
+def test_profiler_disabled_after_capture_ends():
+    capture = profiling.arm_profile(1, 10)
+    token = capture.request_started()
+    assert not capture.running()
+    # the request finishes after the capture is over
+    capture.request_finished(token)
+    assert sys.getprofile() is None
+
+    # a new capture can profile again
+    profiling.arm_profile(1, 10)
+    serve_requests(1)
+    assert "requests profiled: 1" in profiling.profile_report()
+
+
+def test_one_capture_at_a_time():
+    profiling.arm_profile(1, 10)
+    with pytest.raises(Conflict):
+        profiling.arm_profile(1, 10)
+    serve_requests(1)
+    profiling.arm_profile(1, 10)
+
+
+def test_tracemalloc_capture():
+    kept = []
+    profiling.arm_tracemalloc(10)
+    with pytest.raises(Conflict):
+        profiling.arm_tracemalloc(10)
+    for _ in range(100):
+        kept.append(bytearray(1024))
+
+    report = profiling.tracemalloc_report(limit=5)
+    assert "(running)" in report
+    assert "test_profiling.py" in report
+
+    profiling.current_tracemalloc.stop()
+    assert "(finished)" in profiling.tracemalloc_report(limit=5)
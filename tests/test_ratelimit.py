@@ -0,0 +1,144 @@
+import threading
+
+import pytest
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from clamav_rest_service.ratelimit import FairQueue, RateLimiter, \
+    REQUEST_COST, parse_weights
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parse_weights():
+    assert parse_weights("") == {}
+    assert parse_weights("bulk=0.5, vip=4") == {"bulk": 0.5, "vip": 4.0}
+    with pytest.raises(ValueError):
+        parse_weights("bulk")
+    with pytest.raises(ValueError):
+        parse_weights("bulk=0")
+
+
+def test_rate_limit_requests():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_rate=1, bytes_rate=None, burst=2,
+                          clock=clock)
+    limiter.acquire("a", 0)
+    limiter.acquire("a", 0)
+    with pytest.raises(TooManyRequests) as e:
+        limiter.acquire("a", 0)
+    assert e.value.retry_after == 1
+    # other clients are not affected
+    limiter.acquire("b", 0)
+
+    clock.now = 1.0
+    limiter.acquire("a", 0)
+    assert limiter.stats() == {"clients": 2, "admitted": 4, "rejected": 1}
+
+
+def test_rate_limit_bytes():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_rate=None, bytes_rate=100, burst=10,
+                          weights={"vip": 2}, clock=clock)
+    # larger than the bucket, admitted when full, leaving a debt
+    limiter.acquire("a", 3000)
+    with pytest.raises(TooManyRequests) as e:
+        limiter.acquire("a", 10)
+    # 2000 bytes of debt + 10 bytes at 100 bytes/s
+    assert e.value.retry_after == 21
+
+    limiter.acquire("vip", 2000)
+    limiter.charge("vip", 1990)
+    with pytest.raises(TooManyRequests) as e:
+        limiter.acquire("vip", 20)
+    # weighted: 2010 bytes at 200 bytes/s
+    assert e.value.retry_after == 11
+
+
+def test_fair_queue_order():
+    queue = FairQueue(slots=1, weights={"vip": 2})
+    queue.acquire("bulk", 0, timeout=None)
+
+    served = []
+
+    def scan(client, size):
+        queue.acquire(client, size, timeout=5)
+        served.append(client)
+        queue.release()
+
+    # bulk queues many large scans before the others show up
+    threads = [threading.Thread(target=scan, args=("bulk", 10 * REQUEST_COST))
+               for _ in range(3)]
+    threads += [threading.Thread(target=scan, args=(client, 0))
+                for client in ("small", "vip")]
+    for thread in threads:
+        thread.start()
+    while queue.stats()["waiting"] < len(threads):
+        pass
+
+    queue.release()
+    for thread in threads:
+        thread.join()
+    assert served[:2] == ["vip", "small"]
+    assert queue.stats() == {"slots": 1, "active": 0, "waiting": 0,
+                             "timeouts": 0}
+
+
+def test_fair_queue_timeout():
+    queue = FairQueue(slots=1)
+    queue.acquire("a", 0, timeout=None)
+    with pytest.raises(ServiceUnavailable) as e:
+        queue.acquire("b", 0, timeout=0.01)
+    assert e.value.retry_after
+    queue.release()
+    queue.acquire("b", 0, timeout=0.01)
+    assert queue.stats()["timeouts"] == 1
+
+
+def test_rate_limit_forgets_least_recently_seen():
+    clock = FakeClock()
+    limiter = RateLimiter(requests_rate=1, bytes_rate=None, burst=1,
+                          clock=clock, max_clients=2)
+    # buckets are all empty, still the oldest client is forgotten
+    for client in ("a", "b", "a", "c"):
+        clock.now += 0.1
+        try:
+            limiter.acquire(client, 0)
+        except TooManyRequests:
+            pass
+    assert limiter.stats()["clients"] == 2
+    # "b" starts again with a full bucket, "a" was seen recently
+    limiter.acquire("b", 0)
+    with pytest.raises(TooManyRequests):
+        limiter.acquire("c", 0)
+
+
+def test_fair_queue_timeout_rolls_back():
+    queue = FairQueue(slots=1)
+    queue.acquire("a", 0, timeout=None)
+    for _ in range(3):
+        with pytest.raises(ServiceUnavailable):
+            queue.acquire("b", 100 * REQUEST_COST, timeout=0.01)
+
+    served = []
+
+    def scan(client):
+        queue.acquire(client, 0, timeout=5)
+        served.append(client)
+        queue.release()
+
+    # timed out scans of "b" don't count against its next ones
+    threads = [threading.Thread(target=scan, args=(client,))
+               for client in ("b", "c")]
+    for thread in threads:
+        thread.start()
+        while queue.stats()["waiting"] < threads.index(thread) + 1:
+            pass
+    queue.release()
+    for thread in threads:
+        thread.join()
+    assert served == ["b", "c"]
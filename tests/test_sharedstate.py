@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import pytest
+from clamav_rest_service import sharedstate
+from clamav_rest_service.sharedstate import SharedState, SharedStateError
+
+
+def add_scans(path, count):
+    state = SharedState(path)
+    for _ in range(count):
+        state.add("scans")
+    state.close()
+
+
+def test_shared_across_processes(tmp_path):
+    path = sharedstate.create(str(tmp_path))
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=add_scans, args=(path, 500))
+               for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    state = SharedState(path)
+    assert state.get("scans") == 1500
+    assert state.snapshot()["scans_found"] == 0
+
+    state.add_all({"scans_found": 2, "scanned_bytes": 1024})
+    assert state.get("scans_found") == 2
+    assert state.compare_and_set("db_version", 0, 27450)
+    assert not state.compare_and_set("db_version", 0, 27451)
+    assert state.get("db_version") == 27450
+    state.set_max("db_version", 27449)
+    assert state.get("db_version") == 27450
+    state.set_max("db_version", 27451)
+    assert state.get("db_version") == 27451
+    state.close()
+
+
+def test_incompatible_layout(tmp_path):
+    path = tmp_path / "state"
+    path.write_bytes(b"\x00" * sharedstate.SIZE)
+    with pytest.raises(SharedStateError):
+        SharedState(str(path))
+    with pytest.raises(SharedStateError):
+        SharedState(str(tmp_path / "missing"))
+
+
+def test_attach(tmp_path, monkeypatch):
+    monkeypatch.setattr(sharedstate, "_attached_pid", None)
+    monkeypatch.delenv(sharedstate.ENV_PATH, raising=False)
+    assert sharedstate.attach() is None
+
+    monkeypatch.setattr(sharedstate, "_attached_pid", None)
+    monkeypatch.setenv(sharedstate.ENV_PATH,
+                       sharedstate.create(str(tmp_path)))
+    state = sharedstate.attach()
+    assert state is sharedstate.attach()
+    assert state.path == os.environ[sharedstate.ENV_PATH]
+    state.close()
+    monkeypatch.setattr(sharedstate, "_attached", None)
+
+
+def test_attach_falls_back_to_local_state(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(sharedstate, "_attached_pid", None)
+    monkeypatch.setenv(sharedstate.ENV_PATH, str(tmp_path / "missing"))
+    state = sharedstate.attach()
+    assert isinstance(state, sharedstate.LocalState)
+    assert sharedstate.attach() is state
+    assert len(caplog.records) == 1
+
+    state.add_all({"scans": 1, "scanned_bytes": 10})
+    assert state.snapshot()["scanned_bytes"] == 10
+    state.close()
+    monkeypatch.setattr(sharedstate, "_attached", None)
+
+
+def test_gunicorn_conf_does_not_import_package(tmp_path):
+    # as in the gunicorn master, with a broken service configuration
+    code = (
+        "import logging, os, runpy, sys, types\n"
+        "conf = runpy.run_path('docker/gunicorn_conf.py')\n"
+        "server = types.SimpleNamespace(\n"
+        "    log=logging.getLogger(),\n"
+        "    cfg=types.SimpleNamespace(workers=3))\n"
+        "conf['on_starting'](server)\n"
+        "path = os.environ['CLAMAV_SHARED_STATE_PATH']\n"
+        "assert os.path.exists(path)\n"
+        "assert os.environ['CLAMAV_WORKER_PROCESSES'] == '3'\n"
+        "assert not [m for m in sys.modules\n"
+        "            if m.startswith(('clamav_rest_service', 'flask'))]\n"
+        "conf['on_exit'](server)\n"
+        "assert not os.path.exists(path)\n")
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   env={"CLAMAV_SHARED_STATE_DIR": str(tmp_path),
+                        "CLAMAV_HASH_ALLOWLIST": "/nonexistent"})
@@ -0,0 +1,23 @@
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+from clamav_rest_service.spool import SpoolBudget, SpoolFile
+
+
+def test_spool_budget(tmp_path):
+    budget = SpoolBudget()
+
+    first = SpoolFile(max_size=4, dir=str(tmp_path), budget_limit=10,
+                      spool_budget=budget)
+    first.write(b"12345678")
+    assert budget.current == 8
+
+    second = SpoolFile(max_size=4, dir=str(tmp_path), budget_limit=10,
+                       spool_budget=budget)
+    with pytest.raises(ServiceUnavailable) as e:
+        second.write(b"12345678")
+    assert e.value.retry_after
+    assert second.closed
+
+    first.close()
+    stats = budget.stats()
+    assert stats == {"current_bytes": 0, "peak_bytes": 8, "rejected": 1}
@@ -0,0 +1,63 @@
+import gzip
+import io
+import zlib
+
+import pytest
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, \
+    UnsupportedMediaType
+from clamav_rest_service.wrappers import DecompressingStream
+
+
+def test_gzip_multi_member():
+    data = gzip.compress(b"first ") + gzip.compress(b"second")
+    stream = DecompressingStream(io.BytesIO(data), "gzip")
+
+    assert io.BufferedReader(stream).read() == b"first second"
+    assert stream.size == len(b"first second")
+
+
+def test_deflate():
+    data = zlib.compress(b"deflated")
+    stream = DecompressingStream(io.BytesIO(data), "deflate")
+
+    assert io.BufferedReader(stream).read() == b"deflated"
+
+
+def test_max_size():
+    data = gzip.compress(b"\x00" * 1024 * 1024)
+    stream = io.BufferedReader(
+        DecompressingStream(io.BytesIO(data), "gzip", max_size=1024))
+
+    with pytest.raises(RequestEntityTooLarge):
+        stream.read()
+
+
+def test_invalid_content():
+    data = gzip.compress(b"some content")[:-10]
+    stream = io.BufferedReader(DecompressingStream(io.BytesIO(data), "gzip"))
+
+    with pytest.raises(BadRequest):
+        stream.read()
+
+
+def test_unsupported_encoding():
+    with pytest.raises(UnsupportedMediaType):
+        DecompressingStream(io.BytesIO(b""), "compress")
+
+
+def test_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    data = zstandard.ZstdCompressor().compress(b"zstd content")
+    stream = DecompressingStream(io.BytesIO(data), "zstd")
+
+    assert io.BufferedReader(stream).read() == b"zstd content"
+
+
+def test_brotli():
+    brotli = pytest.importorskip("brotli")
+    data = brotli.compress(b"\x00" * 1024 * 1024)
+    stream = io.BufferedReader(
+        DecompressingStream(io.BytesIO(data), "br", max_size=1024))
+
+    with pytest.raises(RequestEntityTooLarge):
+        stream.read()